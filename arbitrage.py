@@ -0,0 +1,175 @@
+from collections import deque
+from bot_logging import get_logger
+from latency import latency, now
+
+logger = get_logger("arbitrage")
+
+# taker fee per exchange as a fraction of notional
+DEFAULT_FEES = {"Binance": 0.001, "Coinbase": 0.006, "OKX": 0.001}
+QUOTE_CURRENCIES = ["USDT", "USDC", "USD"]
+
+
+def base_asset(symbol):
+    '''
+    BTCUSDT (Binance), BTC-USD (Coinbase) and BTC-USDT (OKX) all map to BTC.
+    '''
+    if "-" in symbol:
+        return symbol.split("-")[0]
+    for quote in QUOTE_CURRENCIES:
+        if symbol.endswith(quote) and len(symbol) > len(quote):
+            return symbol[:-len(quote)]
+    return symbol
+
+
+class Quote():
+    '''
+    Latest top of book of one symbol on one exchange.
+    '''
+    __slots__ = ("exchange", "symbol", "bid", "bid_size", "ask", "ask_size", "ts")
+
+    def __init__(self, exchange, symbol) -> None:
+        self.exchange = exchange
+        self.symbol = symbol
+        self.bid = self.bid_size = self.ask = self.ask_size = 0.0
+        self.ts = 0.0
+
+
+class BestPriceIndex():
+    '''
+    Consolidated top of book per base asset over every exchange trading it.
+    An update overwrites one Quote and rescans the quotes of that asset, one per exchange,
+    so it is O(1) in the number of ticks and symbols.
+    '''
+    def __init__(self) -> None:
+        self.quotes = {} # asset -> {exchange: Quote}
+
+    def update(self, exchange, symbol, bid, bid_size, ask, ask_size, ts):
+        asset = base_asset(symbol)
+        quotes = self.quotes.setdefault(asset, {})
+        quote = quotes.get(exchange)
+        if quote is None:
+            quote = quotes[exchange] = Quote(exchange, symbol)
+        quote.bid, quote.bid_size, quote.ask, quote.ask_size, quote.ts = bid, bid_size, ask, ask_size, ts
+        return asset
+
+    #(best bid quote, best ask quote, exchanges quoting) of an asset, ignoring quotes older than max_age_ms before ts
+    def best(self, asset, ts = None, max_age_ms = None):
+        best_bid = best_ask = None
+        fresh = 0
+        oldest = ts - max_age_ms if ts is not None and max_age_ms is not None else None
+        for quote in self.quotes.get(asset, {}).values():
+            if oldest is not None and quote.ts < oldest:
+                continue
+            fresh += 1
+            if quote.bid > 0 and (best_bid is None or quote.bid > best_bid.bid):
+                best_bid = quote
+            if quote.ask > 0 and (best_ask is None or quote.ask < best_ask.ask):
+                best_ask = quote
+        return best_bid, best_ask, fresh
+
+
+class ArbitrageSignal():
+    '''
+    Buy `size` at `ask` on buy_exchange and sell it at `bid` on sell_exchange.
+    kind is "crossed" when the markets are crossed but the edge does not cover fees plus the
+    threshold, "opportunity" when it does.
+    '''
+    __slots__ = ("kind", "asset", "buy_exchange", "buy_symbol", "ask", "sell_exchange", "sell_symbol", "bid", "size", "gross_bps", "net_bps", "ts")
+
+    def __init__(self, kind, asset, buy, sell, size, gross_bps, net_bps, ts) -> None:
+        self.kind = kind
+        self.asset = asset
+        self.buy_exchange, self.buy_symbol, self.ask = buy.exchange, buy.symbol, buy.ask
+        self.sell_exchange, self.sell_symbol, self.bid = sell.exchange, sell.symbol, sell.bid
+        self.size = size
+        self.gross_bps = gross_bps
+        self.net_bps = net_bps
+        self.ts = ts
+
+    def __repr__(self):
+        return (f"{self.kind} {self.asset}: buy {self.size} {self.buy_symbol} on {self.buy_exchange} at {self.ask}, "
+                f"sell {self.sell_symbol} on {self.sell_exchange} at {self.bid} (gross {self.gross_bps:.1f}bps, net {self.net_bps:.1f}bps)")
+
+
+class ArbitrageEngine():
+    '''
+    Tick listener of every book: keeps the BestPriceIndex current and checks the asset of each tick
+    for a crossed market across exchanges. Edges are net of the taker fee on both legs.
+    A signal fires once when a pair of exchanges crosses and again only after the cross has closed;
+    opportunities are sent to the PortfolioManager as a buy leg followed by a sell of the same size, see execute.
+    Detection latency (socket receive -> signal checked) is recorded per tick as the "arbitrage" stage.
+    '''
+    def __init__(self, portfolio_manager = None, fees = None, threshold_bps = 5.0, max_quote_age_ms = 1000, index = None) -> None:
+        self.portfolio_manager = portfolio_manager
+        self.fees = dict(DEFAULT_FEES, **(fees or {}))
+        self.threshold_bps = threshold_bps
+        self.max_quote_age_ms = max_quote_age_ms # quotes this much older than the tick are stale and skipped
+        self.index = index or BestPriceIndex()
+        self.open_crosses = {} # asset -> (buy exchange, sell exchange, kind) of the cross already signalled
+        self.signals = deque(maxlen=10000) # most recent signals
+        self.signal_counts = {"crossed": 0, "opportunity": 0}
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    #called by PriceLevelBook.on_trade for every tick
+    def on_tick(self, book, message):
+        asset = self.index.update(book.exchange, message.symbol, message.bidPx, message.bidSz, message.askPx, message.askSz, message.ts)
+        self.check(asset, message.ts)
+        if message.receiveNs is not None:
+            latency.record("arbitrage", now() - message.receiveNs, book.exchange, message.symbol, "ArbitrageEngine")
+
+    def check(self, asset, ts):
+        best_bid, best_ask, fresh = self.index.best(asset, ts, self.max_quote_age_ms)
+        if fresh < 2 or best_bid is None or best_ask is None:
+            return None # not enough fresh quotes to tell whether a signalled cross is still open
+        if best_bid.exchange == best_ask.exchange or best_bid.bid <= best_ask.ask:
+            self.open_crosses.pop(asset, None)
+            return None
+
+        gross = best_bid.bid - best_ask.ask
+        net = best_bid.bid * (1 - self.fees.get(best_bid.exchange, 0.0)) - best_ask.ask * (1 + self.fees.get(best_ask.exchange, 0.0))
+        gross_bps = gross / best_ask.ask * 10000
+        net_bps = net / best_ask.ask * 10000
+        kind = "opportunity" if net_bps >= self.threshold_bps else "crossed"
+
+        #only signal on entering a cross (or when it turns profitable), not on every tick it lasts
+        state = (best_ask.exchange, best_bid.exchange, kind)
+        if self.open_crosses.get(asset) == state:
+            return None
+        self.open_crosses[asset] = state
+
+        signal = ArbitrageSignal(kind, asset, best_ask, best_bid, min(best_ask.ask_size, best_bid.bid_size), gross_bps, net_bps, ts)
+        self.signals.append(signal)
+        self.signal_counts[kind] += 1
+        logger.info("Arbitrage %r", signal)
+        if kind == "opportunity" and self.portfolio_manager is not None:
+            self.execute(signal)
+        for listener in self.listeners:
+            listener(signal)
+        return signal
+
+    def execute(self, signal):
+        '''
+        Both legs go through the portfolio manager's risk checks and pay the taker fee of their exchange.
+        The buy leg is capped at what the risk manager would let the sell leg sell, and the sell leg is sized
+        to what the buy leg filled. Whatever the sell leg still leaves unhedged is sold back on the buy
+        exchange at its bid. Returns (bought, sold, unwound).
+        '''
+        portfolio_manager = self.portfolio_manager
+        buy_fee = self.fees.get(signal.buy_exchange, 0.0)
+        sell_fee = self.fees.get(signal.sell_exchange, 0.0)
+        size = min(signal.size, portfolio_manager.sell_size(signal.bid, signal.size, signal.sell_symbol))
+        bought = portfolio_manager.buy(signal.ask, size, signal.buy_symbol, fee=buy_fee) if size > 0 else 0
+        if not bought:
+            return 0, 0, 0
+        sold = portfolio_manager.sell(signal.bid, bought, signal.sell_symbol, fee=sell_fee)
+        unwound = 0
+        if sold < bought:
+            quote = self.index.quotes[signal.asset][signal.buy_exchange]
+            unwound = portfolio_manager.sell(quote.bid, bought - sold, signal.buy_symbol, fee=buy_fee)
+            logger.warning("Sell leg of %s filled %s of %s, unwound %s on %s at %s", signal.asset, sold, bought, unwound, signal.buy_exchange, quote.bid)
+            if sold + unwound < bought:
+                logger.warning("%s of %s left unhedged on %s", bought - sold - unwound, signal.asset, signal.buy_exchange)
+        return bought, sold, unwound
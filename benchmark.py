@@ -0,0 +1,394 @@
+import argparse
+import glob
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+from latency import latency
+from orderbook import PriceLevelBook, DepthBook, merge_incremental_data
+from decoding import loads
+from portfolio_manager import PortfolioManager
+from strategy import MACDStrategy, RSIStrategy, SimpleMovingAvgStrategy
+from indicators import IndicatorRegistry, WindowedMACD, StreamingMACD, RollingHurst
+from symbol_handler import BinanceSymbolHandler, CoinbaseSymbolHandler, OKXSymbolHandler
+from tick_format import Tick, exchange_for_symbol
+from replay import TickColumns, TICK_FIELDS
+from sweep import symbol_for_file
+
+STRATEGIES = {"macd": MACDStrategy, "rsi": RSIStrategy, "sma": SimpleMovingAvgStrategy}
+SYMBOL_HANDLERS = {"Binance": BinanceSymbolHandler, "Coinbase": CoinbaseSymbolHandler, "OKX": OKXSymbolHandler}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_messages(file_name):
+    '''
+    The capture in file_name (csv or .ticks) as the per-tick messages HistHandler used to replay.
+    '''
+    columns = TickColumns.from_file(file_name)
+    rows = zip(*[columns.column(field).tolist() for field in TICK_FIELDS])
+    return [dict(zip(TICK_FIELDS, row)) for row in rows]
+
+
+def replay_messages(symbol, strategy, messages):
+    #fresh handler, book, strategy and portfolio for every pass; a live handler loads no capture of its own
+    handler = SYMBOL_HANDLERS[exchange_for_symbol(symbol)](symbol, "live")
+    portfolio_manager = PortfolioManager(initial_balance=1000000, risk_manager="cppi", equities=[symbol])
+    handler.get_orderbook().add_book_listener(STRATEGIES[strategy](market_data_manager=None, portfolio_manager=portfolio_manager))
+    start = time.perf_counter()
+    for message in messages:
+        handler.parse_message(message, "historic")
+    return time.perf_counter() - start, handler.get_orderbook(), portfolio_manager
+
+
+def bench_pipeline(symbol, strategy, messages, memory = True):
+    '''
+    Ticks through parse_message -> PriceLevelBook.on_trade -> strategy -> PortfolioManager.
+    Throughput comes from an uninstrumented pass, the component split from a pass with the
+    latency histograms on, peak memory from a pass under tracemalloc.
+    '''
+    enabled = latency.enabled
+    latency.enabled = False
+    seconds, book, portfolio_manager = replay_messages(symbol, strategy, messages)
+    candles = len(book.candles)
+
+    latency.clear()
+    latency.enabled = True
+    instrumented, book, portfolio_manager = replay_messages(symbol, strategy, messages)
+    components = {"candle": 0.0, "signal": 0.0, "execution": 0.0}
+    for (stage, exchange, stage_symbol, stage_strategy), histogram in latency.histograms.items():
+        if stage in components:
+            components[stage] += histogram.total / 1e9
+    components["parse_and_dispatch"] = max(0.0, instrumented - sum(components.values()))
+    latency.clear()
+    latency.enabled = enabled
+
+    peak_memory = None
+    if memory:
+        tracemalloc.start()
+        replay_messages(symbol, strategy, messages)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {"symbol": symbol,
+            "strategy": strategy,
+            "ticks": len(messages),
+            "candles": candles,
+            "seconds": seconds,
+            "ticks_per_sec": len(messages) / seconds,
+            "candles_per_sec": candles / seconds,
+            "component_seconds": components,
+            "peak_memory_bytes": peak_memory,
+            "pnl": portfolio_manager.get_pnl_without_save()}
+
+
+def timed(function, repeat):
+    #best of 3 runs, in ns per call
+    best = None
+    for _ in range(3):
+        start = time.perf_counter_ns()
+        function(repeat)
+        elapsed = (time.perf_counter_ns() - start) / repeat
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def as_ticks(messages, symbol = "-"):
+    return [Tick(m["last"], m["lastSz"], float(m["ts"]), m["askPx"], m["askSz"], m["bidPx"], m["bidSz"], symbol) for m in messages]
+
+
+def micro_generate_candle(messages, repeat = 50000):
+    messages = as_ticks(messages[:repeat])
+
+    def run(count):
+        book = PriceLevelBook(stored_length=count)
+        for message in messages[:count]:
+            book.generate_candle(message)
+    return {"generate_candle": timed(run, len(messages))}
+
+
+#building the per-tick message: the old dict against the slotted Tick, plus bytes per message
+def micro_tick(messages, repeat = 50000):
+    rows = [tuple(message[field] for field in TICK_FIELDS) for message in messages[:repeat]]
+
+    def run_dict(count):
+        for last, lastSz, ts, askPx, askSz, bidPx, bidSz in rows[:count]:
+            message = {"last": last, "lastSz": lastSz, "ts": ts, "askPx": askPx, "askSz": askSz, "bidPx": bidPx, "bidSz": bidSz, "symbol": "BTCUSDT"}
+            message["askPx"]
+
+    def run_tick(count):
+        for row in rows[:count]:
+            Tick(*row, "BTCUSDT").askPx
+
+    tracemalloc.start()
+    dicts = [{"last": row[0], "lastSz": row[1], "ts": row[2], "askPx": row[3], "askSz": row[4], "bidPx": row[5], "bidSz": row[6], "symbol": "BTCUSDT"} for row in rows[:1000]]
+    dict_bytes = tracemalloc.get_traced_memory()[0] / len(dicts)
+    tracemalloc.reset_peak()
+    del dicts
+    base = tracemalloc.get_traced_memory()[0]
+    ticks = [Tick(*row, "BTCUSDT") for row in rows[:1000]]
+    tick_bytes = (tracemalloc.get_traced_memory()[0] - base) / len(ticks)
+    tracemalloc.stop()
+    del ticks
+    print(f"{'message size':<36} dict {dict_bytes:.0f} B, Tick {tick_bytes:.0f} B")
+    return {"tick_dict": timed(run_dict, len(rows)), "tick_slots": timed(run_tick, len(rows))}
+
+
+def micro_hurst(prices, window = 100, max_lag = 20, repeat = 2000):
+    strategy = MACDStrategy(market_data_manager=None, portfolio_manager=None)
+    windows = [prices[i:i + window] for i in range(min(repeat, len(prices) - window))]
+
+    def reference(count):
+        for series in windows[:count]:
+            strategy.get_hurst_exponent(series, max_lag)
+
+    def rolling(count):
+        hurst = RollingHurst(window, 2, max_lag)
+        for price in prices[:count]:
+            hurst.update(price)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {"get_hurst_exponent": timed(reference, len(windows)),
+                "RollingHurst.update": timed(rolling, min(len(prices), 20000))}
+
+
+def micro_macd(prices, short_window = 12, long_window = 26, signal_span = 9, repeat = 2000):
+    import pandas as pd
+    windows = [prices[i:i + long_window] for i in range(min(repeat, len(prices) - long_window))]
+
+    #the pandas path MACDStrategy used before the streaming indicators
+    def pandas_ewm(count):
+        for window in windows[:count]:
+            data = pd.DataFrame(window, columns=['price'])
+            macd = data['price'].ewm(span=short_window).mean() - data['price'].ewm(span=long_window).mean()
+            macd.ewm(span=signal_span).mean().iloc[-1]
+
+    def windowed(count):
+        macd = WindowedMACD(short_window, long_window, signal_span)
+        for price in prices[:count]:
+            macd.update(price)
+
+    def streaming(count):
+        macd = StreamingMACD(short_window, long_window, signal_span)
+        for price in prices[:count]:
+            macd.update(price)
+
+    count = min(len(prices), 20000)
+    return {"pandas_ewm_window": timed(pandas_ewm, len(windows)),
+            "WindowedMACD.update": timed(windowed, count),
+            "StreamingMACD.update": timed(streaming, count)}
+
+
+def micro_shared_indicators(prices, variants = 8, repeat = 5000):
+    #indicator cost per candle of several MACD variants (different hurst thresholds) on one book vs each on its own
+    strategies = [MACDStrategy(market_data_manager=None, portfolio_manager=None, hurst_thresh=0.5 + 0.02 * i) for i in range(variants)]
+    candles = [{"price": price} for price in prices[:repeat]]
+
+    def run(count, shared):
+        registry = IndicatorRegistry()
+        for strategy in strategies:
+            strategy.use_indicators(registry if shared else IndicatorRegistry())
+        for candle in candles[:count]:
+            for strategy in strategies:
+                strategy.indicators.on_candle(candle)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {f"indicators x{variants} separate": timed(lambda count: run(count, False), len(candles)),
+                f"indicators x{variants} shared": timed(lambda count: run(count, True), len(candles))}
+
+
+def micro_merge(levels = 400, updates = 50, repeat = 2000):
+    rng = np.random.default_rng(0)
+    bids = [[100.0 - 0.01 * i, float(size)] for i, size in enumerate(rng.integers(1, 10, levels))]
+    asks = [[100.01 + 0.01 * i, float(size)] for i, size in enumerate(rng.integers(1, 10, levels))]
+    full = {"bids": bids, "asks": asks}
+    picks = sorted(rng.choice(levels, updates, replace=False).tolist())
+    incremental = {"bids": [[bids[i][0], float(i % 3)] for i in picks],
+                   "asks": [[asks[i][0], float(i % 3)] for i in picks]}
+
+    def run(count):
+        for _ in range(count):
+            merge_incremental_data(full, incremental)
+
+    #the same delta applied in place
+    depth = DepthBook()
+    depth.apply_snapshot(bids, asks)
+
+    def run_in_place(count):
+        for _ in range(count):
+            depth.apply_update(incremental["bids"], incremental["asks"])
+    return {f"merge_incremental_data_{levels}x{updates}": timed(run, repeat),
+            f"DepthBook.apply_update_{levels}x{updates}": timed(run_in_place, repeat)}
+
+
+def depth_stream(symbol = "BTC-USDT", levels = 400, updates = 20000, changes = 10, tick = 0.1, seed = 0):
+    '''
+    Local stand-in for OKX's books channel: a snapshot of `levels` per side, then `updates` deltas
+    of `changes` levels each, clustered near the top of the book like the real stream (around a fixed
+    mid, so the book never crosses). JSON frames.
+    '''
+    rng = np.random.default_rng(seed)
+    mid = 30000.0
+    arg = {"channel": "books", "instId": symbol}
+
+    def level(price, size):
+        return [f"{price:.1f}", f"{size:.4f}", "0", "1"]
+
+    frames = [json.dumps({"arg": arg, "action": "snapshot",
+                          "data": [{"bids": [level(mid - tick * (i + 1), 1.0) for i in range(levels)],
+                                    "asks": [level(mid + tick * (i + 1), 1.0) for i in range(levels)],
+                                    "ts": "0", "seqId": 0, "prevSeqId": -1}]})]
+    for seq in range(1, updates + 1):
+        offsets = rng.integers(1, 40, changes)
+        sizes = np.where(rng.random(changes) < 0.3, 0.0, rng.random(changes) * 5)
+        half = changes // 2
+        frames.append(json.dumps({"arg": arg, "action": "update",
+                                  "data": [{"bids": [level(mid - tick * offset, size) for offset, size in zip(offsets[:half], sizes[:half])],
+                                            "asks": [level(mid + tick * offset, size) for offset, size in zip(offsets[half:], sizes[half:])],
+                                            "ts": str(seq), "seqId": seq, "prevSeqId": seq - 1}]}))
+    return frames
+
+
+def bench_depth(frames, symbol = "BTC-USDT"):
+    #replayed depth frames through decode -> OKXSymbolHandler.parse_message -> PriceLevelBook.on_order_add
+    handler = OKXSymbolHandler(symbol, "live")
+    enabled = latency.enabled
+    latency.enabled = False
+    start = time.perf_counter()
+    for frame in frames:
+        handler.parse_message(loads(frame), "live")
+    seconds = time.perf_counter() - start
+    latency.enabled = enabled
+    depth = handler.get_orderbook().depth
+
+    queries = 100000
+    start = time.perf_counter_ns()
+    for _ in range(queries):
+        depth.best_bid()
+        depth.best_ask()
+    best_ns = (time.perf_counter_ns() - start) / queries
+    return {"updates": len(frames),
+            "seconds": seconds,
+            "updates_per_sec": len(frames) / seconds,
+            "levels": len(depth.bids) + len(depth.asks),
+            "best_bid_ask_ns": best_ns}
+
+
+# modules whose import cost shows up in CLI startup, each timed in a fresh interpreter
+STARTUP_MODULES = ["bot_logging", "market_data_manager", "portfolio_manager", "strategy", "replay", "vectorized"]
+
+
+def bench_startup(repeat = 3):
+    '''
+    Startup cost in fresh interpreters: wall time of `python main.py --help` and import time of each STARTUP_MODULES
+    module, best of `repeat` runs, in seconds.
+    '''
+    def best_of(command):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, output
+
+    help_seconds, _ = best_of([sys.executable, "main.py", "--help"])
+    imports = {}
+    for module in STARTUP_MODULES:
+        #timed inside the child so interpreter startup is not counted
+        _, output = best_of([sys.executable, "-c", f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"])
+        imports[module] = float(output.split()[-1])
+    return {"help_seconds": help_seconds, "import_seconds": imports}
+
+
+def run_benchmarks(file_names, strategies, memory = True):
+    results = {"commit": git_commit(),
+               "time": datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "pipeline": [],
+               "micro_ns": {}}
+
+    first_messages = None
+    for file_name in file_names:
+        symbol = symbol_for_file(file_name)
+        messages = load_messages(file_name)
+        first_messages = first_messages or messages
+        for strategy in strategies:
+            result = bench_pipeline(symbol, strategy, messages, memory)
+            results["pipeline"].append(result)
+            print(f"{symbol:<10} {strategy:<5} {result['ticks_per_sec']:>10.0f} ticks/s {result['candles_per_sec']:>9.0f} candles/s "
+                  + " ".join(f"{name}={seconds:.3f}s" for name, seconds in result["component_seconds"].items())
+                  + (f" peak={result['peak_memory_bytes'] / 2**20:.1f}MiB" if memory else ""))
+
+    #micro benchmarks on the first capture
+    if first_messages:
+        book = PriceLevelBook(stored_length=len(first_messages))
+        for message in as_ticks(first_messages):
+            book.generate_candle(message)
+        prices = book.candles.column("mean").tolist()
+        for micro in (micro_generate_candle(first_messages), micro_tick(first_messages), micro_hurst(prices), micro_macd(prices), micro_shared_indicators(prices), micro_merge()):
+            results["micro_ns"].update(micro)
+        for name, ns in results["micro_ns"].items():
+            print(f"{name:<36} {ns / 1000:>10.2f} us/call")
+
+    results["startup"] = bench_startup()
+    print(f"{'main.py --help':<36} {results['startup']['help_seconds'] * 1000:>10.1f} ms")
+    for module, seconds in results["startup"]["import_seconds"].items():
+        print(f"{'import ' + module:<36} {seconds * 1000:>10.1f} ms")
+
+    results["depth"] = bench_depth(depth_stream())
+    print(f"{'depth stream':<36} {results['depth']['updates_per_sec']:>10.0f} updates/s, best bid+ask {results['depth']['best_bid_ask_ns']:.0f} ns")
+
+    total_ticks = sum(result["ticks"] for result in results["pipeline"])
+    total_seconds = sum(result["seconds"] for result in results["pipeline"])
+    results["ticks_per_sec"] = total_ticks / total_seconds if total_seconds else 0.0
+    return results
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as file:
+        baseline = json.load(file)
+    print(f"\nCompared with {baseline_file} (commit {baseline.get('commit')}), >1 is faster now")
+    if baseline.get("ticks_per_sec"):
+        print(f"{'pipeline ticks/s':<36} {results['ticks_per_sec'] / baseline['ticks_per_sec']:>8.2f}x")
+    old_pipeline = {(result["symbol"], result["strategy"]): result for result in baseline.get("pipeline", [])}
+    for result in results["pipeline"]:
+        old = old_pipeline.get((result["symbol"], result["strategy"]))
+        if old:
+            print(f"{result['symbol'] + ' ' + result['strategy']:<36} {result['ticks_per_sec'] / old['ticks_per_sec']:>8.2f}x")
+    if baseline.get("depth"):
+        print(f"{'depth stream updates/s':<36} {results['depth']['updates_per_sec'] / baseline['depth']['updates_per_sec']:>8.2f}x")
+    if baseline.get("startup"):
+        print(f"{'main.py --help':<36} {baseline['startup']['help_seconds'] / results['startup']['help_seconds']:>8.2f}x")
+    for name, ns in results["micro_ns"].items():
+        if name in baseline.get("micro_ns", {}):
+            print(f"{name:<36} {baseline['micro_ns'][name] / ns:>8.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput benchmarks on the captures in historical_data/, results are saved as json")
+    parser.add_argument('-f', '--files', nargs='*', help='Capture files (default: historical_data/*.csv)', default=None)
+    parser.add_argument('-s', '--strategies', choices=list(STRATEGIES), nargs='*', help='Strategies to run (default: all)', default=list(STRATEGIES))
+    parser.add_argument('-o', '--output', type = str, help='Result file (default: benchmark_<commit>.json)', default=None)
+    parser.add_argument('--compare', type = str, help='Earlier result file to compare against', default=None)
+    parser.add_argument('--no_memory', action='store_true', help='Skip the tracemalloc pass')
+    args = parser.parse_args()
+
+    file_names = args.files or sorted(glob.glob('historical_data/*.csv'))
+    results = run_benchmarks(file_names, args.strategies, memory=not args.no_memory)
+    output = args.output or f"benchmark_{results['commit'] or 'local'}.json"
+    with open(output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Saved {output}")
+    if args.compare:
+        compare(results, args.compare)
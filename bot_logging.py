@@ -0,0 +1,53 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOGGER_NAME = "trading_bot"
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+
+_listener = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler that leaves message formatting to the listener thread, so a log call on the
+    websocket or strategy path only does the level check and a queue put.
+    '''
+    def prepare(self, record):
+        return record
+
+
+def get_logger(name = None):
+    return logging.getLogger(LOGGER_NAME if name is None else f"{LOGGER_NAME}.{name}")
+
+
+def setup_logging(level = "INFO"):
+    '''
+    Sends every bot log record through a queue to one listener thread that formats it and writes to stdout.
+    Records below `level` are dropped at the call site.
+    '''
+    global _listener
+    logger = get_logger()
+    logger.setLevel(level)
+    if _listener is not None:
+        return logger
+
+    records = queue.SimpleQueue()
+    logger.addHandler(DeferredQueueHandler(records))
+    logger.propagate = False
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(message)s"))
+    _listener = logging.handlers.QueueListener(records, stream)
+    _listener.start()
+    atexit.register(stop_logging)
+    return logger
+
+
+#write out everything still queued, needed before os._exit
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
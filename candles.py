@@ -0,0 +1,258 @@
+import numpy as np
+from indicators import IndicatorRegistry
+from latency import now
+
+# one finished candle; start is the candle's bucket start time (ms)
+CANDLE_DTYPE = np.dtype([("start", np.float64),
+                         ("open", np.float64),
+                         ("high", np.float64),
+                         ("low", np.float64),
+                         ("close", np.float64),
+                         ("mean", np.float64),
+                         ("volume", np.float64),
+                         ("vwap", np.float64),
+                         ("ticks", np.int64)])
+
+
+class CandleStore():
+    '''
+    Fixed capacity circular store of finished candles, preallocated once.
+    Every candle is written twice (slot i and i + capacity), so the last N candles are always one
+    contiguous slice and last(n) can hand out a zero-copy view, oldest candle first.
+    '''
+    def __init__(self, capacity = 10000) -> None:
+        self.capacity = capacity
+        self.data = np.zeros(2 * capacity, dtype=CANDLE_DTYPE)
+        self.position = 0 # slot the next candle is written to
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, start, open, high, low, close, mean, volume, vwap, ticks):
+        row = (start, open, high, low, close, mean, volume, vwap, ticks)
+        self.data[self.position] = row
+        self.data[self.position + self.capacity] = row
+        self.position = (self.position + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def last(self, n = None):
+        #structured view of the last n candles (all stored candles if n is None)
+        n = self.count if n is None else min(n, self.count)
+        end = self.position + self.capacity
+        return self.data[end - n:end]
+
+    def column(self, field, n = None):
+        #view of one field, e.g. column("close", 50)
+        return self.last(n)[field]
+
+    def latest(self):
+        if self.count == 0:
+            return None
+        return self.data[self.position + self.capacity - 1]
+
+    def clear(self):
+        self.position = 0
+        self.count = 0
+
+    #replace the contents with CANDLE_DTYPE records, oldest first (e.g. a checkpointed last())
+    def load(self, records):
+        records = records[-self.capacity:]
+        n = len(records)
+        self.data[:n] = records
+        self.data[self.capacity:self.capacity + n] = records
+        self.position = n % self.capacity
+        self.count = n
+
+
+# unit suffixes accepted in timeframe names, e.g. "1s", "5m", "1h"
+TIMEFRAME_UNITS = {"s": 1000, "m": 60000, "h": 3600000, "d": 86400000}
+
+
+def timeframe_length(timeframe):
+    #"5m" -> 300000, lengths in ms pass through
+    if isinstance(timeframe, (int, float)):
+        return int(timeframe)
+    unit = TIMEFRAME_UNITS.get(timeframe[-1:])
+    if unit is None or not timeframe[:-1].isdigit() or int(timeframe[:-1]) == 0:
+        raise ValueError(f"timeframe {timeframe!r} must look like 1s, 5m, 1h or 1d")
+    return int(timeframe[:-1]) * unit
+
+
+class Timeframe():
+    '''
+    Candles of one length: the candle in progress, the finished ones, and the listeners of this resolution.
+    Candles are aligned to multiples of the length (start = ts // length * length) and a tick at
+    exactly start + length already belongs to the next candle.
+    '''
+    def __init__(self, name, length_ms, stored_length = 10000) -> None:
+        self.name = name
+        self.length_ms = length_ms
+        self.candles = CandleStore(stored_length)
+        self.listeners = []
+        self.indicators = IndicatorRegistry() # shared by the strategies listening to this timeframe
+        self.last_candle = None
+        self.start = None # start of the candle in progress, None until the first tick
+        self.open = self.high = self.low = self.close = 0.0
+        self.price_sum = 0.0
+        self.ticks = 0
+        self.volume = 0.0
+        self.notional = 0.0
+
+    #candle in progress, finished candles and indicators, copied so it can be written out on another thread
+    def snapshot(self):
+        return {"start": self.start, "open": self.open, "high": self.high, "low": self.low, "close": self.close,
+                "price_sum": self.price_sum, "ticks": self.ticks, "volume": self.volume, "notional": self.notional,
+                "last_candle": self.last_candle, "candles": self.candles.last().copy(), "indicators": self.indicators.snapshot()}
+
+    def restore(self, state):
+        for field in ("start", "open", "high", "low", "close", "price_sum", "ticks", "volume", "notional", "last_candle"):
+            setattr(self, field, state[field])
+        self.candles.load(state["candles"])
+        self.indicators.restore(state["indicators"])
+
+    def begin(self, start):
+        self.start = start
+        self.ticks = 0
+        self.price_sum = self.volume = self.notional = 0.0
+
+    def add_tick(self, price, size):
+        if self.ticks == 0:
+            self.open = self.high = self.low = price
+        elif price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        self.price_sum += price
+        self.ticks += 1
+        self.volume += size
+        self.notional += price * size
+
+    #fold the finished candle of a shorter timeframe into the candle in progress, before that one restarts
+    def add_candle(self, shorter):
+        if self.start is None:
+            self.begin(shorter.start // self.length_ms * self.length_ms)
+        if self.ticks == 0:
+            self.open, self.high, self.low = shorter.open, shorter.high, shorter.low
+        else:
+            self.high = max(self.high, shorter.high)
+            self.low = min(self.low, shorter.low)
+        self.close = shorter.close
+        self.price_sum += shorter.price_sum
+        self.ticks += shorter.ticks
+        self.volume += shorter.volume
+        self.notional += shorter.notional
+
+    #store the candle in progress and return it in the form listeners receive
+    def finish(self):
+        if self.ticks == 0:
+            return self.finish_empty()
+        mean = self.price_sum / self.ticks
+        vwap = self.notional / self.volume if self.volume else mean
+        self.candles.append(self.start, self.open, self.high, self.low, self.close, mean, self.volume, vwap, self.ticks)
+        self.last_candle = {"price": mean, "start": self.start, "open": self.open, "high": self.high, "low": self.low,
+                            "close": self.close, "volume": self.volume, "vwap": vwap, "ticks": self.ticks, "timeframe": self.name}
+        return self.last_candle
+
+    #a candle without ticks: flat at the previous close, no volume
+    def finish_empty(self):
+        close = self.close
+        self.candles.append(self.start, close, close, close, close, close, 0.0, close, 0)
+        self.last_candle = {"price": close, "start": self.start, "open": close, "high": close, "low": close,
+                            "close": close, "volume": 0.0, "vwap": close, "ticks": 0, "timeframe": self.name}
+        return self.last_candle
+
+
+class CandleAggregator():
+    '''
+    Builds candles of several lengths (e.g. 1s, 1m, 5m, 1h) from one tick stream in one pass.
+    Only the shortest timeframe sees ticks; when one of its candles finishes it is folded into the next
+    timeframe, and so on up, so each added resolution costs work per candle of the one below it, not per tick.
+    Every length must be a multiple of the next shorter one so the buckets nest.
+    A gap with no ticks gives flat, zero volume candles for the empty buckets when fill_gaps is set, and no
+    candles otherwise. Listeners get on_trade_add(candle, message) like book listeners, with message being
+    the tick that closed the candle.
+    '''
+    def __init__(self, timeframes = ("1s", "1m", "5m", "1h"), stored_length = 10000, fill_gaps = True) -> None:
+        self.stored_length = stored_length
+        self.fill_gaps = fill_gaps
+        self.skip_gap = False # next roll leaves the gap before it empty, see skip_next_gap
+        self.timeframes = [] # shortest first
+        self.by_name = {}
+        for timeframe in timeframes:
+            self.add_timeframe(timeframe)
+
+    def add_timeframe(self, timeframe):
+        '''
+        Returns the Timeframe, creating it if needed. One added while ticks are flowing starts with the
+        next candle of the timeframe below it, so its first candle may be partial.
+        '''
+        length = timeframe_length(timeframe)
+        for existing in self.timeframes:
+            if existing.length_ms == length:
+                self.by_name[timeframe] = existing
+                return existing
+        lengths = sorted([existing.length_ms for existing in self.timeframes] + [length])
+        if any(longer % shorter for shorter, longer in zip(lengths, lengths[1:])):
+            raise ValueError(f"timeframe {timeframe!r} does not nest with {[existing.name for existing in self.timeframes]}")
+        added = Timeframe(timeframe if isinstance(timeframe, str) else f"{length}ms", length, self.stored_length)
+        self.timeframes.insert(lengths.index(length), added)
+        self.by_name[timeframe] = self.by_name[added.name] = added
+        return added
+
+    #the next tick does not continue the stream so far (e.g. live ticks after a replay of an old capture):
+    #finish the candles in progress as usual but publish no flat candles for the time in between
+    def skip_next_gap(self):
+        self.skip_gap = True
+
+    def get_timeframe(self, timeframe):
+        return self.by_name[timeframe]
+
+    def add_listener(self, listener, timeframe):
+        self.add_timeframe(timeframe).listeners.append(listener)
+
+    def remove_listener(self, listener, timeframe):
+        self.get_timeframe(timeframe).listeners.remove(listener)
+
+    #tick listener interface of PriceLevelBook
+    def on_tick(self, book, message):
+        self.add_tick(message.ts, message.last, message.lastSz, message)
+
+    def add_tick(self, ts, price, size, message):
+        base = self.timeframes[0]
+        if base.start is None:
+            base.begin(ts // base.length_ms * base.length_ms)
+            #a shorter timeframe was just added in front, the ones above may still need to roll
+            self.roll(ts, message, 1)
+        elif ts >= base.start + base.length_ms:
+            self.roll(ts, message)
+        self.skip_gap = False
+        base.add_tick(price, size)
+
+    #finish every timeframe whose candle ended before ts, shortest first
+    def roll(self, ts, message, first = 0):
+        for i in range(first, len(self.timeframes)):
+            timeframe = self.timeframes[i]
+            if timeframe.start is None or ts < timeframe.start + timeframe.length_ms:
+                break
+            candle = timeframe.finish()
+            if i + 1 < len(self.timeframes):
+                self.timeframes[i + 1].add_candle(timeframe)
+            self.publish(timeframe, candle, message)
+
+            start = ts // timeframe.length_ms * timeframe.length_ms
+            if self.fill_gaps and not self.skip_gap:
+                #empty buckets only matter to this timeframe: they add no ticks to the longer ones
+                timeframe.start += timeframe.length_ms
+                while timeframe.start < start:
+                    self.publish(timeframe, timeframe.finish_empty(), message)
+                    timeframe.start += timeframe.length_ms
+            timeframe.begin(start)
+
+    def publish(self, timeframe, candle, message):
+        for listener in timeframe.listeners:
+            #start of the signal stage of this listener
+            message.publishNs = now()
+            listener.on_trade_add(candle, message)
@@ -0,0 +1,137 @@
+import os
+import pickle
+import threading
+import time
+from contextlib import ExitStack
+from bot_logging import get_logger
+from latency import latency, now
+
+logger = get_logger("checkpoint")
+
+CHECKPOINT_VERSION = 1
+
+
+def book_key(book):
+    return f"{book.exchange}:{book.symbol}"
+
+
+class Checkpointer():
+    '''
+    Periodic snapshots of the bot's state to one local file, and warm restarts from it.
+    A snapshot holds, per book, the candle in progress, the finished candles and the indicator registries of the
+    book and its timeframes (the strategies' whole state lives in those registries), plus the correlation
+    window and the portfolio's balance and positions.
+    Snapshots are taken from a tick listener on every book, holding the lock of every book, so when books run
+    on several threads none of them is mid-tick while it is copied; pickling and writing happen on a background
+    thread, and the file is replaced atomically, so a crash while writing leaves the previous checkpoint in place.
+    On restore the portfolio is always loaded, the market state only when the checkpoint is at most max_age
+    seconds old: after a longer downtime the indicators would describe a market that has moved on.
+    Params:
+    file_name: checkpoint file, written by this bot only (it is a pickle, never load one from elsewhere)
+    interval: seconds between snapshots
+    max_age: oldest checkpoint (seconds) whose books and indicators get restored
+    '''
+    def __init__(self, file_name, portfolio_manager, books, interval = 30.0, max_age = 300.0) -> None:
+        self.file_name = file_name
+        self.portfolio_manager = portfolio_manager
+        self.books = {book_key(book): book for book in books}
+        self.interval = interval
+        self.max_age = max_age
+        self.next_save = time.monotonic() + interval
+        self.lock = threading.Lock() # one snapshot at a time when books run on several threads
+        self.writer = None
+        self.saves = 0
+        self.restored_books = set() # keys of the books restore() loaded
+
+    #take snapshots from the ticks of every book
+    def attach(self):
+        for book in self.books.values():
+            book.add_tick_listener(self)
+
+    #tick listener interface of PriceLevelBook, a clock check unless a snapshot is due
+    def on_tick(self, book, message):
+        if time.monotonic() >= self.next_save and self.lock.acquire(blocking=False):
+            try:
+                start = now()
+                self.save()
+                latency.record("checkpoint", now() - start, book.exchange, book.symbol)
+            finally:
+                self.lock.release()
+
+    #the thread taking the snapshot already holds its own book's lock; the other book threads never wait on
+    #self.lock (on_tick only tries it), so taking every book lock in turn can't deadlock
+    def snapshot(self):
+        correlation = self.portfolio_manager.correlation
+        with ExitStack() as locks:
+            for book in self.books.values():
+                locks.enter_context(book.lock)
+            return {"version": CHECKPOINT_VERSION,
+                    "saved_at": time.time(),
+                    "books": {key: book.snapshot() for key, book in self.books.items()},
+                    "correlation": correlation.snapshot() if correlation is not None else None,
+                    "portfolio": self.portfolio_manager.snapshot()}
+
+    def save(self, wait = False):
+        '''
+        Takes a snapshot and writes it in the background; a snapshot due while the previous one is still
+        being written is skipped. wait=True writes on the calling thread, e.g. on shutdown.
+        '''
+        self.next_save = time.monotonic() + self.interval
+        if self.writer is not None and self.writer.is_alive():
+            if not wait:
+                logger.debug("Previous checkpoint still being written, skipping this one")
+                return
+            self.writer.join()
+        state = self.snapshot()
+        if wait:
+            self.write(state)
+        else:
+            self.writer = threading.Thread(target=self.write, args=(state,), name="checkpoint", daemon=True)
+            self.writer.start()
+
+    def write(self, state):
+        start = time.perf_counter()
+        temp_name = f"{self.file_name}.tmp"
+        with open(temp_name, 'wb') as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_name, self.file_name)
+        self.saves += 1
+        logger.debug("Checkpoint written to %s in %.1f ms", self.file_name, (time.perf_counter() - start) * 1000)
+
+    def restore(self):
+        '''
+        Loads the checkpoint file if there is one. Call after every strategy is added to its book, so the
+        indicators they hold take over the saved state. Returns True if anything was restored.
+        '''
+        if not os.path.exists(self.file_name):
+            logger.info("No checkpoint at %s, starting cold", self.file_name)
+            return False
+        try:
+            with open(self.file_name, 'rb') as file:
+                state = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            logger.warning("Could not read checkpoint %s (%s), starting cold", self.file_name, e)
+            return False
+        if state.get("version") != CHECKPOINT_VERSION:
+            logger.warning("Checkpoint %s has version %s, expected %s, starting cold", self.file_name, state.get("version"), CHECKPOINT_VERSION)
+            return False
+
+        dropped = self.portfolio_manager.restore(state["portfolio"])
+        if dropped:
+            logger.warning("Checkpointed positions in symbols no longer traded were dropped: %s", dropped)
+        age = time.time() - state["saved_at"]
+        logger.info("Restored balance %s and positions %s from %s (%.0fs old)", self.portfolio_manager.balance,
+                    self.portfolio_manager.net_positions, self.file_name, age)
+        if age > self.max_age:
+            logger.info("Checkpoint is older than %ss, books and indicators start cold", self.max_age)
+            return True
+
+        for key, book in self.books.items():
+            if key in state["books"]:
+                book.restore(state["books"][key])
+                self.restored_books.add(key)
+                logger.info("Restored %s candles and %s indicators of %s", len(book.candles), len(book.indicators), key)
+        correlation = self.portfolio_manager.correlation
+        if correlation is not None and state["correlation"] is not None and correlation.restore(state["correlation"]):
+            logger.info("Restored %s correlation rows", len(correlation))
+        return True
@@ -0,0 +1,142 @@
+import math
+import numpy as np
+from strategy import IStrategy
+
+
+class RollingCorrelation(IStrategy):
+    '''
+    Rolling means, variances and covariances of the candle log returns of several symbols.
+    Add it as a book listener of every symbol's PriceLevelBook. Books close candles at different
+    times, so each book only updates its symbol's latest price; whenever the candle clock (start of
+    the newest candle seen on any book) moves forward, one row of returns since the previous clock
+    step is taken for all symbols, with prices carried forward for symbols that did not trade.
+    Rows start once every symbol has a price.
+    The last `window` rows sit in a ring buffer next to running sums of the returns and of their
+    pairwise products, so a row costs O(k^2) for k symbols and queries never touch the buffer.
+    The sums are rebuilt from the buffer every resync_every rows to drop rounding drift.
+    '''
+    def __init__(self, symbols, window = 100, candle_length_ms = 1000, resync_every = 1000) -> None:
+        super().__init__()
+        self.symbols = list(symbols)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.window = window
+        self.candle_length_ms = candle_length_ms
+        self.resync_every = resync_every
+
+        k = len(self.symbols)
+        self.prices = np.full(k, np.nan) # latest candle price per symbol
+        self.sampled = np.full(k, np.nan) # prices at the previous clock step
+        self.clock = None
+
+        self.rows = np.zeros((window, k))
+        self.position = 0
+        self.count = 0
+        self.sum = np.zeros(k)
+        self.sum_products = np.zeros((k, k))
+        self.rows_added = 0
+        self.cache = {}
+
+    #book listener interface
+    def on_trade_add(self, new_candle, message):
+        self.update(message.symbol, new_candle["price"], message.ts)
+
+    #no trading here, recorded candles go in like live ones
+    def warm_up(self, new_candle, message):
+        self.on_trade_add(new_candle, message)
+
+    def update(self, symbol, price, ts):
+        i = self.index.get(symbol)
+        if i is None or not price > 0:
+            return
+        clock = ts // self.candle_length_ms * self.candle_length_ms
+        if self.clock is not None and clock > self.clock:
+            self.sample()
+        if self.clock is None or clock > self.clock:
+            self.clock = clock
+        self.prices[i] = price
+
+    #one row of log returns since the previous clock step
+    def sample(self):
+        if np.isnan(self.prices).any():
+            return
+        if not np.isnan(self.sampled).any():
+            self.add_row(np.log(self.prices / self.sampled))
+        self.sampled = self.prices.copy()
+
+    def add_row(self, row):
+        if self.count == self.window:
+            old = self.rows[self.position]
+            self.sum -= old
+            self.sum_products -= np.outer(old, old)
+        else:
+            self.count += 1
+        self.rows[self.position] = row
+        self.position = (self.position + 1) % self.window
+        self.sum += row
+        self.sum_products += np.outer(row, row)
+        self.rows_added += 1
+        if self.rows_added % self.resync_every == 0:
+            rows = self.rows[:self.count]
+            self.sum = rows.sum(axis=0)
+            self.sum_products = rows.T @ rows
+        self.cache = {}
+
+    def __len__(self):
+        return self.count
+
+    #the return window and running sums, for checkpoints
+    def snapshot(self):
+        return {"symbols": list(self.symbols), "window": self.window, "prices": self.prices.copy(), "sampled": self.sampled.copy(),
+                "clock": self.clock, "rows": self.rows.copy(), "position": self.position, "count": self.count,
+                "sum": self.sum.copy(), "sum_products": self.sum_products.copy(), "rows_added": self.rows_added}
+
+    #returns False (and keeps the current state) if the snapshot was taken over other symbols or another window
+    def restore(self, state):
+        if state["symbols"] != self.symbols or state["window"] != self.window:
+            return False
+        for field in ("prices", "sampled", "clock", "rows", "position", "count", "sum", "sum_products", "rows_added"):
+            setattr(self, field, state[field])
+        self.cache = {}
+        return True
+
+    def mean(self):
+        if self.count == 0:
+            return np.full(len(self.symbols), np.nan)
+        return self.sum / self.count
+
+    #sample covariance matrix of the returns in the window, cached until the next row
+    def covariance(self):
+        if "covariance" not in self.cache:
+            n = self.count
+            if n < 2:
+                self.cache["covariance"] = np.full((len(self.symbols), len(self.symbols)), np.nan)
+            else:
+                self.cache["covariance"] = (self.sum_products - np.outer(self.sum, self.sum) / n) / (n - 1)
+        return self.cache["covariance"]
+
+    def correlation(self):
+        if "correlation" not in self.cache:
+            covariance = self.covariance()
+            with np.errstate(divide="ignore", invalid="ignore"):
+                std = np.sqrt(np.clip(np.diag(covariance), 0.0, None))
+                correlation = covariance / np.outer(std, std)
+            self.cache["correlation"] = np.clip(correlation, -1.0, 1.0)
+        return self.cache["correlation"]
+
+    def variance(self, symbol):
+        return self.covariance()[self.index[symbol], self.index[symbol]]
+
+    def volatility(self, symbol):
+        variance = self.variance(symbol)
+        return math.sqrt(max(variance, 0.0)) if not math.isnan(variance) else math.nan
+
+    def correlation_of(self, a, b):
+        return self.correlation()[self.index[a], self.index[b]]
+
+    def covariance_of(self, a, b):
+        return self.covariance()[self.index[a], self.index[b]]
+
+    #hedge ratio of a against b (regression slope of a's returns on b's), for pairs trading
+    def beta(self, a, b):
+        variance = self.variance(b)
+        return self.covariance_of(a, b) / variance if variance > 0 else math.nan
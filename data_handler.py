@@ -1,9 +1,14 @@
 import json 
-import websocket
+import os
 import typing
-import pandas as pd
+from replay import TickColumns, ColumnarReplay, ReplayCoordinator
+from tick_format import tick_file_name
+from decoding import loads
+from bot_logging import get_logger
+from latency import latency, now
 
 BaseSymbolHandler = typing.TypeVar('BaseSymbolHandler')
+logger = get_logger("data")
 
 
 class IDataHandler():
@@ -26,25 +31,26 @@ class WSHandler(IDataHandler):
         self.data_action = data_action
     
     def on_message(self, ws, message):
-        print(f"Data for {self.symbol} received from {self.url}")
-        if self.data_action == "live":
-            self.symbol_handler.parse_message(json.loads(message), self.data_action)
-        elif self.data_action == "download":
-            self.symbol_handler.parse_message(json.loads(message), self.data_action)
+        receive_ns = now()
+        logger.debug("Data for %s received from %s", self.symbol, self.url)
+        data = loads(message)
+        latency.record("decode", now() - receive_ns, self.symbol_handler.exchange, self.symbol)
+        self.symbol_handler.parse_message(data, self.data_action, receive_ns)
 
     def on_error(self, ws, error): 
-        print("websocket packet loss:", error)
+        logger.warning("websocket packet loss: %s", error)
     
     def on_close(self, ws):
-        print("Connection closed")
+        logger.info("Connection closed")
     
     def on_open(self, ws):
         ws.send(json.dumps(self.subscribe_message))
-        print(f"Subscribed to {self.symbol} at {self.url}")
+        logger.info("Subscribed to %s at %s", self.symbol, self.url)
 
 
     def start(self):
         # open websocket based on url and run forever
+        import websocket
         self.ws = websocket.WebSocketApp( url = self.url,
                                           on_message=self.on_message,
                                           on_error=self.on_error,
@@ -53,23 +59,52 @@ class WSHandler(IDataHandler):
         self.ws.run_forever()
     
 
+class MultiplexWSHandler(WSHandler):
+    '''
+    One websocket connection carrying every symbol of an exchange.
+    route(message) returns the (symbol_handler, data_action) a decoded message belongs to,
+    or None for subscription acks and other control messages.
+    '''
+    def __init__(self, url: str, subscribe_message: dict, route, name: str) -> None:
+        super().__init__(url=url, subscribe_message=subscribe_message, symbol=name, symbol_handler=None, data_action=None)
+        self.route = route
+
+    def on_message(self, ws, message):
+        receive_ns = now()
+        data = loads(message)
+        target = self.route(data)
+        if target is None:
+            return
+        symbol_handler, data_action = target
+        latency.record("decode", now() - receive_ns, symbol_handler.exchange, symbol_handler.symbol)
+        logger.debug("Data for %s received from %s", symbol_handler.symbol, self.url)
+        symbol_handler.parse_message(data, data_action, receive_ns)
+
+
 class HistHandler(IDataHandler):
     def __init__(self, symbol: str, symbol_handler: BaseSymbolHandler) -> None:
         super().__init__()
         self.symbol = symbol
         self.symbol_handler = symbol_handler
+        #prefer the memory-mapped binary capture when it is at least as recent as the csv one
         self.file_name = 'historical_data/' + symbol + "_data.csv"
-        self.data = pd.read_csv(self.file_name)
-        print("Number of messages in CSV file:", self.data.size)
+        binary_file_name = tick_file_name(symbol)
+        if os.path.exists(binary_file_name) and (not os.path.exists(self.file_name) or os.path.getmtime(binary_file_name) >= os.path.getmtime(self.file_name)):
+            self.file_name = binary_file_name
+        self.data = TickColumns.from_file(self.file_name)
+        logger.info("Number of messages in %s: %d", self.file_name, len(self.data))
     
     def on_message(self, message):
         self.symbol_handler.parse_message(message, "historic")
         pass
 
     def start(self):
-        #simulate live data by parsing each row/message at a time
-        for index, row in self.data.iterrows():
-            self.on_message(row)
+        #simulate live data by replaying the typed columns straight into the orderbook
+        ColumnarReplay(self.data, self.symbol).run(self.symbol_handler.get_orderbook())
+
+    #replay this capture as one stream of a time-ordered multi-symbol replay instead
+    def add_to_coordinator(self, coordinator: ReplayCoordinator):
+        coordinator.add_stream(self.data, self.symbol, self.symbol_handler.get_orderbook())
             
             
 
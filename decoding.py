@@ -0,0 +1,45 @@
+import json
+from datetime import datetime, timezone
+
+# fastest available JSON decoder: orjson, then ujson, then the stdlib
+try:
+    import orjson
+    loads = orjson.loads
+    JSON_BACKEND = "orjson"
+except ImportError:
+    try:
+        import ujson
+        loads = ujson.loads
+        JSON_BACKEND = "ujson"
+    except ImportError:
+        loads = json.loads
+        JSON_BACKEND = "json"
+
+
+class IsoTimestampParser():
+    '''
+    Parses UTC ISO-8601 timestamps like Coinbase's "2023-07-10T05:05:13.531234Z" into integer ms.
+    Ticks of one day share the date prefix, so the epoch of midnight is cached and only the time of day
+    is parsed per tick. Anything that isn't plain UTC falls back to datetime.fromisoformat.
+    '''
+    def __init__(self) -> None:
+        self.date_prefix = None
+        self.midnight_ms = 0
+
+    def __call__(self, text):
+        if len(text) < 20 or text[10] != "T" or text[13] != ":" or text[16] != ":" or text[-1] != "Z":
+            return int(datetime.fromisoformat(text).timestamp() * 1000)
+
+        date_prefix = text[:10]
+        if date_prefix != self.date_prefix:
+            midnight = datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]), tzinfo=timezone.utc)
+            self.midnight_ms = int(midnight.timestamp()) * 1000
+            self.date_prefix = date_prefix
+
+        ms = self.midnight_ms + ((int(text[11:13]) * 60 + int(text[14:16])) * 60 + int(text[17:19])) * 1000
+        if text[19] == ".":
+            #first three fractional digits are the milliseconds, the rest is truncated
+            fraction = text[20:-1]
+            ms += int((fraction + "00")[:3])
+        return ms
+
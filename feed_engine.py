@@ -0,0 +1,164 @@
+import asyncio
+import json
+import threading
+import time
+from bot_logging import get_logger
+from latency import latency
+
+logger = get_logger("feeds")
+
+
+class Feed():
+    '''
+    One websocket subscription run by the AsyncFeedEngine.
+    on_message is called with the raw text frame, on the event loop thread.
+    '''
+    def __init__(self, url: str, subscribe_message: dict, on_message, name: str) -> None:
+        self.url = url
+        self.subscribe_message = subscribe_message
+        self.on_message = on_message
+        self.name = name
+        self.messages_received = 0
+        self.messages_failed = 0 # messages dropped because on_message raised
+
+
+class AsyncFeedEngine():
+    '''
+    Multiplexes every websocket subscription on a single asyncio event loop, so the number of
+    feed threads stays at one however many symbols are subscribed.
+    Messages keep flowing through the usual parse_message -> PriceLevelBook.on_trade path.
+    max_size: largest message (bytes) accepted, None for no limit like the threaded WSHandler feeds; full depth
+    snapshots go well past the 1 MiB websockets closes the connection at by default
+    '''
+    def __init__(self, reconnect_delay: float = 1.0, max_reconnect_delay: float = 30.0, max_size: int = None) -> None:
+        self.feeds = []
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.max_size = max_size
+        self.loop = None
+        self.tasks = []
+        self.running = False
+
+    def add_feed(self, url, subscribe_message, on_message, name = None):
+        feed = Feed(url, subscribe_message, on_message, name or url)
+        self.feeds.append(feed)
+        return feed
+
+    #register a WSHandler, its on_message keeps its (ws, message) signature
+    def add_ws_handler(self, ws_handler):
+        return self.add_feed(ws_handler.url, ws_handler.subscribe_message,
+                             lambda message: ws_handler.on_message(None, message), ws_handler.symbol)
+
+    async def run_feed(self, feed: Feed):
+        import websockets
+        delay = self.reconnect_delay
+        while self.running:
+            try:
+                async with websockets.connect(feed.url, max_size=self.max_size) as ws:
+                    await ws.send(json.dumps(feed.subscribe_message))
+                    logger.info("Subscribed to %s at %s", feed.name, feed.url)
+                    delay = self.reconnect_delay
+                    async for message in ws:
+                        feed.messages_received += 1
+                        #a message that fails to parse or dispatch is dropped, the connection stays up
+                        try:
+                            feed.on_message(message)
+                        except Exception:
+                            feed.messages_failed += 1
+                            logger.exception("Error handling a message of feed %s", feed.name)
+                logger.info("Connection closed")
+            except asyncio.CancelledError:
+                raise
+            except (OSError, websockets.exceptions.WebSocketException) as error:
+                #transport errors only, the feed reconnects after the backoff delay
+                logger.warning("websocket packet loss: %s", error)
+            except Exception:
+                #anything else is a bug in the feed itself, stop it without taking the other feeds on this loop down
+                logger.exception("Feed %s stopped", feed.name)
+                return
+
+            if self.running:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.running = True
+        self.tasks = [asyncio.create_task(self.run_feed(feed)) for feed in self.feeds]
+        try:
+            await asyncio.gather(*self.tasks)
+        except asyncio.CancelledError:
+            pass
+
+    #blocks the calling thread until stop() is called
+    def start(self):
+        asyncio.run(self.run())
+
+    #start on one background thread instead
+    def start_in_thread(self):
+        thread = threading.Thread(target=self.start, name="feed-engine", daemon=True)
+        thread.start()
+        return thread
+
+    #thread safe
+    def stop(self):
+        self.running = False
+        if self.loop and not self.loop.is_closed():
+            for task in self.tasks:
+                self.loop.call_soon_threadsafe(task.cancel)
+
+
+async def serve_messages(messages, host = "127.0.0.1", port = 8765, interval = 0.0):
+    '''
+    Local websocket stand-in for an exchange: waits for the subscribe message of each client,
+    then replays `messages` (dicts) to it as JSON frames.
+    '''
+    import websockets
+
+    async def handler(ws, *args):
+        await ws.recv()
+        for message in messages:
+            await ws.send(json.dumps(message))
+            if interval:
+                await asyncio.sleep(interval)
+        await ws.close()
+
+    return await websockets.serve(handler, host, port)
+
+
+if __name__ == "__main__":
+    #demo against the local stand-in: many OKX feeds on one loop, parsed by real symbol handlers
+    from market_data_manager import OkxDataManager
+    from symbol_handler import OKXSymbolHandler
+    from replay import TickColumns
+
+    symbols = [f"SYM{i}-USDT" for i in range(20)]
+    columns = TickColumns.from_csv('historical_data/BTC-USDT_data.csv')
+    rows = zip(columns.last.tolist(), columns.lastSz.tolist(), columns.ts.tolist(), columns.askPx.tolist(),
+               columns.askSz.tolist(), columns.bidPx.tolist(), columns.bidSz.tolist())
+    ticks = [{"data": [{"last": str(last), "lastSz": str(size), "ts": str(ts), "askPx": str(ask), "askSz": str(ask_size), "bidPx": str(bid), "bidSz": str(bid_size)}]}
+             for last, size, ts, ask, ask_size, bid, bid_size in list(rows)[:2000]]
+
+    engine = AsyncFeedEngine()
+    manager = OkxDataManager()
+    for symbol in symbols:
+        handler = OKXSymbolHandler(symbol, "live")
+        engine.add_feed("ws://127.0.0.1:8765", manager.subscribe_message([symbol]),
+                        lambda message, handler=handler: handler.parse_message(json.loads(message), "live"), symbol)
+
+    async def demo():
+        server = await serve_messages(ticks)
+        start = time.perf_counter()
+        runner = asyncio.create_task(engine.run())
+        while sum(feed.messages_received for feed in engine.feeds) < len(ticks) * len(symbols):
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - start
+        threads = threading.active_count()
+        engine.stop()
+        await runner
+        server.close()
+        total = sum(feed.messages_received for feed in engine.feeds)
+        print(f"{total} messages on {len(engine.feeds)} feeds in {elapsed:.2f}s ({total / elapsed:.0f} msg/s), threads alive: {threads}")
+        latency.dump()
+
+    asyncio.run(demo())
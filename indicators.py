@@ -0,0 +1,407 @@
+import copy
+import glob
+import math
+import numpy as np
+
+
+class StreamingEMA():
+    '''
+    Exponential moving average updated in O(1) per value.
+    Keeps the running numerator/denominator of the adjusted EMA, so the value is identical to
+    pandas Series.ewm(span=span).mean() over the full history without storing that history.
+    '''
+    def __init__(self, span) -> None:
+        self.span = span
+        self.decay = 1 - 2 / (span + 1)
+        self.numerator = 0.0
+        self.denominator = 0.0
+        self.value = 0.0
+        self.count = 0
+
+    def update(self, value):
+        self.numerator = value + self.decay * self.numerator
+        self.denominator = 1.0 + self.decay * self.denominator
+        self.value = self.numerator / self.denominator
+        self.count += 1
+        return self.value
+
+
+class StreamingMACD():
+    '''
+    MACD line (short EMA - long EMA) and its signal line, each updated in O(1) per candle.
+    '''
+    def __init__(self, short_window = 12, long_window = 26, signal_span = 9) -> None:
+        self.ema_short = StreamingEMA(short_window)
+        self.ema_long = StreamingEMA(long_window)
+        self.ema_signal = StreamingEMA(signal_span)
+        self.macd = 0.0
+        self.signal = 0.0
+        self.count = 0
+
+    def update(self, price):
+        self.macd = self.ema_short.update(price) - self.ema_long.update(price)
+        self.signal = self.ema_signal.update(self.macd)
+        self.count += 1
+        return self.macd, self.signal
+
+
+class WindowedMACD():
+    '''
+    MACD and signal line computed over the last long_window candles only, i.e. pandas ewm over a
+    DataFrame of the window as MACDStrategy originally did. Both outputs are fixed linear combinations
+    of the window, so the weights are derived once and each update is two dot products over a ring buffer.
+    Values are only meaningful once count >= long_window.
+    '''
+    def __init__(self, short_window = 12, long_window = 26, signal_span = 9) -> None:
+        self.window = long_window
+        self.macd_weights, self.signal_weights = window_macd_weights(short_window, long_window, signal_span)
+        #every price is written twice so the last window is always one contiguous slice, oldest first
+        self.buffer = np.zeros(2 * long_window)
+        self.scratch = np.empty(long_window) # the window relative to the latest price, reused by every update
+        self.position = 0
+        self.macd = 0.0
+        self.signal = 0.0
+        self.count = 0
+
+    def update(self, price):
+        self.buffer[self.position] = price
+        self.buffer[self.position + self.window] = price
+        self.position = (self.position + 1) % self.window
+        #both weight vectors sum to zero, so measuring prices from the latest one changes nothing except
+        #that a flat window gives exactly 0 like pandas does, instead of rounding noise
+        window = np.subtract(self.buffer[self.position:self.position + self.window], price, out=self.scratch)
+        self.macd = float(np.dot(self.macd_weights, window))
+        self.signal = float(np.dot(self.signal_weights, window))
+        self.count += 1
+        return self.macd, self.signal
+
+
+class RollingHurst():
+    '''
+    Hurst exponent over the last `window` prices, estimated like MACDStrategy.get_hurst_exponent:
+    slope of log(std of lagged differences) against log(lag) for lags in [min_lag, max_lag).
+    Prices live in a circular buffer and each lag keeps a running sum / sum of squares of its differences,
+    so an update costs O(max_lag) with no array slicing. Useful for gating any strategy on trend persistence.
+    '''
+    def __init__(self, window = 100, min_lag = 2, max_lag = 20, resync_every = 1000) -> None:
+        if not 1 <= min_lag < max_lag < window:
+            raise ValueError("need 1 <= min_lag < max_lag < window")
+        self.window = window
+        self.lags = list(range(min_lag, max_lag))
+        self.prices = [0.0] * window
+        self.position = 0 # index the next price is written to
+        self.count = 0 # prices currently in the window
+        self.sums = [0.0] * len(self.lags)
+        self.sums_sq = [0.0] * len(self.lags)
+        self.resync_every = resync_every # recompute sums from the buffer now and then to drop rounding drift
+        self.updates = 0
+        self.value = float("nan")
+
+        #regression against log(lag) only depends on the lags, precompute the centered x values
+        log_lags = [math.log(lag) for lag in self.lags]
+        mean_log_lag = sum(log_lags) / len(log_lags)
+        self.centered_log_lags = [log_lag - mean_log_lag for log_lag in log_lags]
+        self.sxx = sum(x * x for x in self.centered_log_lags)
+
+    def update(self, price):
+        prices, window, position = self.prices, self.window, self.position
+
+        #window full: the oldest price leaves, along with the difference it starts for every lag
+        if self.count == window:
+            oldest = prices[position]
+            for i, lag in enumerate(self.lags):
+                diff = prices[(position + lag) % window] - oldest
+                self.sums[i] -= diff
+                self.sums_sq[i] -= diff * diff
+        else:
+            self.count += 1
+
+        #new price adds one difference per lag
+        for i, lag in enumerate(self.lags):
+            if self.count > lag:
+                diff = price - prices[(position - lag) % window]
+                self.sums[i] += diff
+                self.sums_sq[i] += diff * diff
+
+        prices[position] = price
+        self.position = (position + 1) % window
+        self.updates += 1
+        if self.updates % self.resync_every == 0:
+            self.resync()
+
+        self.value = self.estimate()
+        return self.value
+
+    def resync(self):
+        ordered = [self.prices[(self.position - self.count + k) % self.window] for k in range(self.count)]
+        for i, lag in enumerate(self.lags):
+            diffs = [ordered[k] - ordered[k - lag] for k in range(lag, self.count)]
+            self.sums[i] = sum(diffs)
+            self.sums_sq[i] = sum(diff * diff for diff in diffs)
+
+    def estimate(self):
+        #slope of log(tau) on log(lag); nan while a lag has no differences or a std is zero, like np.polyfit
+        slope = 0.0
+        for i, lag in enumerate(self.lags):
+            n = self.count - lag
+            if n <= 0:
+                return float("nan")
+            mean = self.sums[i] / n
+            variance = self.sums_sq[i] / n - mean * mean
+            if variance <= 0.0:
+                return float("nan")
+            slope += self.centered_log_lags[i] * 0.5 * math.log(variance)
+        return slope / self.sxx
+
+
+class RollingSMA():
+    '''
+    Mean of the last `window` values from a running sum, the way SimpleMovingAvgStrategy kept it.
+    Only meaningful once count >= window.
+    '''
+    def __init__(self, window = 14) -> None:
+        self.window = window
+        self.values = [0.0] * window
+        self.position = 0
+        self.sum = 0.0
+        self.count = 0
+        self.last = 0.0
+        self.value = float("nan")
+
+    def update(self, value):
+        self.sum += value
+        if self.count == self.window:
+            self.sum -= self.values[self.position]
+        else:
+            self.count += 1
+        self.values[self.position] = value
+        self.position = (self.position + 1) % self.window
+        self.last = value
+        self.value = self.sum / self.window if self.count == self.window else float("nan")
+        return self.value
+
+
+class RollingRSI():
+    '''
+    Relative strength index over the last `window` price changes, with running sums of the up and down moves
+    the way RSIStrategy kept them (a window without down moves counts them as 0.1).
+    The first value only sets the reference price; ready once count >= window.
+    '''
+    def __init__(self, window = 14) -> None:
+        self.window = window
+        self.deltas = [0.0] * window
+        self.position = 0
+        self.last_price = 0
+        self.ups = 0
+        self.downs = 0
+        self.count = 0
+        self.value = float("nan")
+
+    def update(self, price):
+        if self.last_price == 0:
+            self.last_price = price
+            return self.value
+
+        diff = price - self.last_price
+        if diff > 0:
+            self.ups += diff
+        else:
+            self.downs += abs(diff)
+        if self.count == self.window:
+            popped = self.deltas[self.position]
+            if popped > 0:
+                self.ups -= popped
+            else:
+                self.downs -= abs(popped)
+        else:
+            self.count += 1
+        self.deltas[self.position] = diff
+        self.position = (self.position + 1) % self.window
+        self.last_price = price
+
+        if self.count == self.window:
+            avg_ups = self.ups / self.window
+            avg_downs = self.downs / self.window
+            if avg_downs == 0:
+                avg_downs = 0.1
+            self.value = 100 - 100 / (1 + avg_ups / avg_downs)
+        return self.value
+
+
+class IndicatorRegistry():
+    '''
+    The indicators of one book, shared by every strategy listening to it.
+    Strategies ask for an indicator by class and constructor arguments, e.g. get(RollingSMA, 14), and get
+    the one instance for that spec. Each candle is fed to every registered indicator once: the first
+    listener to call on_candle with a candle updates them all, the other listeners find it already done.
+    '''
+    def __init__(self) -> None:
+        self.indicators = {}
+        self.last_candle = None
+
+    def get(self, indicator_class, *args):
+        key = (indicator_class, args)
+        indicator = self.indicators.get(key)
+        if indicator is None:
+            indicator = self.indicators[key] = indicator_class(*args)
+        return indicator
+
+    def on_candle(self, candle):
+        if candle is self.last_candle:
+            return
+        self.last_candle = candle
+        price = candle["price"]
+        for indicator in self.indicators.values():
+            indicator.update(price)
+
+    def __len__(self):
+        return len(self.indicators)
+
+    #copies of every indicator by spec, for checkpoints
+    def snapshot(self):
+        return copy.deepcopy(self.indicators)
+
+    def restore(self, indicators):
+        '''
+        Loads indicators from snapshot(). Strategies hold references to the registered instances, so those
+        take over the saved state in place; saved indicators nobody asked for yet are kept for later get calls.
+        '''
+        for key, saved in indicators.items():
+            indicator = self.indicators.get(key)
+            if indicator is None:
+                self.indicators[key] = saved
+            else:
+                indicator.__dict__.update(saved.__dict__)
+        self.last_candle = None
+
+
+def adjusted_ewm(values, span):
+    #same recursion as pandas ewm(span=span, adjust=True).mean()
+    decay = 1 - 2 / (span + 1)
+    numerator = denominator = 0.0
+    out = []
+    for value in values:
+        numerator = value + decay * numerator
+        denominator = 1.0 + decay * denominator
+        out.append(numerator / denominator)
+    return out
+
+
+def window_macd_weights(short_window, long_window, signal_span):
+    '''
+    Weights w such that dot(w, window) gives the last MACD / signal value of a window of long_window prices,
+    found by running the window computation on each unit vector.
+    '''
+    macd_weights = np.zeros(long_window)
+    signal_weights = np.zeros(long_window)
+    for k in range(long_window):
+        unit = [0.0] * long_window
+        unit[k] = 1.0
+        macd = [short - long for short, long in zip(adjusted_ewm(unit, short_window), adjusted_ewm(unit, long_window))]
+        macd_weights[k] = macd[-1]
+        signal_weights[k] = adjusted_ewm(macd, signal_span)[-1]
+    return macd_weights, signal_weights
+
+
+def validate_macd(file_name, short_window = 12, long_window = 26, signal_span = 9, tolerance = 1e-9):
+    '''
+    Validation mode for the MACD indicators on a recorded capture.
+    Builds the 1s candles of the file, checks WindowedMACD against the previous pandas implementation
+    (ewm over the last long_window candles) and StreamingMACD against pandas ewm over the full candle
+    history, and reports how often the two indicators agree on the buy/sell direction.
+    '''
+    import pandas as pd
+    from orderbook import PriceLevelBook
+    from replay import TickColumns, ColumnarReplay
+
+    columns = TickColumns.from_csv(file_name)
+    book = PriceLevelBook(stored_length=len(columns))
+    ColumnarReplay(columns, file_name).run(book)
+    prices = book.candles.column("mean").tolist()
+    scale = max([1.0] + [abs(price) for price in prices])
+
+    #streaming indicators
+    windowed = WindowedMACD(short_window, long_window, signal_span)
+    streaming = StreamingMACD(short_window, long_window, signal_span)
+    windowed_values, streaming_values = [], []
+    for price in prices:
+        windowed_values.append(windowed.update(price))
+        streaming_values.append(streaming.update(price))
+
+    #pandas over the full candle history
+    series = pd.Series(prices)
+    reference_macd = (series.ewm(span=short_window).mean() - series.ewm(span=long_window).mean()).tolist()
+    reference_signal = pd.Series(reference_macd).ewm(span=signal_span).mean().tolist()
+    streaming_error = 0.0
+    for (macd, signal), ref_macd, ref_signal in zip(streaming_values, reference_macd, reference_signal):
+        streaming_error = max(streaming_error, abs(macd - ref_macd), abs(signal - ref_signal))
+
+    #previous implementation, pandas ewm over a sliding window of long_window candles
+    windowed_error = 0.0
+    agree = total = 0
+    for i in range(long_window - 1, len(prices)):
+        data = pd.DataFrame(prices[i - long_window + 1:i + 1], columns=['price'])
+        window_macd = data['price'].ewm(span=short_window).mean() - data['price'].ewm(span=long_window).mean()
+        window_signal = window_macd.ewm(span=signal_span).mean()
+        macd, signal = windowed_values[i]
+        windowed_error = max(windowed_error, abs(macd - window_macd.iloc[-1]), abs(signal - window_signal.iloc[-1]))
+        total += 1
+        agree += (macd > signal) == (streaming_values[i][0] > streaming_values[i][1])
+
+    result = {"file": file_name,
+              "candles": len(prices),
+              "windowed_error": windowed_error,
+              "streaming_error": streaming_error,
+              "passed": max(windowed_error, streaming_error) <= tolerance * scale,
+              "direction_agreement": agree / total if total else 1.0}
+    print(f"{file_name}: {result['candles']} candles, windowed max error {windowed_error:.3e}, "
+          f"streaming max error {streaming_error:.3e} ({'ok' if result['passed'] else 'FAILED'}), "
+          f"windowed/streaming direction agreement {result['direction_agreement']:.2%}")
+    return result
+
+
+def validate_hurst(file_name, window = 100, min_lag = 2, max_lag = 20, tolerance = 1e-6):
+    '''
+    Validation mode for RollingHurst: compares it with np.std / np.polyfit over the same window on every candle.
+    '''
+    from orderbook import PriceLevelBook
+    from replay import TickColumns, ColumnarReplay
+
+    columns = TickColumns.from_csv(file_name)
+    book = PriceLevelBook(stored_length=len(columns))
+    ColumnarReplay(columns, file_name).run(book)
+    prices = book.candles.column("mean").tolist()
+
+    hurst = RollingHurst(window, min_lag, max_lag)
+    lags = range(min_lag, max_lag)
+    max_error = 0.0
+    mismatched_nans = 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for i, price in enumerate(prices):
+            value = hurst.update(price)
+            if i < max_lag:
+                continue
+            series = prices[max(0, i + 1 - window):i + 1]
+            tau = [np.std(np.subtract(series[lag:], series[:-lag])) for lag in lags]
+            if min(tau) == 0:
+                mismatched_nans += not math.isnan(value)
+                continue
+            reference = np.polyfit(np.log(lags), np.log(tau), 1)[0]
+            if math.isnan(value):
+                mismatched_nans += 1
+            else:
+                max_error = max(max_error, abs(value - reference))
+
+    result = {"file": file_name, "max_error": max_error, "mismatched_nans": mismatched_nans,
+              "passed": max_error <= tolerance and mismatched_nans == 0}
+    print(f"{file_name}: rolling hurst max error {max_error:.3e}, mismatched nans {mismatched_nans} ({'ok' if result['passed'] else 'FAILED'})")
+    return result
+
+
+if __name__ == "__main__":
+    #validate the streaming indicators on every bundled capture
+    file_names = sorted(glob.glob('historical_data/*.csv'))
+    results = [validate_macd(file_name) for file_name in file_names]
+    results += [validate_hurst(file_name) for file_name in file_names]
+    if not all(result["passed"] for result in results):
+        raise SystemExit(1)
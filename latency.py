@@ -0,0 +1,125 @@
+import json
+import math
+import threading
+import time
+
+# monotonic clock used for every stage stamp
+now = time.perf_counter_ns
+
+# stages of a live tick, in pipeline order
+# decode: socket receive -> json decoded, normalize: decoded message -> tick dict,
+# candle: generate_candle, depth: applying a level 2 snapshot/delta, signal: candle published -> order decided, execution: portfolio call,
+# total: socket receive -> strategy done, arbitrage: socket receive -> cross-exchange check done (every tick)
+STAGES = ["decode", "normalize", "candle", "depth", "arbitrage", "signal", "execution", "total"]
+PERCENTILES = [("p50", 0.5), ("p99", 0.99), ("p999", 0.999)]
+
+
+class LatencyHistogram():
+    '''
+    Log-bucketed histogram of durations in ns: 2**SUB_BITS buckets per power of two, so a
+    percentile is off by at most one bucket width (12.5% with SUB_BITS = 3). Fixed memory,
+    recording is a couple of integer ops.
+    '''
+    SUB_BITS = 3
+
+    def __init__(self) -> None:
+        self.counts = [0] * ((65 - self.SUB_BITS) << self.SUB_BITS)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def bucket(self, value):
+        if value < (1 << self.SUB_BITS):
+            return max(0, value)
+        shift = value.bit_length() - 1 - self.SUB_BITS
+        return ((shift + 1) << self.SUB_BITS) + (value >> shift) - (1 << self.SUB_BITS)
+
+    #largest value that falls into a bucket
+    def bucket_upper(self, index):
+        if index < (1 << self.SUB_BITS):
+            return index
+        shift = (index >> self.SUB_BITS) - 1
+        mantissa = (index & ((1 << self.SUB_BITS) - 1)) + (1 << self.SUB_BITS)
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, value):
+        index = self.bucket(value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0
+        target = max(1, math.ceil(q * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.bucket_upper(index), self.max)
+        return self.max
+
+    def summary(self):
+        #in microseconds
+        with self.lock:
+            result = {"count": self.count, "mean": self.total / self.count / 1000 if self.count else 0.0}
+            for name, q in PERCENTILES:
+                result[name] = self.percentile(q) / 1000
+            result["max"] = self.max / 1000
+        return result
+
+
+class LatencyMonitor():
+    '''
+    Per-stage latency histograms keyed by (stage, exchange, symbol, strategy); keys that do not
+    apply to a stage are "-". Stages stamp with the monotonic clock and call record with the duration.
+    '''
+    def __init__(self) -> None:
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.enabled = True
+
+    def record(self, stage, duration, exchange = "-", symbol = "-", strategy = "-"):
+        if not self.enabled:
+            return
+        key = (stage, exchange, symbol, strategy)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, LatencyHistogram())
+        histogram.record(duration)
+
+    def clear(self):
+        with self.lock:
+            self.histograms = {}
+
+    def summaries(self):
+        order = {stage: i for i, stage in enumerate(STAGES)}
+        keys = sorted(list(self.histograms), key=lambda key: (key[1], key[2], key[3], order.get(key[0], len(order)), key[0]))
+        return [dict(zip(["stage", "exchange", "symbol", "strategy"], key), **self.histograms[key].summary()) for key in keys]
+
+    def report(self):
+        rows = self.summaries()
+        if not rows:
+            return "No latency samples recorded"
+        header = f"{'exchange':<9} {'symbol':<10} {'strategy':<24} {'stage':<10} {'count':>9} {'p50 us':>10} {'p99 us':>10} {'p999 us':>10} {'max us':>10}"
+        lines = [header, "-" * len(header)]
+        for row in rows:
+            lines.append(f"{row['exchange']:<9} {row['symbol']:<10} {row['strategy']:<24} {row['stage']:<10} {row['count']:>9} "
+                         f"{row['p50']:>10.1f} {row['p99']:>10.1f} {row['p999']:>10.1f} {row['max']:>10.1f}")
+        return "\n".join(lines)
+
+    #print the table, and write it as json when a file name is given
+    def dump(self, file_name = None):
+        print(self.report(), flush=True)
+        if file_name:
+            with open(file_name, 'w') as file:
+                json.dump(self.summaries(), file, indent=2)
+
+
+# process wide monitor shared by the data handlers, books and strategies
+latency = LatencyMonitor()
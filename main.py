@@ -1,10 +1,10 @@
-from market_data_manager import BinanceDataManager, CoinbaseDataManager, OkxDataManager 
-from portfolio_manager import PortfolioManager
-from strategy import SimpleMovingAvgStrategy, RSIStrategy, MACDStrategy
 import concurrent.futures
 import argparse
-from pynput import keyboard
 import os
+import signal
+from bot_logging import setup_logging, stop_logging, LOG_LEVELS
+from latency import latency
+import atexit
 
 
 parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, 
@@ -18,18 +18,69 @@ cryptocurrencies = ['BTC', 'ETH', 'XRP', 'LTC', 'ADA']
 trading_signals = ['macd', 'rsi', 'sma']
 risk_strategies = ['cppi', 'tipp', 'ratio']
 data_actions = ['live', 'historic', 'download']
+rotations = ['hourly', 'daily']
+record_formats = ['csv', 'binary']
+feed_engines = ['asyncio', 'threads']
+book_candle_ms = 1000 # length of the candles every PriceLevelBook builds, timeframes are made of whole ones
+
+#--timeframe: a name like 5m, or a length in ms; checked here so a bad one fails before any feed connects
+def timeframe(value):
+    from candles import timeframe_length
+    if value.isdigit():
+        value = int(value)
+    try:
+        length = timeframe_length(value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    if length <= 0 or length % book_candle_ms:
+        raise argparse.ArgumentTypeError(f"timeframe {value!r} must be a whole number of {book_candle_ms} ms book candles")
+    return value
 
 parser.add_argument('-e', '--exchanges', choices=exchanges, nargs='*', help='Select exchanges (at least one)')
 parser.add_argument('-c', '--currencies', choices=cryptocurrencies, nargs='*', help='Select cryptocurrencies (at least one)')
 parser.add_argument('-s', '--trading_signals', choices=trading_signals, nargs='*', help='Select trading strategies (at least one, unless data action is download)')
 parser.add_argument('-r', '--risk_manager', choices=risk_strategies, type = str, help='Select a risk management strategy (default: cppi)', default="cppi")
 parser.add_argument('-d', '--data_action', choices=data_actions, type = str, help = 'Select data actions (default: \'live\')', default="live")
+parser.add_argument('--rotation', choices=rotations, type = str, help = 'Rotate download files hourly or daily (default: single file per symbol)', default=None)
+parser.add_argument('--record_format', choices=record_formats, type = str, help = 'File format for downloaded data (default: csv)', default="csv")
+parser.add_argument('--feed_engine', choices=feed_engines, type = str, help = 'Run websocket feeds on one asyncio event loop or one thread per symbol (default: asyncio)', default="asyncio")
+parser.add_argument('--log_level', choices=LOG_LEVELS, type = str, help = 'Log level; DEBUG also logs every received message (default: INFO)', default="INFO")
+parser.add_argument('--timeframe', type = timeframe, help = 'Run strategies on candles of this length, e.g. 1m, 5m, 1h or 90000 (ms, a multiple of 1000), aligned to the clock (default: the book\'s 1s candles)', default=None)
+parser.add_argument('--columnar_run', type = int, help = 'In historic mode, replay runs of at least N consecutive ticks of one symbol with the columnar candle builder instead of tick by tick (default: off)', default=None)
+parser.add_argument('--depth', action='store_true', help = 'Also subscribe to each exchange\'s level 2 depth channel when live trading')
+parser.add_argument('--arbitrage', action='store_true', help = 'Watch every selected book for crossed markets between exchanges and trade them through the portfolio manager')
+parser.add_argument('--arb_threshold_bps', type = float, help = 'Minimum edge after fees for an arbitrage trade, in basis points (default: 5)', default=5.0)
+parser.add_argument('--corr_window', type = int, help = 'Number of candle returns in the rolling correlation matrix of the traded symbols (default: 100)', default=100)
+parser.add_argument('--checkpoint', type = str, help = 'When live trading, save books, indicators and portfolio to this file periodically and on exit, and restore them from it on startup', default=None)
+parser.add_argument('--checkpoint_every', type = float, help = 'Seconds between checkpoints (default: 30)', default=30.0)
+parser.add_argument('--checkpoint_max_age', type = float, help = 'Oldest checkpoint (seconds) whose books and indicators are restored; the portfolio is always restored (default: 300)', default=300.0)
+parser.add_argument('--warmup_minutes', type = float, help = 'When live trading, first replay the last N minutes of each symbol\'s capture in historical_data/ through candles and indicators, without trading (default: 0, off)', default=0)
+parser.add_argument('--latency_file', type = str, help = 'Also write the per-stage latency histograms to this json file on exit (press l to print them at any time)', default=None)
+parser.add_argument('--no_latency', action='store_true', help = 'Turn off per-stage latency instrumentation')
+parser.add_argument('--headless', action='store_true', help = 'No keyboard listener (SIGINT/SIGTERM exit, SIGUSR1 prints latency histograms) and the PNL plot is saved to --plot_file instead of shown')
+parser.add_argument('--plot_file', type = str, help = 'File the PNL plot is saved to in headless mode (default: pnl_plot.png)', default="pnl_plot.png")
 parser.add_argument('-b', '--balance', type = float, help = 'Select initial balance (default: 1000000)', default=1000000)
 
 args = parser.parse_args()
 
 #function to initialize everything using parsed args
 def initialize_bot(args):
+    #the bot's modules pull in numpy and the exchange clients, so they are only loaded once the arguments check out
+    from market_data_manager import BinanceDataManager, CoinbaseDataManager, OkxDataManager
+    from portfolio_manager import PortfolioManager
+    from strategy import SimpleMovingAvgStrategy, RSIStrategy, MACDStrategy
+    from recorder import close_all_recorders
+    from feed_engine import AsyncFeedEngine
+    from replay import ReplayCoordinator, warm_up
+    from arbitrage import ArbitrageEngine
+    from correlation import RollingCorrelation
+    from checkpoint import Checkpointer, book_key
+
+    setup_logging(args.log_level)
+    latency.enabled = not args.no_latency
+    if latency.enabled:
+        atexit.register(latency.dump, args.latency_file)
+
     #dictionary for mapping currencies to exchange-specific symbol names
     exchange_to_symbol = {"Binance": {"BTC": "BTCUSDT", "ETH": "ETHUSDT", "XRP": "XRPUSDT", "LTC":"LTCUSDT", "ADA": "ADAUSDT"}, 
                   "Coinbase": {"BTC": "BTC-USD", "ETH": "ETH-USD", "XRP": "XRP-USD", "LTC": "LTC-USD", "ADA": "ADA-USD"}, 
@@ -40,9 +91,9 @@ def initialize_bot(args):
     if args.data_action != "download": portfolio_manager = PortfolioManager(initial_balance=args.balance, risk_manager=args.risk_manager, equities=all_equities)
 
     #initialize exchange specific data managers
-    binance_data_manager = BinanceDataManager()
-    coinbase_data_manager = CoinbaseDataManager()
-    okx_data_manager = OkxDataManager()
+    binance_data_manager = BinanceDataManager(rotation=args.rotation, record_format=args.record_format, depth=args.depth)
+    coinbase_data_manager = CoinbaseDataManager(rotation=args.rotation, record_format=args.record_format, depth=args.depth)
+    okx_data_manager = OkxDataManager(rotation=args.rotation, record_format=args.record_format, depth=args.depth)
     
     trading_signals = args.trading_signals if args.trading_signals else [None] * len(args.exchanges)
 
@@ -60,7 +111,7 @@ def initialize_bot(args):
                     case 'sma': 
                         strategy_instance = SimpleMovingAvgStrategy(market_data_manager=binance_data_manager, portfolio_manager=portfolio_manager) 
                 binance_data_manager.add_symbol_handler(symbol=symbol, type=args.data_action) 
-                if args.data_action != "download": binance_data_manager.get_orderbook(symbol).add_book_listener(strategy=strategy_instance)
+                if args.data_action != "download": binance_data_manager.get_orderbook(symbol).add_book_listener(strategy=strategy_instance, timeframe=args.timeframe)
             case 'Coinbase':
                 strategy_instance = None 
                 match strategy:
@@ -71,7 +122,7 @@ def initialize_bot(args):
                     case 'sma': 
                         strategy_instance = SimpleMovingAvgStrategy(market_data_manager=coinbase_data_manager, portfolio_manager=portfolio_manager) 
                 coinbase_data_manager.add_symbol_handler(symbol=symbol, type=args.data_action) 
-                if args.data_action != "download": coinbase_data_manager.get_orderbook(symbol).add_book_listener(strategy=strategy_instance) 
+                if args.data_action != "download": coinbase_data_manager.get_orderbook(symbol).add_book_listener(strategy=strategy_instance, timeframe=args.timeframe) 
             case 'OKX':
                 strategy_instance = None 
                 match strategy:
@@ -82,33 +133,114 @@ def initialize_bot(args):
                     case 'sma': 
                         strategy_instance = SimpleMovingAvgStrategy(market_data_manager=okx_data_manager, portfolio_manager=portfolio_manager) 
                 okx_data_manager.add_symbol_handler(symbol=symbol, type=args.data_action) 
-                if args.data_action != "download": okx_data_manager.get_orderbook(symbol).add_book_listener(strategy=strategy_instance)
+                if args.data_action != "download": okx_data_manager.get_orderbook(symbol).add_book_listener(strategy=strategy_instance, timeframe=args.timeframe)
     
-    #listener function for esc key press to stop script
-    def on_press(key):
-        if key == keyboard.Key.esc:
-            if args.data_action != "download": portfolio_manager.plot()
-            os._exit(0)
+    #cross-exchange arbitrage checks run on every tick of every book
+    if args.arbitrage and args.data_action != "download":
+        arbitrage_engine = ArbitrageEngine(portfolio_manager=portfolio_manager, threshold_bps=args.arb_threshold_bps)
+        for data_manager in (binance_data_manager, coinbase_data_manager, okx_data_manager):
+            data_manager.add_tick_listener(arbitrage_engine)
+
+    #rolling return correlations of every traded symbol, readable by strategies through portfolio_manager.correlation
+    if args.data_action != "download" and len(all_equities) > 1:
+        portfolio_manager.correlation = RollingCorrelation(all_equities, window=args.corr_window)
+        for data_manager in (binance_data_manager, coinbase_data_manager, okx_data_manager):
+            for symbol in data_manager.symbol_handlers:
+                data_manager.get_orderbook(symbol).add_book_listener(portfolio_manager.correlation)
+
+    #warm restart: restore the last checkpoint once every listener is in place, then keep saving
+    checkpointer = None
+    books = [data_manager.get_orderbook(symbol) for data_manager in (binance_data_manager, coinbase_data_manager, okx_data_manager) for symbol in data_manager.symbol_handlers]
+    if args.checkpoint and args.data_action == "live":
+        checkpointer = Checkpointer(args.checkpoint, portfolio_manager, books, interval=args.checkpoint_every, max_age=args.checkpoint_max_age)
+        checkpointer.restore()
+
+    #books without a fresh checkpoint get primed from the tail of their recorded data before the feeds start
+    if args.warmup_minutes > 0 and args.data_action == "live":
+        restored = checkpointer.restored_books if checkpointer else set()
+        warm_up([book for book in books if book_key(book) not in restored], int(args.warmup_minutes * 60000))
+
+    if checkpointer:
+        checkpointer.attach()
+        atexit.register(checkpointer.save, True)
+
+    plot_file = args.plot_file if args.headless else None
+
+    #esc, or SIGINT/SIGTERM when headless
+    def shutdown():
+        if checkpointer: checkpointer.save(wait=True)
+        if args.data_action != "download": portfolio_manager.plot(plot_file)
+        #os._exit skips atexit, flush recorded ticks and queued log lines first
+        close_all_recorders()
+        stop_logging()
+        if latency.enabled: latency.dump(args.latency_file)
+        os._exit(0)
+
+    def on_signal(signum, frame):
+        if signum == getattr(signal, "SIGUSR1", None):
+            latency.dump()
         else:
-            print("A key has been pressed. Press esc if you are trying to exit.")
+            shutdown()
+
+    #keyboard listener, or signal handlers when headless (pynput needs a display, so it is only imported here)
+    def start_controls():
+        if args.headless:
+            for signum in (signal.SIGINT, signal.SIGTERM, getattr(signal, "SIGUSR1", None)):
+                if signum is not None:
+                    signal.signal(signum, on_signal)
+            return
+        from pynput import keyboard
+
+        #listener function for esc key press to stop script
+        def on_press(key):
+            if key == keyboard.Key.esc:
+                shutdown()
+            elif getattr(key, "char", None) == "l":
+                latency.dump()
+            else:
+                print("A key has been pressed. Press esc if you are trying to exit, or l to print latency histograms.")
+        keyboard.Listener(on_press=on_press).start()
 
-    #use threading to start data manager for each exchange
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(args.exchanges)+1) as executor:
+    if args.data_action == "historic":
+        #every capture is merged into one time-ordered replay on this thread, so backtests are reproducible
+        coordinator = ReplayCoordinator(columnar_run=args.columnar_run)
+        if 'Binance' in args.exchanges: 
+            binance_data_manager.register_replays(coordinator)
+        if 'Coinbase' in args.exchanges: 
+            coinbase_data_manager.register_replays(coordinator)
+        if 'OKX' in args.exchanges: 
+            okx_data_manager.register_replays(coordinator)
+        start_controls()
+        coordinator.run()
+    elif args.feed_engine == "asyncio":
+        #every websocket subscription of every exchange runs on one event loop in this thread
+        engine = AsyncFeedEngine()
         if 'Binance' in args.exchanges: 
-            executor.submit(binance_data_manager.start)
+            binance_data_manager.register_feeds(engine)
         if 'Coinbase' in args.exchanges: 
-            executor.submit(coinbase_data_manager.start)
+            coinbase_data_manager.register_feeds(engine)
         if 'OKX' in args.exchanges: 
-            executor.submit(okx_data_manager.start)
-        listener = keyboard.Listener(on_press=on_press)
-        executor.submit(listener.start)
+            okx_data_manager.register_feeds(engine)
+        start_controls()
+        engine.start()
+    else:
+        #use threading to start data manager for each exchange
+        #signal handlers can only be installed from this thread
+        start_controls()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(args.exchanges)) as executor:
+            if 'Binance' in args.exchanges: 
+                executor.submit(binance_data_manager.start)
+            if 'Coinbase' in args.exchanges: 
+                executor.submit(coinbase_data_manager.start)
+            if 'OKX' in args.exchanges: 
+                executor.submit(okx_data_manager.start)
 
-    portfolio_manager.plot()
+    if args.data_action != "download": portfolio_manager.plot(plot_file)
     
     
 #check paramters and print configuration
 if (args.data_action != "download" and args.exchanges and args.currencies and args.trading_signals and len(args.exchanges) == len(args.currencies) == len(args.trading_signals)) or (args.data_action == "download" and args.exchanges and args.currencies and len(args.exchanges) == len(args.currencies)):
-    print("(Press esc to exit at any time)")
+    print("(Send SIGINT or SIGTERM to exit at any time)" if args.headless else "(Press esc to exit at any time)")
     print()
     if args.data_action == "download" and args.trading_signals:
         print("Warning, trading signals will not be used because data action is download")
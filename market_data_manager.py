@@ -1,58 +1,159 @@
 from symbol_handler import ISymbolHandler, BinanceSymbolHandler, CoinbaseSymbolHandler, OKXSymbolHandler
+from data_handler import MultiplexWSHandler
+import time
+from bot_logging import get_logger
 import concurrent.futures
-from pynput import keyboard
 import os
 
+logger = get_logger("market_data")
+
 class MarketDataManager:
     '''
     Responsible for managing all data on an exchange.
     Params:
     Symbols: list of strings like 'BTC-USDT' (symbols to be traded)
     Types: list of strings either 'live' or 'hist' (live trading or backtesting)
+    Rotation: None, 'hourly' or 'daily' (file rotation in download mode)
+    Record_format: 'csv' or 'binary' (file format in download mode)
+    Depth: also subscribe live symbols to the exchange's level 2 channel, feeding PriceLevelBook.depth
+    Live and download symbols of an exchange share one websocket connection; messages are routed to
+    symbol handlers by their instrument field.
     '''
-    def __init__(self, symbols: list[str] = [], types: list[str] = []):
+    url = None
+
+    def __init__(self, symbols: list[str] = [], types: list[str] = [], rotation: str = None, record_format: str = "csv", depth: bool = False):
         self.symbol_handlers = {}
+        self.depth = depth
+        self.routes = {} # symbol -> (symbol handler, data action) for symbols streamed over the shared connection
+        self.connection = None
+        self.rotation = rotation
+        self.record_format = record_format
         for symbol,type in zip(symbols, types):
             self.add_symbol_handler(symbol, type)
 
 
     def add_symbol_handler(self, symbol, type):
-        new_symbol_handler = self.create_symbol_handler(symbol, type)
+        new_symbol_handler = self.create_symbol_handler(symbol, type, self.rotation, self.record_format)
         if not isinstance(new_symbol_handler, ISymbolHandler):
             raise ValueError
         else:
             self.symbol_handlers[symbol] = new_symbol_handler
+            if type in ("live", "download"):
+                self.routes[symbol] = (new_symbol_handler, type)
+                self.connection = None
+
+    #one connection subscribed to every live/download symbol, rebuilt when symbols are added
+    def get_connection(self):
+        if not self.routes:
+            return None
+        if self.connection is None:
+            symbols = list(self.routes)
+            depth_symbols = [symbol for symbol, (symbol_handler, type) in self.routes.items() if type == "live"] if self.depth else []
+            self.connection = MultiplexWSHandler(url=self.url,
+                                                 subscribe_message=self.subscribe_message(symbols, depth_symbols),
+                                                 route=self.route_message,
+                                                 name=", ".join(symbols))
+        return self.connection
+
+    def route_message(self, message):
+        return self.routes.get(self.message_symbol(message))
     
-    #start all symbol handlers simultaneously using thread executor for specific exchange
+    #start historic symbol handlers and the shared connection simultaneously using thread executor for specific exchange
     def start(self):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.symbol_handlers)+1) as executor:
-            for symbol_handler in self.symbol_handlers.values():
+        historic_handlers = [symbol_handler for symbol, symbol_handler in self.symbol_handlers.items() if symbol not in self.routes]
+        connection = self.get_connection()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(historic_handlers)+2) as executor:
+            for symbol_handler in historic_handlers:
                 executor.submit(symbol_handler.start) 
+            if connection:
+                executor.submit(connection.start)
     
+    #add the historic captures of this exchange to a ReplayCoordinator instead of replaying them on threads
+    def register_replays(self, coordinator):
+        for symbol, symbol_handler in self.symbol_handlers.items():
+            if symbol not in self.routes:
+                symbol_handler.data_handler.add_to_coordinator(coordinator)
+
+    #add the shared connection of this exchange to an AsyncFeedEngine instead of starting threads
+    def register_feeds(self, engine):
+        connection = self.get_connection()
+        if connection:
+            engine.add_ws_handler(connection)
+
+    #per tick listener (e.g. ArbitrageEngine) on the books of every symbol of this exchange
+    def add_tick_listener(self, listener):
+        for symbol_handler in self.symbol_handlers.values():
+            symbol_handler.get_orderbook().add_tick_listener(listener)
+
     def get_orderbook(self, symbol):
         return self.symbol_handlers[symbol].get_orderbook()
     
-    def create_symbol_handler(self):
+    def create_symbol_handler(self, symbol, type, rotation, record_format):
+        raise NotImplementedError
+
+    #subscribe message for many symbols on one connection, depth_symbols also get the level 2 channel
+    def subscribe_message(self, symbols, depth_symbols = []):
+        raise NotImplementedError
+
+    #symbol a decoded message belongs to, None for control messages
+    def message_symbol(self, message):
         raise NotImplementedError
 
 class BinanceDataManager(MarketDataManager):
+    url = "wss://stream.binance.us:9443/ws"
+
     def start(self):
-        print("Initializing Binance Data Manager...")
+        logger.info("Initializing Binance Data Manager...")
         return super().start() 
 
-    def create_symbol_handler(self, symbol, type):
-        return BinanceSymbolHandler(symbol, type)
+    def create_symbol_handler(self, symbol, type, rotation=None, record_format="csv"):
+        return BinanceSymbolHandler(symbol, type, rotation, record_format)
+
+    def subscribe_message(self, symbols, depth_symbols = []):
+        return {"method": "SUBSCRIBE",
+                "params": [f"{symbol.lower()}@ticker" for symbol in symbols] + [f"{symbol.lower()}@depth@100ms" for symbol in depth_symbols],
+                "id": int(time.time())}
+
+    def message_symbol(self, message):
+        return message.get("s")
 
 class CoinbaseDataManager(MarketDataManager):
+    url = "wss://ws-feed.exchange.coinbase.com/ws"
+
     def start(self):
-        print("Initializing Coinbase Data Manager...")
+        logger.info("Initializing Coinbase Data Manager...")
         return super().start()
-    def create_symbol_handler(self, symbol, type):
-        return CoinbaseSymbolHandler(symbol, type)
+    def create_symbol_handler(self, symbol, type, rotation=None, record_format="csv"):
+        return CoinbaseSymbolHandler(symbol, type, rotation, record_format)
+
+    def subscribe_message(self, symbols, depth_symbols = []):
+        if not depth_symbols:
+            return {"type": "subscribe",
+                    "product_ids": symbols,
+                    "channels": ["ticker"]}
+        return {"type": "subscribe",
+                "channels": [{"name": "ticker", "product_ids": symbols},
+                             {"name": "level2_batch", "product_ids": depth_symbols}]}
+
+    def message_symbol(self, message):
+        if message.get("type") in ("ticker", "snapshot", "l2update"):
+            return message.get("product_id")
+        return None
 
 class OkxDataManager(MarketDataManager):
+    url = "wss://ws.okx.com:8443/ws/v5/public"
+
     def start(self):
-        print("Initializing OKX Data Manager")
+        logger.info("Initializing OKX Data Manager")
         return super().start()
-    def create_symbol_handler(self, symbol, type):
-        return OKXSymbolHandler(symbol, type)
+    def create_symbol_handler(self, symbol, type, rotation=None, record_format="csv"):
+        return OKXSymbolHandler(symbol, type, rotation, record_format)
+
+    def subscribe_message(self, symbols, depth_symbols = []):
+        return {"op": "subscribe",
+                "args": [{"channel": "tickers", "instId": symbol} for symbol in symbols] + [{"channel": "books", "instId": symbol} for symbol in depth_symbols]}
+
+    def message_symbol(self, message):
+        if "data" in message:
+            return message.get("arg", {}).get("instId")
+        return None
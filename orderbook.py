@@ -1,4 +1,11 @@
 from strategy import IStrategy
+from candles import CandleStore, CandleAggregator
+from indicators import IndicatorRegistry
+from tick_format import EXCHANGE_IDS, intern_symbol
+from latency import latency, now
+from bisect import bisect_left, insort
+import threading
+import numpy as np
 
 class IOrderbook():
     '''
@@ -21,57 +28,315 @@ class IOrderbook():
 
 
 
-class PriceLevelBook(IOrderbook):
+class BookSide():
+    '''
+    One side of a level 2 book: sizes by price in a dict plus the prices kept sorted in a list.
+    Keys are stored so the best level is always the last item (bids as price, asks as -price),
+    which keeps best() O(1) and puts the list inserts/deletes of the busy levels near the end.
+    Finding a level is a binary search, O(log n).
+    '''
+    def __init__(self, is_bid: bool) -> None:
+        self.sign = 1.0 if is_bid else -1.0
+        self.keys = []
+        self.sizes = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def clear(self):
+        self.keys = []
+        self.sizes = {}
+
+    #size 0 removes the level
+    def set(self, price, size):
+        key = self.sign * price
+        if size == 0:
+            if self.sizes.pop(key, None) is not None:
+                del self.keys[bisect_left(self.keys, key)]
+        else:
+            if key not in self.sizes:
+                insort(self.keys, key)
+            self.sizes[key] = size
+
+    def best(self):
+        if not self.keys:
+            return None
+        key = self.keys[-1]
+        return (self.sign * key, self.sizes[key])
+
+    #best n levels, best first
+    def top(self, n):
+        sign, sizes = self.sign, self.sizes
+        return [(sign * key, sizes[key]) for key in reversed(self.keys[-n:])]
+
+    #total size of the best n levels
+    def cumulative_size(self, n):
+        sizes = self.sizes
+        return sum(sizes[key] for key in self.keys[-n:])
+
+    #total size at prices at least as good as price
+    def size_through(self, price):
+        sizes = self.sizes
+        return sum(sizes[key] for key in self.keys[bisect_left(self.keys, self.sign * price):])
+
+
+class DepthBook():
+    '''
+    Level 2 book of one symbol, snapshots and deltas are applied in place.
+    Levels are (price, size) pairs of floats, a size of 0 in an update deletes the level.
+    '''
     def __init__(self) -> None:
+        self.bids = BookSide(is_bid=True)
+        self.asks = BookSide(is_bid=False)
+        self.ts = None
+        self.updates = 0
+
+    def apply_snapshot(self, bids, asks, ts = None):
+        self.bids.clear()
+        self.asks.clear()
+        self.apply_update(bids, asks, ts)
+
+    def apply_update(self, bids, asks, ts = None):
+        for price, size in bids:
+            self.bids.set(price, size)
+        for price, size in asks:
+            self.asks.set(price, size)
+        self.ts = ts
+        self.updates += 1
+
+    def best_bid(self):
+        return self.bids.best()
+
+    def best_ask(self):
+        return self.asks.best()
+
+    def spread(self):
+        bid, ask = self.bids.best(), self.asks.best()
+        return ask[0] - bid[0] if bid and ask else None
+
+    def mid(self):
+        bid, ask = self.bids.best(), self.asks.best()
+        return (ask[0] + bid[0]) / 2 if bid and ask else None
+
+    def depth(self, n = 10):
+        return {"bids": self.bids.top(n), "asks": self.asks.top(n)}
+
+
+class WarmUpListener():
+    '''
+    Stands in for a candle listener while its book warms up, handing candles to the listener's warm_up instead of on_trade_add.
+    '''
+    def __init__(self, listener) -> None:
+        self.listener = listener
+
+    def on_trade_add(self, new_candle, message):
+        self.listener.warm_up(new_candle, message)
+
+
+class PriceLevelBook(IOrderbook):
+    # candle in progress, saved by snapshot() next to the finished candles and indicators
+    CHECKPOINT_FIELDS = ("candle_start", "open", "high", "low", "close", "price_sum", "tick_count", "volume", "notional", "last_candle")
+
+    def __init__(self, candle_length_ms = 1000, stored_length = 10000, symbol = "-", exchange = "-") -> None:
         super().__init__()
+        self.symbol = intern_symbol(symbol)
+        self.exchange = exchange
+        self.exchange_id = EXCHANGE_IDS.get(exchange, 0)
+        self.depth = DepthBook() # level 2 book, fed by on_order_add when the depth channel is subscribed
+        self.depth_listeners = []
+        self.tick_listeners = [] # called with (book, message) on every tick, before candle generation
         self.book_listeners = []
-        self.generated_candles = [] # list of {closing prices, time}
-        self.candle_length_ms = 1000 # length of candles (ms)
-        self.stored_length = 10000 # how many candles get stored in memory
+        self.indicators = IndicatorRegistry() # indicators shared by the strategies listening to this book
+        self.candle_length_ms = candle_length_ms # length of candles (ms)
+        self.stored_length = stored_length # how many candles get stored in memory
+        self.candles = CandleStore(stored_length) # finished candles, fixed memory per book
+        self.aggregator = None # CandleAggregator for listeners of other timeframes, created by the first one
+        self.live_listeners = None # listeners put aside while warming up
+        self.last_candle = None # latest finished candle as passed to listeners
         self.candle_start = 0
-        self.prices = [0.0]
+        self.lock = threading.RLock() # held while a tick mutates the book, so a snapshot from another book's thread sees no half-applied tick
 
+        #running accumulators of the candle in progress
+        #the very first candle averages a single 0.0 placeholder price, as the original price list did
+        self.open = self.high = self.low = self.close = 0.0
+        self.price_sum = 0.0
+        self.tick_count = 1
+        self.volume = 0.0
+        self.notional = 0.0
+
+    #message: {"action": "snapshot" or "update", "bids": [(price, size)], "asks": [(price, size)], "ts", "symbol"}
     def on_order_add(self, message):
-        pass 
+        start = now()
+        if message["action"] == "snapshot":
+            self.depth.apply_snapshot(message["bids"], message["asks"], message["ts"])
+        else:
+            self.depth.apply_update(message["bids"], message["asks"], message["ts"])
+        latency.record("depth", now() - start, self.exchange, self.symbol)
+        for depth_listener in self.depth_listeners:
+            depth_listener.on_depth_update(self.depth, message)
 
     #generate candles for strategies based on average price in last period
     def generate_candle(self, message):
-        if message["ts"] > self.candle_start+self.candle_length_ms:
-            self.generated_candles.append({"price": sum(self.prices)/len(self.prices)})
-            if len(self.generated_candles) > self.stored_length:
-                self.generated_candles.pop(0)
-            self.candle_start = message["ts"]//self.candle_length_ms * self.candle_length_ms
-            self.prices = [message["last"]]
+        last = message.last
+        if message.ts > self.candle_start+self.candle_length_ms:
+            self.close_candle()
+            self.candle_start = message.ts//self.candle_length_ms * self.candle_length_ms
+            self.load_candle(last, last, last, last, last, 1, message.lastSz, last * message.lastSz)
             return True
         else:
-            self.prices.append(message["last"])
+            self.close = last
+            if last > self.high:
+                self.high = last
+            elif last < self.low:
+                self.low = last
+            self.price_sum += last
+            self.tick_count += 1
+            self.volume += message.lastSz
+            self.notional += last * message.lastSz
             return False
-        
+
+    #set the accumulators of the candle in progress
+    def load_candle(self, open, high, low, close, price_sum, tick_count, volume, notional):
+        self.open, self.high, self.low, self.close = open, high, low, close
+        self.price_sum = price_sum
+        self.tick_count = tick_count
+        self.volume = volume
+        self.notional = notional
+
+    #fold an array of ticks into the candle in progress, summed tick by tick in the same order as generate_candle
+    def accumulate_ticks(self, prices, sizes):
+        if len(prices) == 0:
+            return
+        self.close = float(prices[-1])
+        self.high = max(self.high, float(prices.max()))
+        self.low = min(self.low, float(prices.min()))
+        price_sum, volume, notional = self.price_sum, self.volume, self.notional
+        for price, size in zip(prices.tolist(), sizes.tolist()):
+            price_sum += price
+            volume += size
+            notional += price * size
+        self.price_sum, self.volume, self.notional = price_sum, volume, notional
+        self.tick_count += len(prices)
+
+    #store the candle in progress and return it in the form listeners receive
+    def close_candle(self):
+        mean = self.price_sum/self.tick_count
+        vwap = self.notional/self.volume if self.volume else mean
+        self.candles.append(self.candle_start, self.open, self.high, self.low, self.close, mean, self.volume, vwap, self.tick_count)
+        self.last_candle = {"price": mean}
+        return self.last_candle
+
+    #run strategies that use this specific orderbook on a finished candle
+    def publish_candle(self, candle, message):
+        for book_listener in self.book_listeners:
+            #start of the signal stage of this listener
+            message.publishNs = now()
+            book_listener.on_trade_add(candle, message)
 
     def on_trade(self, message):
-        #if new candle generated, run strategies that use this specific orderbook
-        if self.generate_candle(message):
-            for book_listener in self.book_listeners:
-                book_listener.on_trade_add(self.generated_candles[-1], message)
+        with self.lock:
+            for tick_listener in self.tick_listeners:
+                tick_listener.on_tick(self, message)
+            start = now()
+            new_candle = self.generate_candle(message)
+            latency.record("candle", now() - start, self.exchange, self.symbol)
+            #if new candle generated, run strategies that use this specific orderbook
+            if new_candle:
+                self.publish_candle(self.last_candle, message)
+
+    #candle state and indicators of the book and its timeframes, copied so it can be written out on another thread
+    def snapshot(self):
+        state = {field: getattr(self, field) for field in self.CHECKPOINT_FIELDS}
+        state["candles"] = self.candles.last().copy()
+        state["indicators"] = self.indicators.snapshot()
+        state["timeframes"] = {timeframe.name: timeframe.snapshot() for timeframe in self.aggregator.timeframes} if self.aggregator else {}
+        return state
+
+    #call after the listeners are added, so their indicators pick up the saved state; unknown timeframes are skipped
+    def restore(self, state):
+        for field in self.CHECKPOINT_FIELDS:
+            setattr(self, field, state[field])
+        self.candles.load(state["candles"])
+        self.indicators.restore(state["indicators"])
+        if self.aggregator:
+            for timeframe in self.aggregator.timeframes:
+                if timeframe.name in state["timeframes"]:
+                    timeframe.restore(state["timeframes"][timeframe.name])
+            #nothing was recorded while the bot was down, no flat candles for the time in between
+            self.aggregator.skip_next_gap()
 
-    def add_book_listener(self, strategy):
+    def begin_warm_up(self):
+        '''
+        Until end_warm_up, ticks only build candles: every candle listener (of the book and of its timeframes)
+        gets them through warm_up, which primes indicators without trading, and tick listeners other than the
+        candle aggregator are left out. Listeners added in between are dropped by end_warm_up.
+        '''
+        timeframes = self.aggregator.timeframes if self.aggregator else []
+        self.live_listeners = (self.book_listeners, self.tick_listeners, [timeframe.listeners for timeframe in timeframes])
+        self.book_listeners = [WarmUpListener(listener) for listener in self.book_listeners]
+        self.tick_listeners = [listener for listener in self.tick_listeners if listener is self.aggregator]
+        for timeframe in timeframes:
+            timeframe.listeners = [WarmUpListener(listener) for listener in timeframe.listeners]
+
+    def end_warm_up(self):
+        book_listeners, tick_listeners, timeframe_listeners = self.live_listeners
+        self.book_listeners, self.tick_listeners = book_listeners, tick_listeners
+        if self.aggregator:
+            for timeframe, listeners in zip(self.aggregator.timeframes, timeframe_listeners):
+                timeframe.listeners = listeners
+            #the recorded ticks and the live ones don't join up, no flat candles for the time in between
+            self.aggregator.skip_next_gap()
+        self.live_listeners = None
+
+    #timeframe None: the book's own candles; otherwise e.g. "1m", built by the book's CandleAggregator
+    def add_book_listener(self, strategy, timeframe = None):
         if not isinstance(strategy, IStrategy):
             raise ValueError
         
-        self.book_listeners.append(strategy) 
+        if timeframe is None:
+            strategy.bind(self)
+            self.book_listeners.append(strategy) 
+        else:
+            candle_timeframe = self.get_aggregator().add_timeframe(timeframe)
+            strategy.bind(candle_timeframe)
+            candle_timeframe.listeners.append(strategy)
 
-    def remove_book_listener(self, strategy):
+    def remove_book_listener(self, strategy, timeframe = None):
         if not isinstance(strategy, IStrategy):
             raise ValueError
         
-        self.book_listeners.remove(strategy)  
+        if timeframe is None:
+            self.book_listeners.remove(strategy)  
+        else:
+            self.aggregator.remove_listener(strategy, timeframe)
+
+    #the aggregator is a tick listener, so it only costs anything once a timeframe listener exists
+    def get_aggregator(self):
+        if self.aggregator is None:
+            self.aggregator = CandleAggregator(timeframes=(), stored_length=self.stored_length)
+            self.add_tick_listener(self.aggregator)
+        return self.aggregator
+
+    #listeners get on_tick(book, message) for every tick, replays then go tick by tick for this book
+    def add_tick_listener(self, listener):
+        self.tick_listeners.append(listener)
+
+    def remove_tick_listener(self, listener):
+        self.tick_listeners.remove(listener)
+
+    #listeners get on_depth_update(depth_book, message) after every depth snapshot or delta
+    def add_depth_listener(self, listener):
+        self.depth_listeners.append(listener)
+
+    def remove_depth_listener(self, listener):
+        self.depth_listeners.remove(listener)
 
 
 
-# function for managing full price level book, not used in current strategies
+# function for managing full price level book, superseded by DepthBook which updates levels in place
 def merge_incremental_data(full_load, incremental_load):
     '''
-    Merges an incremental book into a full book using two pointers
+    Merges an incremental book into a full book using two pointers, building new lists for both sides
     '''
     full_bids, new_bids = full_load["bids"], incremental_load["bids"]
     full_asks, new_asks = full_load["asks"], incremental_load["asks"]
@@ -110,7 +375,7 @@ def merge_incremental_data(full_load, incremental_load):
             j += 1 
         else:
             if new_asks[j][1] != 0:
-                bids_final.append(new_asks[j])
+                asks_final.append(new_asks[j])
             i += 1
             j += 1
     
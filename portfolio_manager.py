@@ -1,23 +1,37 @@
 import threading
-from pynput import keyboard
-import matplotlib.pyplot as plt
 from datetime import datetime 
 import json 
+import numpy as np
+from timeseries import TimeSeriesStore
+from bot_logging import get_logger
+
+logger = get_logger("portfolio")
 
 class PortfolioManager():
     '''
     Manages risk among all strategies, tracks positions and PNL over all strategies and exchanges
     '''
 
-    def __init__(self, initial_balance, risk_manager, equities) -> None:
+    def __init__(self, initial_balance, risk_manager, equities, resync_every = 10000, history_options = None) -> None:
         self.net_positions = {equity: 0 for equity in equities}
         self.prices = {equity: 0 for equity in equities}
+        self.position_values = {equity: 0 for equity in equities} # net_positions * prices, updated by deltas
+        self.net_position_value = 0.0 # running sum of position_values
         self.initial_balance = initial_balance
         self.balance = initial_balance 
         self.risk_manager = risk_manager
-        self.pnls_over_time = []
-        self.net_position_values_over_time = {equity: [] for equity in equities}
-        self.portfolio_lock = threading.Lock()
+        #bounded pnl / position value history, see TimeSeriesStore for the retention options
+        history_options = history_options or {}
+        self.pnls_over_time = TimeSeriesStore(**history_options)
+        self.net_position_values_over_time = {equity: TimeSeriesStore(**history_options) for equity in equities} # appended when the value changed
+        self.changed_equities = set(equities) # values changed since the last get_pnl
+        self.last_pnl_time = 0.0 # ts of the latest pnl point
+        self.symbol_locks = {equity: threading.RLock() for equity in equities} # serializes trades on one symbol
+        self.portfolio_lock = threading.Lock() # guards balance and running totals, only held for O(1) updates
+        self.resync_every = resync_every # rebuild net_position_value from scratch now and then to drop rounding drift
+        self.marks = 0
+        self.trade_count = 0 # buys and sells that moved a position
+        self.correlation = None # RollingCorrelation over the traded symbols, set by main when there are several
         self.start_time = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
 
     #Constant Proportion Portfolio Insurance (CPPI)
@@ -38,9 +52,9 @@ class PortfolioManager():
     def ratio_risk_manager(self, ratio = 0.3):
         return self.balance*ratio
 
-    #calculate how many shares to purchase based on risk manager type
-    def purchase_size(self, price, size, symbol):
-        balance_limit = self.balance/price
+    #calculate how many shares to purchase based on risk manager type, cost is the price plus fees per share
+    def purchase_size(self, price, size, symbol, cost = None):
+        balance_limit = self.balance/(cost or price)
         if self.risk_manager == "cppi":
             risk_limit = self.cppi_risk_manager()/price
         elif self.risk_manager == "tipp":
@@ -53,26 +67,44 @@ class PortfolioManager():
 
         return max(0, min(size, min(balance_limit, risk_limit)))
 
-    def buy(self, price, size, symbol):
-        #aquire lock to prevent two executed trades changing balance at same time
-        self.portfolio_lock.acquire()
-
-        #update price for pnl calculation
-        self.prices[symbol] = price
-        
-
-        print("Starting buy")
-        # use risk management function to calculate purchas size
-        shares_to_buy = self.purchase_size(price, size, symbol)
-
-        #update positions and balance
-        self.balance -= shares_to_buy * price
-        self.net_positions[symbol] += shares_to_buy
-        print("Bought " + str(shares_to_buy) + " shares of " + symbol + " at " + str(price))
-        print("Finished buy")
-
-        #release lock when done
-        self.portfolio_lock.release()
+    #apply a changed price or position of one symbol to the running totals, portfolio_lock must be held
+    def mark_to_market(self, symbol):
+        value = self.net_positions[symbol] * self.prices[symbol]
+        self.net_position_value += value - self.position_values[symbol]
+        self.position_values[symbol] = value
+        self.changed_equities.add(symbol)
+        self.marks += 1
+        if self.marks % self.resync_every == 0:
+            self.net_position_value = sum(self.position_values.values())
+
+    #update price for pnl calculation
+    def update_price(self, symbol, price):
+        with self.portfolio_lock:
+            self.prices[symbol] = price
+            self.mark_to_market(symbol)
+
+    #fee: taker fee as a fraction of notional, paid out of the balance
+    def buy(self, price, size, symbol, fee = 0.0):
+        #trades on one symbol are serialized, different symbols only meet briefly on portfolio_lock
+        with self.symbol_locks[symbol]:
+            self.update_price(symbol, price)
+
+            logger.debug("Starting buy")
+            # use risk management function to calculate purchas size
+            cost = price * (1 + fee)
+            shares_to_buy = self.purchase_size(price, size, symbol, cost)
+
+            #update positions and balance; never spend more than what is left after other symbols' trades
+            with self.portfolio_lock:
+                shares_to_buy = max(0, min(shares_to_buy, self.balance/cost))
+                self.balance -= shares_to_buy * cost
+                self.net_positions[symbol] += shares_to_buy
+                self.mark_to_market(symbol)
+                if shares_to_buy > 0:
+                    self.trade_count += 1
+            logger.info("Bought %s shares of %s at %s", shares_to_buy, symbol, price)
+            logger.debug("Finished buy")
+            return shares_to_buy
 
         
     #calculate how many shares to sell based on risk manager type
@@ -89,93 +121,135 @@ class PortfolioManager():
 
         return max(0, min(size, risk_limit))
     
-    def sell(self, price, size, symbol, fixed=None):
-        #aquire lock to prevent two executed trades changing balance at same time
-        self.portfolio_lock.acquire()
-
-        #update price for pnl calculation
-        self.prices[symbol] = price
-
-        print("Starting sell")
-        #use risk management function to get sell size
-        if not fixed:
-            shares_to_sell = self.sell_size(price, size, symbol)
-        else:
-            shares_to_sell = fixed
-
-        #update positions and balance
-        self.balance += shares_to_sell * price
-        self.net_positions[symbol] -= shares_to_sell
-        print("Sold " + str(shares_to_sell) + " shares of " + symbol + " at " + str(price))
-        print("Finished sell")
-
-        #release lock when done
-        self.portfolio_lock.release()
-
-        
+    #fee: taker fee as a fraction of notional, taken from the proceeds
+    def sell(self, price, size, symbol, fixed=None, fee = 0.0):
+        #trades on one symbol are serialized, different symbols only meet briefly on portfolio_lock
+        with self.symbol_locks[symbol]:
+            self.update_price(symbol, price)
+
+            logger.debug("Starting sell")
+            #use risk management function to get sell size
+            if not fixed:
+                shares_to_sell = self.sell_size(price, size, symbol)
+            else:
+                shares_to_sell = fixed
+
+            #update positions and balance
+            with self.portfolio_lock:
+                self.balance += shares_to_sell * (price * (1 - fee))
+                self.net_positions[symbol] -= shares_to_sell
+                self.mark_to_market(symbol)
+                if shares_to_sell > 0:
+                    self.trade_count += 1
+            logger.info("Sold %s shares of %s at %s", shares_to_sell, symbol, price)
+            logger.debug("Finished sell")
+            return shares_to_sell
 
     def rebalance(self, price, size, symbol):
-        #aquire lock to prevent two executed trades changing balance at same time
-        self.portfolio_lock.acquire()
-
-        #update price for pnl calculation
-        self.prices[symbol] = price
-
-        print("Starting portfolio rebalance")
-        #get risk limit from risk manager
-        risk_limit = None
-        if self.risk_manager == "cppi":
-            risk_limit = self.cppi_risk_manager()/price
-        elif self.risk_manager == "tipp":
-            risk_limit = self.tipp_risk_manager()/price
-        elif self.risk_manager == "ratio":
-            risk_limit = self.ratio_risk_manager()/price
-
-        #rebalance equities accordingly
-        if risk_limit:
-            if self.net_positions[symbol] > risk_limit:
-                print("Finished rebalance: selling shares now")
-                self.portfolio_lock.release()
-
-                self.sell(price, 0, symbol, min(self.net_positions[symbol]-risk_limit, size))
-                return
-        print("Finished rebalance: no shares sold")
-
-        #release lock when done
-        self.portfolio_lock.release()
-
-
-    #calculate pnl and append to pnl over time list
-    def get_pnl(self):
-        asset_value = 0
-        for key in self.net_positions:
-            cur_equity_value = self.net_positions[key] * self.prices[key]
-            self.net_position_values_over_time[key].append(cur_equity_value)
-            asset_value += cur_equity_value
-
-        pnl = (self.balance + asset_value) - self.initial_balance
-        self.pnls_over_time.append(pnl)
+        with self.symbol_locks[symbol]:
+            self.update_price(symbol, price)
+
+            logger.debug("Starting portfolio rebalance")
+            #get risk limit from risk manager
+            risk_limit = None
+            if self.risk_manager == "cppi":
+                risk_limit = self.cppi_risk_manager()/price
+            elif self.risk_manager == "tipp":
+                risk_limit = self.tipp_risk_manager()/price
+            elif self.risk_manager == "ratio":
+                risk_limit = self.ratio_risk_manager()/price
+
+            #rebalance equities accordingly, the symbol lock is reentrant so sell can take it again
+            if risk_limit:
+                if self.net_positions[symbol] > risk_limit:
+                    logger.debug("Finished rebalance: selling shares now")
+                    self.sell(price, 0, symbol, min(self.net_positions[symbol]-risk_limit, size))
+                    return
+            logger.debug("Finished rebalance: no shares sold")
+
+
+    #balance and positions, for checkpoints; history is not kept across restarts
+    def snapshot(self):
+        with self.portfolio_lock:
+            return {"initial_balance": self.initial_balance, "balance": self.balance, "net_positions": dict(self.net_positions),
+                    "prices": dict(self.prices), "position_values": dict(self.position_values),
+                    "net_position_value": self.net_position_value, "marks": self.marks, "trade_count": self.trade_count}
+
+    def restore(self, state):
+        '''
+        Loads a snapshot(), continuing its pnl from its initial balance. Positions in symbols that are not traded
+        any more are returned, they stay out of the portfolio.
+        '''
+        dropped = {symbol: size for symbol, size in state["net_positions"].items() if symbol not in self.net_positions and size}
+        with self.portfolio_lock:
+            self.initial_balance = state["initial_balance"]
+            self.balance = state["balance"]
+            self.trade_count = state["trade_count"]
+            self.marks = state["marks"]
+            for symbol in self.net_positions:
+                self.net_positions[symbol] = state["net_positions"].get(symbol, 0)
+                self.prices[symbol] = state["prices"].get(symbol, 0)
+                self.position_values[symbol] = state["position_values"].get(symbol, 0)
+                self.changed_equities.add(symbol)
+            #the running total carries on from the saved one (same rounding) unless the symbols changed
+            if set(state["net_positions"]) == set(self.net_positions):
+                self.net_position_value = state["net_position_value"]
+            else:
+                self.net_position_value = sum(self.position_values.values())
+        return dropped
+
+    #calculate pnl and append to pnl over time list at ts (seconds, the time of the tick or candle being handled),
+    #only equities whose value changed get a new point
+    def get_pnl(self, ts):
+        with self.portfolio_lock:
+            pnl = (self.balance + self.net_position_value) - self.initial_balance
+            #books of different exchanges can hand in slightly older ticks, the history never goes back in time
+            ts = max(ts, self.last_pnl_time)
+            self.last_pnl_time = ts
+            for key in self.changed_equities:
+                self.net_position_values_over_time[key].append(ts, self.position_values[key])
+            self.changed_equities.clear()
+            self.pnls_over_time.append(ts, pnl)
         return pnl
     
-    #get pnl without saving to list
+    #get pnl without saving to list, O(1) from the running totals
     def get_pnl_without_save(self):
-        asset_value = 0
-        for key in self.net_positions:
-            cur_equity_value = self.net_positions[key] * self.prices[key]
-            asset_value += cur_equity_value
-        return (self.balance + asset_value) - self.initial_balance
-
-    #plot pnl over time after exiting
-    def plot(self):
+        return (self.balance + self.net_position_value) - self.initial_balance
+
+    #plot pnl over time after exiting, from the downsampled history; shown in a window, or saved to file_name (e.g. headless)
+    def plot(self, file_name = None):
+        import matplotlib
+        if file_name:
+            matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
         finish_time = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
         plt.figure(figsize=(12,6))
-        plt.plot(self.pnls_over_time, linewidth=2, label="PNL")
-        for equity in self.net_position_values_over_time:
-            # print(self.net_position_values_over_time[equity])
-            plt.plot(self.net_position_values_over_time[equity], label = equity)
+        times, lasts, mins, maxs = self.pnls_over_time.downsampled()
+        dates = [datetime.fromtimestamp(t) for t in times.tolist()]
+        plt.plot(dates, lasts, linewidth=2, label="PNL")
+        plt.fill_between(dates, mins, maxs, alpha=0.2)
+        end = self.pnls_over_time.raw_times[self.pnls_over_time.raw_position - 1] if len(self.pnls_over_time) else None
+        for equity, history in self.net_position_values_over_time.items():
+            #values only change at the recorded points, hold them until the next one
+            if len(history):
+                times, lasts, mins, maxs = history.downsampled()
+                times = np.append(times, max(times[-1], end if end is not None else times[-1]))
+                lasts = np.append(lasts, lasts[-1])
+                plt.step([datetime.fromtimestamp(t) for t in times.tolist()], lasts, where="post", label = equity)
 
         plt.xlabel('time')
         plt.ylabel('USD')
         plt.title(f'Plot of PNLS and Net Positions from {self.start_time} to {finish_time}')
         plt.legend()
-        plt.show()
\ No newline at end of file
+        if file_name:
+            plt.savefig(file_name)
+            plt.close()
+            logger.info("Saved PNL plot to %s", file_name)
+        else:
+            plt.show()
+
+    #write the downsampled pnl and position value history to one csv per series
+    def export_history(self, directory = "."):
+        self.pnls_over_time.export_csv(f"{directory}/pnl_history.csv", "pnl")
+        for equity, history in self.net_position_values_over_time.items():
+            history.export_csv(f"{directory}/{equity}_position_history.csv", equity)
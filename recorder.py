@@ -0,0 +1,178 @@
+import atexit
+import csv
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from tick_format import TickFileWriter
+
+# header of every capture, HistHandler reads files with these columns
+CSV_HEADER = ["last", "lastSz", "ts", "askPx", "askSz", "bidPx", "bidSz"]
+ROTATIONS = {None: None, "hourly": (3600000, "%Y%m%d%H"), "daily": (86400000, "%Y%m%d")}
+RECORD_FORMATS = {"csv": ".csv", "binary": ".ticks"}
+
+_STOP = object()
+_open_recorders = []
+_open_recorders_lock = threading.Lock()
+
+
+#a download killed mid write can leave half a row at the end of the file, cut it so the next row starts on its own line
+def drop_partial_row(file):
+    with open(file.name, 'rb') as existing:
+        size = existing.seek(0, os.SEEK_END)
+        existing.seek(max(0, size - 4096))
+        tail = existing.read()
+    if tail.endswith(b"\n"):
+        return
+    newline = tail.rfind(b"\n")
+    if newline < 0:
+        return
+    file.truncate(size - len(tail) + newline + 1)
+    file.seek(0, os.SEEK_END)
+
+
+class TickRecorder():
+    '''
+    Records ticks for one symbol in download mode.
+    The websocket thread only puts rows on a queue; a dedicated writer thread writes them in batches,
+    flushing when batch_size rows are waiting or flush_interval seconds have passed.
+    Params:
+    symbol: symbol name, file is historical_data/<symbol>_data.csv (or .ticks)
+    exchange: exchange name, stored in the header of binary files
+    rotation: None, 'hourly' or 'daily'; rotated files get a _YYYYmmdd[HH] suffix taken from the tick ts (UTC)
+    record_format: 'csv' or 'binary' (fixed-width .ticks file, see tick_format.py)
+    '''
+    def __init__(self, symbol: str, exchange: str = "", directory: str = 'historical_data', batch_size: int = 500, flush_interval: float = 1.0, rotation: str = None, record_format: str = "csv") -> None:
+        if rotation not in ROTATIONS:
+            raise ValueError(f"rotation must be one of {list(ROTATIONS)}")
+        if record_format not in RECORD_FORMATS:
+            raise ValueError(f"record_format must be one of {list(RECORD_FORMATS)}")
+        self.symbol = symbol
+        self.exchange = exchange
+        self.record_format = record_format
+        self.directory = directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rotation = rotation
+        self.queue = queue.Queue()
+        self.file = None
+        self.writer = None
+        self.period = None
+        self.rows_written = 0
+        self.closed = False
+
+        #without rotation the capture file is opened up front, a restarted download appends to it
+        if self.rotation is None:
+            self.open_file(None)
+
+        self.thread = threading.Thread(target=self.run, name=f"recorder-{symbol}", daemon=True)
+        self.thread.start()
+        with _open_recorders_lock:
+            _open_recorders.append(self)
+
+    def file_name(self, period):
+        extension = RECORD_FORMATS[self.record_format]
+        if period is None:
+            return f"{self.directory}/{self.symbol}_data{extension}"
+        period_ms, time_format = ROTATIONS[self.rotation]
+        suffix = datetime.fromtimestamp(period * period_ms / 1000, tz=timezone.utc).strftime(time_format)
+        return f"{self.directory}/{self.symbol}_data_{suffix}{extension}"
+
+    def open_file(self, period):
+        if self.file:
+            self.file.close()
+        self.period = period
+        if self.record_format == "binary":
+            self.file = TickFileWriter(self.file_name(period), self.symbol, self.exchange)
+            self.writer = self.file
+        else:
+            self.file = open(self.file_name(period), 'a', newline='')
+            self.writer = csv.writer(self.file)
+            if self.file.tell() == 0:
+                self.writer.writerow(CSV_HEADER)
+            else:
+                drop_partial_row(self.file)
+
+    def write_rows(self, rows):
+        if self.record_format == "binary":
+            self.writer.write_rows(rows)
+        else:
+            self.writer.writerows(rows)
+
+    #called from the websocket thread: fields are in CSV_HEADER order
+    def record(self, fields):
+        self.queue.put(fields)
+
+    def run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self.write(batch)
+                return
+            if item is not None:
+                batch.append(item)
+                #drain whatever else is already waiting without blocking
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        self.write(batch)
+                        return
+                    batch.append(item)
+
+            if len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self.write(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+
+    def write(self, batch):
+        if not batch:
+            return
+        if self.rotation is None:
+            self.write_rows(batch)
+        else:
+            #rows arrive in time order, switch files whenever the rotation period changes
+            period_ms = ROTATIONS[self.rotation][0]
+            start = 0
+            for i, row in enumerate(batch):
+                period = int(float(row[2])) // period_ms
+                if period != self.period:
+                    if i > start:
+                        self.write_rows(batch[start:i])
+                    self.open_file(period)
+                    start = i
+            self.write_rows(batch[start:])
+        self.file.flush()
+        self.rows_written += len(batch)
+
+    #flush everything still queued and close the file
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(_STOP)
+        self.thread.join()
+        if self.file:
+            self.file.close()
+        with _open_recorders_lock:
+            if self in _open_recorders:
+                _open_recorders.remove(self)
+
+
+def close_all_recorders():
+    with _open_recorders_lock:
+        recorders = list(_open_recorders)
+    for recorder in recorders:
+        recorder.close()
+
+
+atexit.register(close_all_recorders)
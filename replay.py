@@ -0,0 +1,380 @@
+import glob
+import heapq
+import io
+import os
+from bisect import bisect_left, bisect_right
+import numpy as np
+from tick_format import open_tick_file, Tick, intern_symbol
+from bot_logging import get_logger
+
+logger = get_logger("replay")
+
+# column order of every capture written in download mode
+TICK_FIELDS = ["last", "lastSz", "ts", "askPx", "askSz", "bidPx", "bidSz"]
+
+
+class TickColumns():
+    '''
+    Typed numpy columns for one recorded capture, loaded once per file.
+    Prices and sizes are float64, ts is int64 milliseconds. Columns may be strided views
+    (e.g. fields of a memory-mapped .ticks file), they are not copied.
+    '''
+    def __init__(self, last, lastSz, ts, askPx, askSz, bidPx, bidSz) -> None:
+        self.last = np.asarray(last, dtype=np.float64)
+        self.lastSz = np.asarray(lastSz, dtype=np.float64)
+        self.ts = np.asarray(ts, dtype=np.int64)
+        self.askPx = np.asarray(askPx, dtype=np.float64)
+        self.askSz = np.asarray(askSz, dtype=np.float64)
+        self.bidPx = np.asarray(bidPx, dtype=np.float64)
+        self.bidSz = np.asarray(bidSz, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.ts)
+
+    def column(self, field):
+        return getattr(self, field)
+
+    #views of ticks [start, end)
+    def slice(self, start, end):
+        return TickColumns(*[self.column(field)[start:end] for field in TICK_FIELDS])
+
+    #copy reordered by ts, ties keep their recorded order
+    def sorted_by_time(self):
+        order = np.argsort(self.ts, kind="stable")
+        return TickColumns(*[self.column(field)[order] for field in TICK_FIELDS])
+
+    def is_time_ordered(self):
+        return len(self.ts) < 2 or bool(np.all(self.ts[1:] >= self.ts[:-1]))
+
+    @classmethod
+    def from_csv(cls, file_name):
+        import pandas as pd
+        dtypes = {field: np.float64 for field in TICK_FIELDS}
+        dtypes["ts"] = np.int64
+        data = pd.read_csv(file_name, usecols=TICK_FIELDS, dtype=dtypes)
+        return cls(*[data[field].to_numpy() for field in TICK_FIELDS])
+
+    @classmethod
+    def from_binary(cls, file_name):
+        #zero-copy views into the memory-mapped records
+        header, records = open_tick_file(file_name)
+        return cls(*[records[field] for field in TICK_FIELDS])
+
+    @classmethod
+    def from_file(cls, file_name):
+        if file_name.endswith(".ticks"):
+            return cls.from_binary(file_name)
+        return cls.from_csv(file_name)
+
+    @classmethod
+    def from_file_tail(cls, file_name, duration_ms):
+        '''
+        The ticks of the last duration_ms of a capture (counted back from its last tick), without reading the rest:
+        .ticks files are binary searched through the memory map, csv files are read backwards from the end.
+        '''
+        if file_name.endswith(".ticks"):
+            header, records = open_tick_file(file_name)
+            ts = records["ts"]
+            start = bisect_left(ts, ts[-1] - duration_ms) if len(ts) else 0
+            return cls(*[records[field][start:] for field in TICK_FIELDS])
+        return read_csv_tail(file_name, duration_ms)
+
+
+def read_csv_tail(file_name, duration_ms, block_size = 1 << 16):
+    '''
+    TickColumns of the last duration_ms of a csv capture. Blocks of growing size are read back from the end of
+    the file until one starts with a tick older than that, and only the lines from there on are parsed.
+    A partially written last line (capture still being downloaded) is left out.
+    '''
+    with open(file_name, 'rb') as file:
+        header = file.readline()
+        ts_index = header.decode().strip().split(",").index("ts")
+        data_start = file.tell()
+        size = file.seek(0, os.SEEK_END)
+
+        def line_ts(line):
+            return int(float(line.split(b",")[ts_index]))
+
+        #the last complete line ends the capture
+        file.seek(max(data_start, size - block_size))
+        tail = file.read()
+        if tail.count(b"\n") == 0:
+            return TickColumns(*[[] for field in TICK_FIELDS])
+        end = size - len(tail) + tail.rfind(b"\n") + 1
+        last_line = tail[:tail.rfind(b"\n")]
+        cutoff = line_ts(last_line[last_line.rfind(b"\n") + 1:]) - duration_ms
+
+        #step back until the first whole line of the block is older than the cutoff
+        block = block_size
+        while True:
+            position = max(data_start, end - block)
+            file.seek(position)
+            if position > data_start:
+                file.readline()
+            line_start = file.tell()
+            if position == data_start or (line_start < end and line_ts(file.readline()) < cutoff):
+                break
+            block *= 2
+        file.seek(line_start)
+        data = file.read(end - line_start)
+
+    import pandas as pd
+    dtypes = {field: np.float64 for field in TICK_FIELDS}
+    dtypes["ts"] = np.int64
+    frame = pd.read_csv(io.BytesIO(header + data), usecols=TICK_FIELDS, dtype=dtypes)
+    columns = TickColumns(*[frame[field].to_numpy() for field in TICK_FIELDS])
+    start = int(np.argmax(columns.ts >= cutoff)) if len(columns) else 0
+    return columns.slice(start, len(columns))
+
+
+def capture_start(file_name):
+    #ts of the first tick of a capture, None if it has none yet
+    if file_name.endswith(".ticks"):
+        header, records = open_tick_file(file_name)
+        return int(records["ts"][0]) if len(records) else None
+    with open(file_name, 'rb') as file:
+        ts_index = file.readline().decode().strip().split(",").index("ts")
+        line = file.readline()
+    return int(float(line.split(b",")[ts_index])) if line.endswith(b"\n") else None
+
+
+def captures_newest_first(symbol, directory = 'historical_data'):
+    '''
+    (first tick ts, file name) of every capture of symbol, csv or .ticks, rotated or not, latest first;
+    a capture converted to .ticks is only listed once, as the .ticks file. Captures without ticks are left out.
+    '''
+    file_names = {}
+    for file_name in sorted(glob.glob(f"{directory}/{symbol}_data*.csv")) + sorted(glob.glob(f"{directory}/{symbol}_data*.ticks")):
+        file_names[os.path.splitext(file_name)[0]] = file_name
+    starts = [(start, file_name) for file_name in file_names.values() if (start := capture_start(file_name)) is not None]
+    return sorted(starts, reverse=True)
+
+
+def read_captures_tail(symbol, duration_ms, directory = 'historical_data'):
+    '''
+    The ticks of the last duration_ms of a symbol's captures (counted back from the latest tick) and the files
+    they came from, oldest first. Rotated files are read backwards from the latest until one starts before the
+    window, each through TickColumns.from_file_tail.
+    '''
+    parts, file_names = [], []
+    cutoff = next_start = None
+    for start, file_name in captures_newest_first(symbol, directory):
+        if cutoff is None:
+            columns = TickColumns.from_file_tail(file_name, duration_ms)
+            if len(columns) == 0:
+                continue
+            cutoff = int(columns.ts[-1]) - duration_ms
+        else:
+            #an older file ends before the next one starts, that much back from its end covers the window
+            columns = TickColumns.from_file_tail(file_name, next_start - cutoff)
+            columns = columns.slice(bisect_left(columns.ts, cutoff), len(columns))
+            if len(columns) == 0:
+                break
+        parts.append(columns)
+        file_names.append(file_name)
+        next_start = int(columns.ts[0])
+        if start <= cutoff:
+            break
+    if not parts:
+        return TickColumns(*[[] for field in TICK_FIELDS]), []
+    if len(parts) == 1:
+        return parts[0], file_names
+    parts.reverse()
+    file_names.reverse()
+    return TickColumns(*[np.concatenate([part.column(field) for part in parts]) for field in TICK_FIELDS]), file_names
+
+
+def candle_boundaries(ts, candle_start, candle_length_ms):
+    '''
+    Precomputes the tick indices that close a candle, matching PriceLevelBook.generate_candle:
+    a tick starts a new candle when ts > candle_start + candle_length_ms.
+    Returns (boundary indices, candle_start after the last boundary).
+    '''
+    boundaries = []
+    n = len(ts)
+    if n == 0:
+        return np.empty(0, dtype=np.int64), candle_start
+
+    if n < 2 or bool(np.all(ts[1:] >= ts[:-1])):
+        #sorted timestamps, jump from boundary to boundary with a binary search
+        i = 0
+        while i < n:
+            i += int(np.searchsorted(ts[i:], candle_start + candle_length_ms, side="right"))
+            if i >= n:
+                break
+            boundaries.append(i)
+            candle_start = int(ts[i]) // candle_length_ms * candle_length_ms
+    else:
+        #out of order capture, fall back to a plain scan
+        for i, t in enumerate(ts.tolist()):
+            if t > candle_start + candle_length_ms:
+                boundaries.append(i)
+                candle_start = t // candle_length_ms * candle_length_ms
+
+    return np.asarray(boundaries, dtype=np.int64), candle_start
+
+
+def segment_sums(values, starts, ends):
+    '''
+    Sum of values[start:end] for each segment, added one value at a time from the left like the running
+    accumulators of PriceLevelBook.generate_candle, so columnar candles are bit for bit the tick by tick ones.
+    (np.add.reduceat adds pairwise, a few ulps off, which is enough to flip price == average ties.)
+    '''
+    sums = []
+    for start, end in zip(starts, ends):
+        total = values[start]
+        for value in values[start + 1:end]:
+            total += value
+        sums.append(total)
+    return sums
+
+
+class ColumnarReplay():
+    '''
+    Replays a TickColumns capture into a PriceLevelBook.
+    Candle boundaries and OHLCV are computed on the whole arrays up front, so only the
+    ticks that close a candle are turned into messages for the book listeners.
+    '''
+    def __init__(self, columns: TickColumns, symbol: str) -> None:
+        self.columns = columns
+        self.symbol = symbol
+
+    def run(self, orderbook):
+        columns = self.columns
+        n = len(columns)
+        if n == 0:
+            return
+        if orderbook.tick_listeners:
+            #tick listeners need every tick, not just the ones closing a candle
+            replay_ticks(columns, self.symbol, orderbook, 0, n)
+            return
+
+        bounds, last_candle_start = candle_boundaries(columns.ts, orderbook.candle_start, orderbook.candle_length_ms)
+        if len(bounds) == 0:
+            orderbook.accumulate_ticks(columns.last, columns.lastSz)
+            return
+
+        #ticks before the first boundary finish the candle already in progress in the book
+        orderbook.accumulate_ticks(columns.last[:bounds[0]], columns.lastSz[:bounds[0]])
+
+        #OHLCV of every segment between boundaries; the last segment is left in progress
+        last, size = columns.last, columns.lastSz
+        segment_ends = np.append(bounds[1:], n)
+        opens = last[bounds].tolist()
+        highs = np.maximum.reduceat(last, bounds).tolist()
+        lows = np.minimum.reduceat(last, bounds).tolist()
+        closes = last[segment_ends - 1].tolist()
+        starts, ends = bounds.tolist(), segment_ends.tolist()
+        price_sums = segment_sums(last.tolist(), starts, ends)
+        tick_counts = (segment_ends - bounds).tolist()
+        volumes = segment_sums(size.tolist(), starts, ends)
+        notionals = segment_sums((last * size).tolist(), starts, ends)
+
+        #only materialize the rows that close a candle
+        rows = [columns.column(field)[bounds].tolist() for field in TICK_FIELDS]
+        rows[2] = [float(t) for t in rows[2]]
+        symbol, exchange_id = intern_symbol(self.symbol), orderbook.exchange_id
+        candle_length_ms = orderbook.candle_length_ms
+
+        for k, row in enumerate(zip(*rows)):
+            message = Tick(*row, symbol, exchange_id)
+            candle = orderbook.close_candle()
+            orderbook.candle_start = message.ts//candle_length_ms * candle_length_ms
+            orderbook.load_candle(opens[k], highs[k], lows[k], closes[k], price_sums[k], tick_counts[k], volumes[k], notionals[k])
+            orderbook.publish_candle(candle, message)
+
+        #leave the book holding the unfinished candle, same as a tick-by-tick replay would
+        orderbook.candle_start = last_candle_start
+
+
+def replay_ticks(columns, symbol, orderbook, start, end, rows = None):
+    '''
+    Replays ticks [start, end) one message at a time through orderbook.on_trade.
+    rows: the columns as python lists, when the caller already has them.
+    '''
+    if rows is None:
+        rows = [columns.column(field)[start:end].tolist() for field in TICK_FIELDS]
+        start, end = 0, end - start
+    last, size, times, ask, ask_size, bid, bid_size = rows
+    symbol, exchange_id, on_trade = intern_symbol(symbol), orderbook.exchange_id, orderbook.on_trade
+    for k in range(start, end):
+        on_trade(Tick(last[k], size[k], float(times[k]), ask[k], ask_size[k], bid[k], bid_size[k], symbol, exchange_id))
+
+
+class ReplayCoordinator():
+    '''
+    Replays several captures into their books as one time-ordered stream, from a single loop.
+    Ticks are merged by ts with a k-way heap merge (ties go to the stream added first), so
+    listeners shared between books, like the PortfolioManager, see the same order on every run.
+    The merge hands out runs of consecutive ticks of one stream, replayed tick by tick through on_trade.
+    columnar_run is opt-in: runs of at least that many ticks then go through ColumnarReplay instead
+    (None, the default, never does).
+    '''
+    def __init__(self, columnar_run = None) -> None:
+        self.streams = []
+        self.columnar_run = columnar_run # shortest run replayed columnar, None for tick by tick only
+
+    def add_stream(self, columns: TickColumns, symbol: str, orderbook):
+        if not columns.is_time_ordered():
+            logger.warning("%s has out of order timestamps, replaying it sorted by ts", symbol)
+            columns = columns.sorted_by_time()
+        self.streams.append((columns, symbol, orderbook))
+
+    def run(self):
+        streams = self.streams
+        rows = [None] * len(streams) # python rows of a stream, built the first time it needs tick by tick replay
+        times = [columns.ts.tolist() for columns, symbol, orderbook in streams]
+        positions = [0] * len(streams)
+        heap = [(times[i][0], i) for i in range(len(streams)) if times[i]]
+        heapq.heapify(heap)
+
+        while heap:
+            _, i = heapq.heappop(heap)
+            columns, symbol, orderbook = streams[i]
+            ts = times[i]
+            start = positions[i]
+            n = len(ts)
+
+            #this stream goes first until it passes the head of the next stream
+            if heap:
+                next_ts, next_i = heap[0]
+                search = bisect_right if i < next_i else bisect_left
+                end = max(start + 1, search(ts, next_ts, start))
+            else:
+                end = n
+
+            if self.columnar_run is not None and end - start >= self.columnar_run and not orderbook.tick_listeners:
+                ColumnarReplay(columns.slice(start, end), symbol).run(orderbook)
+            else:
+                if rows[i] is None:
+                    rows[i] = [columns.column(field).tolist() for field in TICK_FIELDS]
+                replay_ticks(columns, symbol, orderbook, start, end, rows[i])
+
+            positions[i] = end
+            if end < n:
+                heapq.heappush(heap, (ts[end], i))
+
+
+def warm_up(books, duration_ms, directory = 'historical_data'):
+    '''
+    Primes the candles and indicators of live books from the last duration_ms of each symbol's captures,
+    across rotated files, replayed as one time-ordered stream so listeners shared by several books see the ticks in order.
+    Nothing trades during the replay, see PriceLevelBook.begin_warm_up. Returns the books that had a capture.
+    '''
+    coordinator = ReplayCoordinator()
+    warmed = []
+    for book in books:
+        columns, file_names = read_captures_tail(book.symbol, duration_ms, directory)
+        if len(columns) == 0:
+            logger.info("No capture of %s in %s, it starts cold", book.symbol, directory)
+            continue
+        logger.info("Warming up %s on %d ticks from %s", book.symbol, len(columns), ", ".join(file_names))
+        coordinator.add_stream(columns, book.symbol, book)
+        book.begin_warm_up()
+        warmed.append(book)
+    try:
+        coordinator.run()
+    finally:
+        for book in warmed:
+            book.end_warm_up()
+    return warmed
@@ -1,6 +1,10 @@
-import pandas as pd
 import numpy as np
-import time
+from indicators import IndicatorRegistry, StreamingMACD, WindowedMACD, RollingHurst, RollingSMA, RollingRSI
+from bot_logging import get_logger
+from latency import latency, now
+
+logger = get_logger("strategy")
+
 class IStrategy():
     '''
     Interface for an automated trading strategy.
@@ -11,6 +15,14 @@ class IStrategy():
     def on_trade_add(self):
         raise NotImplementedError
 
+    #called by the book this strategy is added to
+    def bind(self, book):
+        pass
+
+    #candles replayed while the book warms up from recorded data, must not trade; listeners that can't warm up skip them
+    def warm_up(self, new_candle, message):
+        pass
+
     def add_book_listener(self):
         raise NotImplementedError 
 
@@ -22,51 +34,85 @@ class BaseStrategy(IStrategy):
         super().__init__() 
         self.market_data_manager = market_data_manager
         self.portfolio_manager = portfolio_manager 
+        self.name = type(self).__name__
+        self.indicators = None
 
     # for each strategy every time new candle is received, generate new signal, then send buy or sell to portfolio manager
     def on_trade_add(self):
         pass
 
-    def add_book_listener(self, symbol):
-        self.market_data_manager.get_orderbook(symbol=symbol).add_book_listener(strategy=self)
+    #indicators come from the registry of the book once added to one, until then from a private registry
+    def use_indicators(self, registry):
+        self.indicators = registry
+        self.declare_indicators(registry)
+
+    #subclasses get their indicators here with registry.get(indicator class, *args)
+    def declare_indicators(self, registry):
+        pass
+
+    def bind(self, book):
+        self.use_indicators(book.indicators)
+
+    #the strategies' state is their indicators, so warming up is feeding them the candle
+    def warm_up(self, new_candle, message):
+        self.indicators.on_candle(new_candle)
+
+    def add_book_listener(self, symbol, timeframe = None):
+        self.market_data_manager.get_orderbook(symbol=symbol).add_book_listener(strategy=self, timeframe=timeframe)
+
+    def remove_book_listener(self, symbol, timeframe = None):
+        self.market_data_manager.get_orderbook(symbol=symbol).remove_book_listener(strategy=self, timeframe=timeframe) 
+
+    #orders go through here so the signal (candle published -> order) and execution (portfolio call) stages get timed
+    def execute(self, order, message, price, size):
+        start = now()
+        exchange = message.exchange
+        latency.record("signal", start - (message.publishNs or start), exchange, message.symbol, self.name)
+        order(price, size, message.symbol)
+        latency.record("execution", now() - start, exchange, message.symbol, self.name)
+
+    def buy(self, message):
+        self.execute(self.portfolio_manager.buy, message, message.askPx, message.askSz)
+
+    def sell(self, message):
+        self.execute(self.portfolio_manager.sell, message, message.bidPx, message.bidSz)
 
-    def remove_book_listener(self, symbol):
-        self.market_data_manager.get_orderbook(symbol=symbol).remove_book_listener(strategy=self) 
+    def rebalance(self, message):
+        self.execute(self.portfolio_manager.rebalance, message, message.askPx, message.askSz)
 
-    def print_receive_to_trade_execute_time(self, message):
-        print("Latency:", str((time.time()-message["receiveTime"])*1000) + "ms")
+    #socket receive to strategy done, historic messages carry no receive stamp
+    def record_latency(self, message):
+        if message.receiveNs is not None:
+            latency.record("total", now() - message.receiveNs, message.exchange, message.symbol, self.name)
     
 
 class SimpleMovingAvgStrategy(BaseStrategy):
     def __init__(self, market_data_manager, portfolio_manager, window_size = 14) -> None:
         super().__init__(market_data_manager, portfolio_manager) 
         self.window_size = window_size
-        self.candles = []
-        self.sum = 0
+        self.use_indicators(IndicatorRegistry())
+
+    def declare_indicators(self, registry):
+        self.sma = registry.get(RollingSMA, self.window_size)
 
     def on_trade_add(self, new_candle: dict[str, float], message: dict[str, float]):
         #preprocess new candle
-        self.candles.append(new_candle)
-        self.sum += new_candle["price"]
-        if len(self.candles) > self.window_size:
-            popped = self.candles.pop(0)
-            self.sum -= popped["price"]
-
-        if len(self.candles) != self.window_size:
+        self.indicators.on_candle(new_candle)
+        if self.sma.count != self.window_size:
             return
 
         #generate signal
-        cur_moving_avg = self.sum / self.window_size
+        cur_moving_avg = self.sma.value
         
         #do action based on signal
-        if self.candles[-1]["price"] > cur_moving_avg:
-            self.portfolio_manager.sell(message["bidPx"], message["bidSz"], message["symbol"]) 
-        elif self.candles[-1]["price"] < cur_moving_avg:
-            self.portfolio_manager.buy(message["askPx"], message["askSz"], message["symbol"])
+        if self.sma.last > cur_moving_avg:
+            self.sell(message) 
+        elif self.sma.last < cur_moving_avg:
+            self.buy(message)
         else:
-            self.portfolio_manager.rebalance(message["askPx"], message["askSz"], message["symbol"])
-        print("PNL:", self.portfolio_manager.get_pnl())
-        self.print_receive_to_trade_execute_time(message)
+            self.rebalance(message)
+        logger.info("PNL: %s", self.portfolio_manager.get_pnl(message.ts / 1000))
+        self.record_latency(message)
         
     
 
@@ -74,104 +120,74 @@ class RSIStrategy(BaseStrategy):
     def __init__(self, market_data_manager, portfolio_manager, window_size = 14, buy_thresh = 30, sell_thresh = 70) -> None:
         super().__init__(market_data_manager, portfolio_manager) 
         self.window_size = window_size
-        self.last_price = 0
-        self.deltas = []
-        self.ups = 0
-        self.downs = 0
         self.buy_thresh = buy_thresh
         self.sell_thresh = sell_thresh
+        self.use_indicators(IndicatorRegistry())
+
+    def declare_indicators(self, registry):
+        self.rsi = registry.get(RollingRSI, self.window_size)
 
     def on_trade_add(self, new_candle: dict[str, float], message: dict[str, float]):
         #preprocess new candle
-        if self.last_price == 0:
-            self.last_price = new_candle["price"] 
-            return
-        
-        diff = new_candle["price"] - self.last_price
-        self.deltas.append(diff)
-        if diff > 0:
-            self.ups += diff 
-        else:
-            self.downs += abs(diff)
-
-        if len(self.deltas) > self.window_size:
-            popped = self.deltas.pop(0)
-            if popped > 0:
-                self.ups -= popped 
-            else:
-                self.downs -= abs(popped)
-
-        self.last_price = new_candle["price"]
-
-        if len(self.deltas) != self.window_size:
+        self.indicators.on_candle(new_candle)
+        if self.rsi.count != self.window_size:
             return
         
         #generate signal
-        avg_ups = self.ups/self.window_size
-        avg_downs = self.downs/self.window_size
-        if (avg_downs) == 0:
-            avg_downs = 0.1
-        relative_strength = avg_ups/avg_downs
-        rsi = 100 - 100 / (1+relative_strength)
+        rsi = self.rsi.value
         
         #do action based on signal
         if rsi >= self.sell_thresh:
-            self.portfolio_manager.sell(message["bidPx"], message["bidSz"], message["symbol"]) 
+            self.sell(message) 
         elif rsi <= self.buy_thresh:
-            self.portfolio_manager.buy(message["askPx"], message["askSz"], message["symbol"])
+            self.buy(message)
         else:
-            self.portfolio_manager.rebalance(message["askPx"], message["askSz"], message["symbol"])
-        print("PNL:", "$"+str(self.portfolio_manager.get_pnl()))
-        self.print_receive_to_trade_execute_time(message)
+            self.rebalance(message)
+        logger.info("PNL: $%s", self.portfolio_manager.get_pnl(message.ts / 1000))
+        self.record_latency(message)
 
 class MACDStrategy(BaseStrategy):
-    def __init__(self, market_data_manager, portfolio_manager, short_window = 12, long_window = 26, signal_span = 9, hurst_thresh = 0.6, hurst_len = 100) -> None:
+    def __init__(self, market_data_manager, portfolio_manager, short_window = 12, long_window = 26, signal_span = 9, hurst_thresh = 0.6, hurst_len = 100, hurst_min_lag = 2, hurst_max_lag = 20, windowed_macd = True) -> None:
         super().__init__(market_data_manager, portfolio_manager) 
-        self.candles = []
-        self.historic_prices = []
         self.short_window = short_window
         self.long_window = long_window
         self.signal_span = signal_span
         self.hurst_thresh = hurst_thresh
         self.hurst_len = hurst_len
+        self.hurst_min_lag = hurst_min_lag
+        self.hurst_max_lag = hurst_max_lag
+        self.windowed_macd = windowed_macd
+        self.use_indicators(IndicatorRegistry())
+
+    def declare_indicators(self, registry):
+        #windowed: EMAs over the last long_window candles only; otherwise EMAs over every candle seen
+        macd_class = WindowedMACD if self.windowed_macd else StreamingMACD
+        self.macd = registry.get(macd_class, self.short_window, self.long_window, self.signal_span)
+        #hurst exponent over the last hurst_len candles
+        self.hurst = registry.get(RollingHurst, self.hurst_len, self.hurst_min_lag, self.hurst_max_lag)
 
     def on_trade_add(self, new_candle: dict[str, float], message: dict[str, float]):
         #preprocess new candle
-        self.candles.append(new_candle["price"])
-        self.historic_prices.append(new_candle["price"])
-        if len(self.candles) > self.long_window:
-            self.candles.pop(0)
-        if len(self.historic_prices) > self.hurst_len:
-            self.historic_prices.pop(0)
-
-        if len(self.candles) != self.long_window:
-            return
-
-        #generate signal
-        data = pd.DataFrame(self.candles, columns=['price'])
-        ema_short = data['price'].ewm(span=self.short_window).mean()
-        ema_long = data['price'].ewm(span=self.long_window).mean()
-        macd = ema_short - ema_long
-        macd_signal_line = macd.ewm(span=self.signal_span).mean()
-        macd = macd.iloc[-1]
-        macd_signal_line = macd_signal_line.iloc[-1]
-
-        #hurst exponent
-        hurst = self.get_hurst_exponent(self.historic_prices)
+        self.indicators.on_candle(new_candle)
+        macd, macd_signal_line = self.macd.macd, self.macd.signal
+        hurst = self.hurst.value
 
+        if self.macd.count < self.long_window:
+            return
 
         #do action based on signal, if hurst > 0.5, place order
         if macd > macd_signal_line and hurst > self.hurst_thresh:
-                self.portfolio_manager.buy(message["askPx"], message["askSz"], message["symbol"])
+                self.buy(message)
         elif macd < macd_signal_line and hurst > self.hurst_thresh:
-                self.portfolio_manager.sell(message["bidPx"], message["bidSz"], message["symbol"]) 
+                self.sell(message) 
         else:
-            self.portfolio_manager.rebalance(message["askPx"], message["askSz"], message["symbol"])
+            self.rebalance(message)
         
         
-        print("PNL:", self.portfolio_manager.get_pnl())
-        self.print_receive_to_trade_execute_time(message)
+        logger.info("PNL: %s", self.portfolio_manager.get_pnl(message.ts / 1000))
+        self.record_latency(message)
 
+    #reference implementation over a full array, the strategy itself uses the incremental RollingHurst
     def get_hurst_exponent(self, time_series, max_lag=20):
         lags = range(2, max_lag)
 
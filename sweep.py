@@ -0,0 +1,245 @@
+import argparse
+import concurrent.futures
+import csv
+import glob
+import itertools
+import os
+import random
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from orderbook import PriceLevelBook
+from portfolio_manager import PortfolioManager
+from replay import TickColumns, ColumnarReplay, replay_ticks, TICK_FIELDS
+from strategy import IStrategy, MACDStrategy, RSIStrategy, SimpleMovingAvgStrategy
+from tick_format import TICK_DTYPE
+from latency import latency
+from vectorized import run_vectorized
+
+STRATEGIES = {"macd": MACDStrategy, "rsi": RSIStrategy, "sma": SimpleMovingAvgStrategy}
+
+# used when no --params are given
+DEFAULT_GRIDS = {"macd": {"short_window": [8, 12, 16], "long_window": [21, 26, 34], "hurst_thresh": [0.5, 0.6, 0.7]},
+                 "rsi": {"window_size": [10, 14, 20], "buy_thresh": [20, 25, 30], "sell_thresh": [70, 75, 80]},
+                 "sma": {"window_size": [7, 14, 28, 56]}}
+
+RESULT_FIELDS = ["rank", "strategy", "symbol", "params", "pnl", "max_drawdown", "trades", "candles", "seconds"]
+
+# per worker process: symbol -> TickColumns viewing the shared blocks
+_worker_columns = {}
+_worker_blocks = []
+
+
+def symbol_for_file(file_name):
+    name = os.path.basename(file_name)
+    for suffix in ("_data.csv", "_data.ticks"):
+        if name.endswith(suffix):
+            return name.removesuffix(suffix)
+    return os.path.splitext(name)[0]
+
+
+def parse_values(text):
+    '''
+    "8,12,16" -> [8, 12, 16] (choices), "0.4:0.7" -> (0.4, 0.7) (range, random search only).
+    '''
+    def number(value):
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+
+    if ":" in text:
+        low, high = text.split(":")
+        return (number(low), number(high))
+    return [number(value) for value in text.split(",")]
+
+
+def parse_params(specs):
+    params = {}
+    for spec in specs:
+        name, _, values = spec.partition("=")
+        if not values:
+            raise ValueError(f"parameter {spec!r} must look like name=1,2,3 or name=low:high")
+        params[name] = parse_values(values)
+    return params
+
+
+def grid_search(params):
+    for name, values in params.items():
+        if isinstance(values, tuple):
+            raise ValueError(f"{name} is a range, ranges are only allowed with --random")
+    names = list(params)
+    for combination in itertools.product(*params.values()):
+        yield dict(zip(names, combination))
+
+
+def random_search(params, count, seed = None):
+    rng = random.Random(seed)
+    seen = set()
+    for _ in range(count * 10):
+        if len(seen) == count:
+            break
+        combination = {}
+        for name, values in params.items():
+            if isinstance(values, list):
+                combination[name] = rng.choice(values)
+            elif isinstance(values[0], int) and isinstance(values[1], int):
+                combination[name] = rng.randint(*values)
+            else:
+                combination[name] = round(rng.uniform(*values), 4)
+        key = tuple(sorted(combination.items()))
+        if key not in seen:
+            seen.add(key)
+            yield combination
+
+
+class DrawdownTracker(IStrategy):
+    '''
+    Book listener registered after the strategy: follows the portfolio PnL on every candle
+    and keeps the largest drop from a previous peak.
+    '''
+    def __init__(self, portfolio_manager) -> None:
+        super().__init__()
+        self.portfolio_manager = portfolio_manager
+        self.peak = 0.0
+        self.max_drawdown = 0.0
+        self.candles = 0
+
+    def on_trade_add(self, new_candle, message):
+        pnl = self.portfolio_manager.get_pnl_without_save()
+        self.candles += 1
+        if pnl > self.peak:
+            self.peak = pnl
+        elif self.peak - pnl > self.max_drawdown:
+            self.max_drawdown = self.peak - pnl
+
+
+def share_columns(columns):
+    '''
+    Copies a capture into one shared memory block of TICK_DTYPE records.
+    Returns the block, workers attach to it by name instead of reading the file again.
+    '''
+    block = shared_memory.SharedMemory(create=True, size=max(1, len(columns) * TICK_DTYPE.itemsize))
+    records = np.ndarray((len(columns),), dtype=TICK_DTYPE, buffer=block.buf)
+    for field in TICK_FIELDS:
+        records[field] = columns.column(field)
+    return block
+
+
+def attach_columns(shared):
+    #pool initializer: map every shared capture once per worker process, nobody reads the latency histograms there
+    latency.enabled = False
+    for symbol, (name, count) in shared.items():
+        block = shared_memory.SharedMemory(name=name)
+        records = np.ndarray((count,), dtype=TICK_DTYPE, buffer=block.buf)
+        _worker_blocks.append(block)
+        _worker_columns[symbol] = TickColumns(*[records[field] for field in TICK_FIELDS])
+
+
+def run_backtest(strategy, symbol, params, risk_manager = "cppi", balance = 1000000, columns = None, vectorized = False, columnar = True):
+    '''
+    One historic run of `strategy` with constructor arguments `params` on the capture of `symbol`.
+    Candles are built by ColumnarReplay, or tick by tick through PriceLevelBook.on_trade like
+    `python main.py -d historic` when columnar is False, without the feed threads or the plot;
+    vectorized.run_vectorized when vectorized is set.
+    '''
+    started = time.perf_counter()
+    columns = columns if columns is not None else _worker_columns[symbol]
+    if vectorized:
+        return run_vectorized(strategy, symbol, params, risk_manager, balance, columns)
+    portfolio_manager = PortfolioManager(initial_balance=balance, risk_manager=risk_manager, equities=[symbol])
+    book = PriceLevelBook()
+    book.add_book_listener(STRATEGIES[strategy](market_data_manager=None, portfolio_manager=portfolio_manager, **params))
+    tracker = DrawdownTracker(portfolio_manager)
+    book.add_book_listener(tracker)
+    if columnar:
+        ColumnarReplay(columns, symbol).run(book)
+    else:
+        replay_ticks(columns, symbol, book, 0, len(columns))
+    return {"strategy": strategy,
+            "symbol": symbol,
+            "params": params,
+            "pnl": portfolio_manager.get_pnl_without_save(),
+            "max_drawdown": tracker.max_drawdown,
+            "trades": portfolio_manager.trade_count,
+            "candles": tracker.candles,
+            "seconds": time.perf_counter() - started}
+
+
+def sweep(strategy, file_names, combinations, risk_manager = "cppi", balance = 1000000, workers = None, vectorized = False):
+    '''
+    Runs every parameter combination on every file on a process pool and returns the results
+    ranked by PnL. Each capture is parsed once in this process and shared with the workers.
+    '''
+    combinations = list(combinations)
+    blocks = []
+    try:
+        shared = {}
+        for file_name in file_names:
+            columns = TickColumns.from_file(file_name)
+            block = share_columns(columns)
+            blocks.append(block)
+            shared[symbol_for_file(file_name)] = (block.name, len(columns))
+
+        jobs = [(strategy, symbol, params, risk_manager, balance, None, vectorized) for params in combinations for symbol in shared]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=attach_columns, initargs=(shared,)) as executor:
+            chunksize = max(1, len(jobs) // (4 * (workers or os.cpu_count() or 1)))
+            results = list(executor.map(run_backtest, *zip(*jobs), chunksize=chunksize)) if jobs else []
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    results.sort(key=lambda result: result["pnl"], reverse=True)
+    for rank, result in enumerate(results, 1):
+        result["rank"] = rank
+    return results
+
+
+def print_results(results, top = None):
+    rows = results[:top] if top else results
+    header = f"{'rank':>4}  {'strategy':<8} {'symbol':<10} {'pnl':>14} {'max_drawdown':>14} {'trades':>7}  params"
+    print(header)
+    print("-" * len(header))
+    for result in rows:
+        params = " ".join(f"{name}={value}" for name, value in result["params"].items())
+        print(f"{result['rank']:>4}  {result['strategy']:<8} {result['symbol']:<10} {result['pnl']:>14.2f} "
+              f"{result['max_drawdown']:>14.2f} {result['trades']:>7}  {params}")
+
+
+def write_results(results, file_name):
+    with open(file_name, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        for result in results:
+            writer.writerow(dict(result, params=" ".join(f"{name}={value}" for name, value in result["params"].items())))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                     description="Parameter sweep over historical data, every combination runs the historic backtest on every file\
+                                        \nTry \'python sweep.py -s macd -p short_window=8,12,16 long_window=21,26 hurst_thresh=0.5,0.6\' for a grid search\
+                                        \nTry \'python sweep.py -s rsi -p buy_thresh=15:35 sell_thresh=65:85 --random 50\' for a random search")
+    parser.add_argument('-s', '--strategy', choices=list(STRATEGIES), type = str, help='Strategy to tune', required=True)
+    parser.add_argument('-p', '--params', nargs='*', help='Constructor parameters: name=v1,v2,... or name=low:high (default: built-in grid)', default=None)
+    parser.add_argument('-f', '--files', nargs='*', help='Capture files (default: historical_data/*.csv)', default=None)
+    parser.add_argument('--random', type = int, help='Random search with this many combinations instead of the full grid', default=None)
+    parser.add_argument('--seed', type = int, help='Seed of the random search', default=None)
+    parser.add_argument('-r', '--risk_manager', choices=['cppi', 'tipp', 'ratio'], type = str, help='Risk manager (default: cppi)', default="cppi")
+    parser.add_argument('-b', '--balance', type = float, help='Initial balance (default: 1000000)', default=1000000)
+    parser.add_argument('-j', '--workers', type = int, help='Worker processes (default: one per cpu)', default=None)
+    parser.add_argument('--vectorized', action='store_true', help='Run each backtest with the vectorized engine (same results, much faster)')
+    parser.add_argument('--top', type = int, help='Only print the best N results', default=None)
+    parser.add_argument('-o', '--output', type = str, help='Also write the ranked table to this csv file', default=None)
+    args = parser.parse_args()
+
+    params = parse_params(args.params) if args.params else DEFAULT_GRIDS[args.strategy]
+    combinations = random_search(params, args.random, args.seed) if args.random else grid_search(params)
+    file_names = args.files or sorted(glob.glob('historical_data/*.csv'))
+
+    start = time.perf_counter()
+    results = sweep(args.strategy, file_names, combinations, args.risk_manager, args.balance, args.workers, args.vectorized)
+    print_results(results, args.top)
+    print(f"{len(results)} backtests in {time.perf_counter() - start:.1f}s")
+    if args.output:
+        write_results(results, args.output)
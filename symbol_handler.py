@@ -1,8 +1,17 @@
 from orderbook import IOrderbook, PriceLevelBook
-from data_handler import IDataHandler, WSHandler, HistHandler
-import csv
-from datetime import datetime
+from data_handler import HistHandler
+from recorder import TickRecorder
+from decoding import IsoTimestampParser
+from bot_logging import get_logger
+from latency import latency, now
+from tick_format import Tick, EXCHANGE_IDS, intern_symbol
+from decoding import loads
+import threading
 import time
+from collections import deque
+import urllib.request
+
+logger = get_logger("symbols")
 
 class ISymbolHandler():
     '''
@@ -25,9 +34,12 @@ class ISymbolHandler():
 
 
 class BaseSymbolHandler(ISymbolHandler):
+    exchange = "-"
+
     def __init__(self, symbol, type) -> None:
         super().__init__()
-        self.orderbook = PriceLevelBook() 
+        self.exchange_id = EXCHANGE_IDS.get(self.exchange, 0)
+        self.orderbook = PriceLevelBook(symbol=symbol, exchange=self.exchange) 
 
         if not isinstance(self.orderbook, IOrderbook):
             raise ValueError
@@ -35,6 +47,17 @@ class BaseSymbolHandler(ISymbolHandler):
     def parse_message(self):
         pass 
 
+    #level 2 messages arrive on the same connection as the ticker when the depth channel is subscribed
+    def is_depth_message(self, message):
+        return False
+
+    def parse_depth_message(self, message, type):
+        pass
+
+    #levels as [price, size, ...] strings -> (price, size) floats
+    def parse_levels(self, levels):
+        return [(float(level[0]), float(level[1])) for level in levels]
+
     def start(self):
         self.data_handler.start()
 
@@ -42,251 +65,257 @@ class BaseSymbolHandler(ISymbolHandler):
         return self.orderbook
 
 class BinanceSymbolHandler(BaseSymbolHandler):
-    def __init__(self, symbol, type) -> None:
+    exchange = "Binance"
+    depth_snapshot_url = "https://api.binance.us/api/v3/depth?symbol={symbol}&limit=1000"
+    depth_buffer_size = 1000 # deltas kept while a snapshot is fetched, overflowing it resyncs from scratch
+    depth_retry_delay = 1.0 # seconds before refetching a failed snapshot, doubled on every failure in a row
+    depth_max_retry_delay = 60.0
+
+    def __init__(self, symbol, type, rotation=None, record_format="csv") -> None:
         super().__init__(symbol, type)
-        self.symbol = symbol
-
-        if type == "live":
-            self.data_handler = WSHandler(
-                url="wss://stream.binance.us:9443/ws", 
-                subscribe_message = {"method": "SUBSCRIBE",
-                                    "params": [f"{symbol.lower()}@ticker"],
-                                    "id": int(time.time())}, 
-                symbol=symbol, 
-                symbol_handler=self,
-                data_action=type)
-            
-        elif type == "historic":
+        self.symbol = intern_symbol(symbol)
+        #the diff depth stream needs a REST snapshot to start from, see parse_depth_message
+        self.depth_update_id = None
+        self.depth_snapshot = None
+        self.depth_fetching = False
+        self.depth_failures = 0 # failed snapshot fetches in a row
+        self.depth_retry_at = 0.0 # time.monotonic() before which no snapshot is fetched after a failure
+        self.depth_buffer = deque(maxlen=self.depth_buffer_size)
+
+        #live and download symbols stream over their exchange's shared connection, see MarketDataManager
+        self.data_handler = None
+        if type == "historic":
             self.data_handler = HistHandler(
                 symbol = symbol,
                 symbol_handler=self)
-            
         elif type == "download":
-            #initialize csv file
-            filename = 'historical_data/' + self.symbol + '_data.csv'
-            with open(filename, 'w') as csvfile: 
-                # creating a csv writer object 
-                csvwriter = csv.writer(csvfile) 
-                # writing the fields 
-                csvwriter.writerow(["last", "lastSz", "ts", "askPx", "askSz", "bidPx", "bidSz"]) 
-                csvfile.close()
-
-            #start websocket to collect data
-            self.data_handler = WSHandler(
-                url="wss://stream.binance.us:9443/ws", 
-                subscribe_message = {"method": "SUBSCRIBE",
-                                    "params": [f"{symbol.lower()}@ticker"],
-                                    "id": int(time.time())}, 
-                symbol=symbol, 
-                symbol_handler=self,
-                data_action=type)
-        else:
-            print("Invalid data type.")
-
-        if not isinstance(self.data_handler, IDataHandler):
+            #ticks are written to csv in batches by a background recorder thread
+            self.recorder = TickRecorder(self.symbol, exchange=self.exchange, rotation=rotation, record_format=record_format)
+        elif type != "live":
+            logger.error("Invalid data type.")
             raise ValueError
         
     
-    def parse_message(self, message, type):
-        receive_time = time.time()
-        if type == "live":
+    def is_depth_message(self, message):
+        return message.get("e") == "depthUpdate"
+
+    def fetch_depth_snapshot(self):
+        try:
+            with urllib.request.urlopen(self.depth_snapshot_url.format(symbol=self.symbol), timeout=10) as response:
+                self.depth_snapshot = loads(response.read())
+            self.depth_failures = 0
+        except (OSError, ValueError) as error:
+            delay = min(self.depth_retry_delay * 2 ** self.depth_failures, self.depth_max_retry_delay)
+            self.depth_failures += 1
+            self.depth_retry_at = time.monotonic() + delay
+            logger.error("Depth snapshot for %s failed: %s, retrying in %.0fs", self.symbol, error, delay)
+        self.depth_fetching = False
+
+    #fetch a snapshot on a side thread unless one is already on its way or the last one failed too recently
+    def request_depth_snapshot(self):
+        if not self.depth_fetching and time.monotonic() >= self.depth_retry_at:
+            self.depth_fetching = True
+            threading.Thread(target=self.fetch_depth_snapshot, name=f"depth-{self.symbol}", daemon=True).start()
+
+    #drop the book's sync state, message is the first delta kept for the next snapshot
+    def resync_depth(self, message):
+        self.depth_update_id = None
+        self.depth_snapshot = None
+        self.depth_buffer.clear()
+        self.depth_buffer.append(message)
+        self.request_depth_snapshot()
+
+    def parse_depth_message(self, message, type):
+        if type != "live":
+            return
+        if self.depth_update_id is not None:
+            self.apply_depth_delta(message)
+            return
+
+        #buffer deltas while the snapshot is fetched on a side thread, then replay them on top of it
+        if len(self.depth_buffer) == self.depth_buffer.maxlen:
+            logger.warning("Depth buffer of %s filled up waiting for a snapshot, resyncing", self.symbol)
+            self.resync_depth(message)
+            return
+        self.depth_buffer.append(message)
+        snapshot, self.depth_snapshot = self.depth_snapshot, None
+        if snapshot is None:
+            self.request_depth_snapshot()
+            return
+        self.depth_update_id = snapshot["lastUpdateId"]
+        self.orderbook.on_order_add({"action": "snapshot",
+                                     "bids": self.parse_levels(snapshot["bids"]),
+                                     "asks": self.parse_levels(snapshot["asks"]),
+                                     "ts": float(message["E"]),
+                                     "symbol": self.symbol})
+        buffered = list(self.depth_buffer)
+        self.depth_buffer.clear()
+        for delta in buffered:
+            if self.depth_update_id is None:
+                #a gap in the buffer started a resync, the newer deltas wait for its snapshot
+                self.depth_buffer.append(delta)
+            else:
+                self.apply_depth_delta(delta)
+
+    def apply_depth_delta(self, message):
+        if message["u"] <= self.depth_update_id:
+            return # already part of the snapshot
+        if message["U"] > self.depth_update_id + 1:
+            logger.warning("Depth stream of %s skipped updates %d-%d, resyncing", self.symbol, self.depth_update_id + 1, message["U"] - 1)
+            self.resync_depth(message)
+            return
+        self.depth_update_id = message["u"]
+        self.orderbook.on_order_add({"action": "update",
+                                     "bids": self.parse_levels(message["b"]),
+                                     "asks": self.parse_levels(message["a"]),
+                                     "ts": float(message["E"]),
+                                     "symbol": self.symbol})
+
+    #receive_ns: monotonic stamp of the socket receive, see latency.py
+    def parse_message(self, message, type, receive_ns = None):
+        start = now()
+        if self.is_depth_message(message):
+            self.parse_depth_message(message, type)
+        elif type == "live":
             data = message
-            self.orderbook.on_trade({"last": float(data["c"]), 
-                                 "lastSz": float(data["Q"]),
-                                 "ts": float(data["E"]),
-                                 "askPx": float(data["a"]), 
-                                 "askSz": float(data["A"]), 
-                                 "bidPx": float(data["b"]), 
-                                 "bidSz": float(data["B"]),
-                                 "symbol": self.symbol,
-                                 "receiveTime": receive_time}) 
+            tick = Tick(float(data["c"]), float(data["Q"]), float(data["E"]), float(data["a"]), float(data["A"]),
+                        float(data["b"]), float(data["B"]), self.symbol, self.exchange_id, receive_ns or start)
+            latency.record("normalize", now() - start, self.exchange, self.symbol)
+            self.orderbook.on_trade(tick)
             
         elif type == "historic":
             data = message
-            self.orderbook.on_trade({"last": float(data["last"]), 
-                                 "lastSz": float(data["lastSz"]),
-                                 "ts": float(data["ts"]),
-                                 "askPx": float(data["askPx"]), 
-                                 "askSz": float(data["askSz"]), 
-                                 "bidPx": float(data["bidPx"]), 
-                                 "bidSz": float(data["bidSz"]),
-                                 "symbol": self.symbol})      
+            self.orderbook.on_trade(Tick(float(data["last"]), float(data["lastSz"]), float(data["ts"]), float(data["askPx"]), float(data["askSz"]),
+                                      float(data["bidPx"]), float(data["bidSz"]), self.symbol, self.exchange_id))      
         elif type == "download":
-            filename = 'historical_data/' + self.symbol + '_data.csv'
-            with open(filename, 'a') as csvfile: 
-                # creating a csv writer object 
-                csvwriter = csv.writer(csvfile) 
-                # writing the fields 
-                data = message
-                fields = [data["c"], data["Q"], data["E"], data["a"], data["A"], data["b"], data["B"]]
-                csvwriter.writerow(fields) 
-                csvfile.close() 
+            data = message
+            self.recorder.record([data["c"], data["Q"], data["E"], data["a"], data["A"], data["b"], data["B"]])
 
 
 class CoinbaseSymbolHandler(BaseSymbolHandler):
-    def __init__(self, symbol, type) -> None:
+    exchange = "Coinbase"
+
+    def __init__(self, symbol, type, rotation=None, record_format="csv") -> None:
         super().__init__(symbol, type)
-        self.symbol = symbol 
-
-        if type == "live":
-            self.data_handler = WSHandler(
-                url="wss://ws-feed.exchange.coinbase.com/ws", 
-                subscribe_message = {"type": "subscribe",
-                                    "product_ids": [symbol],
-                                    "channels": ["ticker"]}, 
-                symbol=symbol, 
-                symbol_handler=self,
-                data_action=type)
-            
-        elif type == "historic":
+        self.symbol = intern_symbol(symbol) 
+        self.parse_time = IsoTimestampParser() # caches the date part of Coinbase's ISO timestamps
+
+        #live and download symbols stream over their exchange's shared connection, see MarketDataManager
+        self.data_handler = None
+        if type == "historic":
             self.data_handler = HistHandler(
                 symbol = symbol,
                 symbol_handler=self)
-            
         elif type == "download":
-            #initialize csv file
-            filename = 'historical_data/' + self.symbol + '_data.csv'
-            with open(filename, 'w') as csvfile: 
-                # creating a csv writer object 
-                csvwriter = csv.writer(csvfile) 
-                # writing the fields 
-                csvwriter.writerow(["last", "lastSz", "ts", "askPx", "askSz", "bidPx", "bidSz"]) 
-                csvfile.close()
-
-            #start websocket to collect data
-            self.data_handler = WSHandler(
-                url="wss://ws-feed.exchange.coinbase.com/ws", 
-                subscribe_message = {"type": "subscribe",
-                                    "product_ids": [symbol],
-                                    "channels": ["ticker"]}, 
-                symbol=symbol, 
-                symbol_handler=self,
-                data_action=type)
-        else:
-            print("Invalid data type.")
-
-        if not isinstance(self.data_handler, IDataHandler):
+            #ticks are written to csv in batches by a background recorder thread
+            self.recorder = TickRecorder(self.symbol, exchange=self.exchange, rotation=rotation, record_format=record_format)
+        elif type != "live":
+            logger.error("Invalid data type.")
             raise ValueError
         
     
-    def parse_message(self, message, type):
-        receive_time = time.time()
-        if type == "live":
+    def is_depth_message(self, message):
+        return message.get("type") in ("snapshot", "l2update")
+
+    def parse_depth_message(self, message, type):
+        if type != "live":
+            return
+        if message["type"] == "snapshot":
+            self.orderbook.on_order_add({"action": "snapshot",
+                                         "bids": self.parse_levels(message["bids"]),
+                                         "asks": self.parse_levels(message["asks"]),
+                                         "ts": None,
+                                         "symbol": self.symbol})
+        else:
+            bids, asks = [], []
+            for side, price, size in message["changes"]:
+                (bids if side == "buy" else asks).append((float(price), float(size)))
+            self.orderbook.on_order_add({"action": "update",
+                                         "bids": bids,
+                                         "asks": asks,
+                                         "ts": self.parse_time(message["time"]),
+                                         "symbol": self.symbol})
+
+    #receive_ns: monotonic stamp of the socket receive, see latency.py
+    def parse_message(self, message, type, receive_ns = None):
+        start = now()
+        if self.is_depth_message(message):
+            self.parse_depth_message(message, type)
+        elif type == "live":
             data = message
-            #print(data)
-            ms = int(datetime.fromisoformat(data["time"]).timestamp() * 1000)
-            self.orderbook.on_trade({"last": float(data["price"]), 
-                                 "lastSz": float(data["last_size"]),
-                                 "ts": ms,
-                                 "askPx": float(data["best_ask"]), 
-                                 "askSz": float(data["best_ask_size"]), 
-                                 "bidPx": float(data["best_bid"]), 
-                                 "bidSz": float(data["best_bid_size"]),
-                                 "symbol": self.symbol,
-                                 "receiveTime": receive_time}) 
+            ms = self.parse_time(data["time"])
+            tick = Tick(float(data["price"]), float(data["last_size"]), ms, float(data["best_ask"]), float(data["best_ask_size"]),
+                        float(data["best_bid"]), float(data["best_bid_size"]), self.symbol, self.exchange_id, receive_ns or start)
+            latency.record("normalize", now() - start, self.exchange, self.symbol)
+            self.orderbook.on_trade(tick)
             
         elif type == "historic":
             data = message
-            self.orderbook.on_trade({"last": float(data["last"]), 
-                                 "lastSz": float(data["lastSz"]),
-                                 "ts": float(data["ts"]),
-                                 "askPx": float(data["askPx"]), 
-                                 "askSz": float(data["askSz"]), 
-                                 "bidPx": float(data["bidPx"]), 
-                                 "bidSz": float(data["bidSz"]),
-                                 "symbol": self.symbol})      
+            self.orderbook.on_trade(Tick(float(data["last"]), float(data["lastSz"]), float(data["ts"]), float(data["askPx"]), float(data["askSz"]),
+                                      float(data["bidPx"]), float(data["bidSz"]), self.symbol, self.exchange_id))      
         elif type == "download":
-            filename = 'historical_data/' + self.symbol + '_data.csv'
-            with open(filename, 'a') as csvfile: 
-                # creating a csv writer object 
-                csvwriter = csv.writer(csvfile) 
-                # writing the fields 
-                data = message
-                ms = int(datetime.fromisoformat(data["time"]).timestamp() * 1000)
-
-                fields = [data["price"], data["last_size"], ms , data["best_ask"], data["best_ask_size"], data["best_bid"], data["best_bid_size"]]
-                csvwriter.writerow(fields) 
-                csvfile.close() 
+            data = message
+            ms = self.parse_time(data["time"])
+            self.recorder.record([data["price"], data["last_size"], ms, data["best_ask"], data["best_ask_size"], data["best_bid"], data["best_bid_size"]])
 
 class OKXSymbolHandler(BaseSymbolHandler):
-    def __init__(self, symbol, type) -> None:
+    exchange = "OKX"
+
+    def __init__(self, symbol, type, rotation=None, record_format="csv") -> None:
         super().__init__(symbol, type)
-        self.symbol = symbol
-
-        if type == "live":
-            self.data_handler = WSHandler(
-                url="wss://ws.okx.com:8443/ws/v5/public", 
-                subscribe_message = {"op": "subscribe",
-                                    "args": [{"channel": "tickers", "instId": symbol}]}, 
-                symbol=symbol, 
-                symbol_handler=self,
-                data_action=type)
-            
-        elif type == "historic":
+        self.symbol = intern_symbol(symbol)
+        self.depth_seq = None # seqId of the last applied books message
+
+        #live and download symbols stream over their exchange's shared connection, see MarketDataManager
+        self.data_handler = None
+        if type == "historic":
             self.data_handler = HistHandler(
                 symbol = symbol,
                 symbol_handler=self)
-            
         elif type == "download":
-            #initialize csv file
-            filename = 'historical_data/' + self.symbol + '_data.csv'
-            with open(filename, 'w') as csvfile: 
-                # creating a csv writer object 
-                csvwriter = csv.writer(csvfile) 
-                # writing the fields 
-                csvwriter.writerow(["last", "lastSz", "ts", "askPx", "askSz", "bidPx", "bidSz"]) 
-                csvfile.close()
-
-            #start websocket to collect data
-            self.data_handler = WSHandler(
-                url="wss://ws.okx.com:8443/ws/v5/public", 
-                subscribe_message = {"op": "subscribe",
-                                    "args": [{"channel": "tickers", "instId": symbol}]}, 
-                symbol=symbol, 
-                symbol_handler=self,
-                data_action=type)
-        else:
-            print("Invalid data type.")
-
-        if not isinstance(self.data_handler, IDataHandler):
+            #ticks are written to csv in batches by a background recorder thread
+            self.recorder = TickRecorder(self.symbol, exchange=self.exchange, rotation=rotation, record_format=record_format)
+        elif type != "live":
+            logger.error("Invalid data type.")
             raise ValueError
 
 
 
-    def parse_message(self, message: dict[str, list[dict]], type: str):
-        receive_time = time.time()
-        if type == "live":
+    def is_depth_message(self, message):
+        return message.get("arg", {}).get("channel") == "books"
+
+    def parse_depth_message(self, message, type):
+        if type != "live" or "data" not in message:
+            return
+        data = message["data"][0]
+        if message.get("action") == "update" and self.depth_seq is not None and data.get("prevSeqId") != self.depth_seq:
+            logger.warning("Depth stream of %s skipped from seqId %s to %s", self.symbol, self.depth_seq, data.get("prevSeqId"))
+        self.depth_seq = data.get("seqId")
+        self.orderbook.on_order_add({"action": "snapshot" if message.get("action") == "snapshot" else "update",
+                                     "bids": self.parse_levels(data["bids"]),
+                                     "asks": self.parse_levels(data["asks"]),
+                                     "ts": float(data["ts"]),
+                                     "symbol": self.symbol})
+
+    #receive_ns: monotonic stamp of the socket receive, see latency.py
+    def parse_message(self, message: dict[str, list[dict]], type: str, receive_ns: int = None):
+        start = now()
+        if self.is_depth_message(message):
+            self.parse_depth_message(message, type)
+        elif type == "live":
             data = message["data"][0]
-            self.orderbook.on_trade({"last": float(data["last"]), 
-                                 "lastSz": float(data["lastSz"]),
-                                 "ts": float(data["ts"]),
-                                 "askPx": float(data["askPx"]), 
-                                 "askSz": float(data["askSz"]), 
-                                 "bidPx": float(data["bidPx"]), 
-                                 "bidSz": float(data["bidSz"]),
-                                 "symbol": self.symbol,
-                                 "receiveTime": receive_time}) 
+            tick = Tick(float(data["last"]), float(data["lastSz"]), float(data["ts"]), float(data["askPx"]), float(data["askSz"]),
+                        float(data["bidPx"]), float(data["bidSz"]), self.symbol, self.exchange_id, receive_ns or start)
+            latency.record("normalize", now() - start, self.exchange, self.symbol)
+            self.orderbook.on_trade(tick)
             
         elif type == "historic":
             data = message
-            self.orderbook.on_trade({"last": float(data["last"]), 
-                                 "lastSz": float(data["lastSz"]),
-                                 "ts": float(data["ts"]),
-                                 "askPx": float(data["askPx"]), 
-                                 "askSz": float(data["askSz"]), 
-                                 "bidPx": float(data["bidPx"]), 
-                                 "bidSz": float(data["bidSz"]),
-                                 "symbol": self.symbol}) 
+            self.orderbook.on_trade(Tick(float(data["last"]), float(data["lastSz"]), float(data["ts"]), float(data["askPx"]), float(data["askSz"]),
+                                      float(data["bidPx"]), float(data["bidSz"]), self.symbol, self.exchange_id)) 
             
             
         elif type == "download":
-            filename = 'historical_data/' + self.symbol + '_data.csv'
-            with open(filename, 'a') as csvfile: 
-                # creating a csv writer object 
-                csvwriter = csv.writer(csvfile) 
-                # writing the fields 
-                data = message["data"][0]
-                fields = [data["last"], data["lastSz"], data["ts"], data["askPx"], data["askSz"], data["bidPx"], data["bidSz"]]
-                csvwriter.writerow(fields) 
-                csvfile.close()
+            data = message["data"][0]
+            self.recorder.record([data["last"], data["lastSz"], data["ts"], data["askPx"], data["askSz"], data["bidPx"], data["bidSz"]])
 
@@ -0,0 +1,17 @@
+import glob
+import os
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+#every bundled capture, tests run against the recorded data
+@pytest.fixture(params=sorted(glob.glob(os.path.join(ROOT, "historical_data", "*.csv"))), ids=os.path.basename)
+def capture(request):
+    return request.param
+
+
+def symbol_of(file_name):
+    return os.path.basename(file_name).removesuffix("_data.csv")
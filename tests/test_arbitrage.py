@@ -0,0 +1,67 @@
+import pytest
+from arbitrage import ArbitrageEngine
+from portfolio_manager import PortfolioManager
+
+FEES = {"Binance": 0.001, "OKX": 0.002}
+
+
+class CappedSellLeg(PortfolioManager):
+    '''
+    Lets the sell leg's exchange sell only `cap` once the buy leg has filled, as if another trade used up the
+    risk budget in between.
+    '''
+    def __init__(self, cap, *args) -> None:
+        super().__init__(*args)
+        self.cap = cap
+
+    def sell_size(self, price, size, symbol):
+        allowed = super().sell_size(price, size, symbol)
+        if symbol == "BTC-USDT" and self.net_positions["BTCUSDT"] > 0:
+            return min(allowed, self.cap)
+        return allowed
+
+
+#Binance asks 100, OKX bids 101: an opportunity net of both fees
+def crossed_engine(portfolio_manager, size = 1.0):
+    engine = ArbitrageEngine(portfolio_manager, fees=FEES, threshold_bps=5.0)
+    engine.index.update("Binance", "BTCUSDT", 99.0, 5.0 * size, 100.0, size, 1000)
+    engine.index.update("OKX", "BTC-USDT", 101.0, 2.0 * size, 102.0, 5.0 * size, 1000)
+    return engine
+
+
+def test_both_legs_pay_fees():
+    portfolio_manager = PortfolioManager(1000000, "cppi", ["BTCUSDT", "BTC-USDT"])
+    signal = crossed_engine(portfolio_manager).check("BTC", 1000)
+    assert signal.kind == "opportunity"
+    assert portfolio_manager.net_positions == {"BTCUSDT": 1.0, "BTC-USDT": -1.0}
+    assert portfolio_manager.balance == pytest.approx(1000000 - 100.0 * 1.001 + 101.0 * 0.998, abs=1e-9)
+    assert portfolio_manager.trade_count == 2
+
+
+@pytest.mark.parametrize("cap", [0.4, 0])
+def test_short_sell_leg_is_unwound(cap):
+    portfolio_manager = CappedSellLeg(cap, 1000000, "cppi", ["BTCUSDT", "BTC-USDT"])
+    engine = crossed_engine(None)
+    signal = engine.check("BTC", 1000)
+    engine.portfolio_manager = portfolio_manager
+
+    assert engine.execute(signal) == (1.0, cap, 1.0 - cap)
+    #what is left long on Binance is what was sold on OKX
+    assert portfolio_manager.net_positions["BTCUSDT"] == pytest.approx(cap)
+    assert portfolio_manager.net_positions["BTC-USDT"] == pytest.approx(-cap)
+    assert portfolio_manager.balance == pytest.approx(1000000 - 100.0 * 1.001 + cap * 101.0 * 0.998 + (1.0 - cap) * 99.0 * 0.999, abs=1e-9)
+
+
+@pytest.mark.parametrize("risk_manager", ["cppi", "tipp", "ratio"])
+def test_legs_stay_within_risk_limits_and_hedged(risk_manager):
+    #quoted size far beyond what any risk manager allows
+    portfolio_manager = PortfolioManager(1000000, risk_manager, ["BTCUSDT", "BTC-USDT"])
+    engine = crossed_engine(None, size=1e6)
+    signal = engine.check("BTC", 1000)
+    engine.portfolio_manager = portfolio_manager
+    sell_limit = portfolio_manager.sell_size(signal.bid, signal.size, signal.sell_symbol)
+
+    bought, sold, unwound = engine.execute(signal)
+    assert 0 < bought <= sell_limit
+    assert sold + unwound == pytest.approx(bought)
+    assert portfolio_manager.net_positions["BTCUSDT"] == pytest.approx(-portfolio_manager.net_positions["BTC-USDT"])
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+from candles import CandleAggregator, timeframe_length
+from replay import TickColumns
+
+TIMEFRAMES = ("1s", "1m", "5m")
+
+
+def aggregated(columns, fill_gaps):
+    #room for every 1s bucket of the capture, filled or not
+    stored_length = int(columns.ts[-1] - columns.ts[0]) // 1000 + 2
+    aggregator = CandleAggregator(TIMEFRAMES, stored_length=stored_length, fill_gaps=fill_gaps)
+    for ts, price, size in zip(columns.ts.tolist(), columns.last.tolist(), columns.lastSz.tolist()):
+        aggregator.add_tick(ts, price, size, None)
+    return aggregator
+
+
+def resampled(columns, timeframe):
+    ticks = pd.DataFrame({"last": columns.last, "lastSz": columns.lastSz, "notional": columns.last * columns.lastSz},
+                         index=pd.to_datetime(columns.ts, unit="ms"))
+    candles = ticks.resample(f"{timeframe_length(timeframe)}ms", origin="epoch").agg(
+        {"last": ["first", "max", "min", "last", "mean", "count"], "lastSz": "sum", "notional": "sum"})
+    candles.columns = ["open", "high", "low", "close", "mean", "ticks", "volume", "notional"]
+    candles["start"] = (candles.index - pd.Timestamp(0)) // pd.Timedelta(1, "ms")
+    #the aggregator only stores finished candles, the last one is still in progress
+    return candles.iloc[:-1]
+
+
+@pytest.mark.parametrize("fill_gaps", [True, False])
+def test_candles_equal_pandas_resample(capture, fill_gaps):
+    columns = TickColumns.from_csv(capture)
+    if not columns.is_time_ordered():
+        columns = columns.sorted_by_time()
+    aggregator = aggregated(columns, fill_gaps)
+
+    for timeframe in TIMEFRAMES:
+        expected = resampled(columns, timeframe)
+        empty = expected["ticks"] == 0
+        if timeframe == "1s":
+            assert empty.any() # the test has to cover empty buckets
+        if fill_gaps:
+            #an empty bucket is a flat candle at the previous close
+            close = expected["close"].ffill()
+            for field in ("open", "high", "low", "close", "mean"):
+                expected[field] = expected[field].where(~empty, close)
+        else:
+            expected = expected[~empty]
+        candles = aggregator.get_timeframe(timeframe).candles.last()
+
+        assert len(candles) == len(expected), timeframe
+        assert candles["start"].tolist() == expected["start"].tolist()
+        assert candles["ticks"].tolist() == expected["ticks"].tolist()
+        for field in ("open", "high", "low", "close"):
+            assert candles[field].tolist() == expected[field].tolist(), (timeframe, field)
+        #sums are added in a different order by pandas
+        np.testing.assert_allclose(candles["mean"], expected["mean"], rtol=1e-12)
+        np.testing.assert_allclose(candles["volume"], expected["volume"], rtol=1e-9, atol=1e-12)
+        traded = (expected["volume"] > 0).to_numpy()
+        np.testing.assert_allclose(candles["vwap"][traded], (expected["notional"] / expected["volume"])[traded], rtol=1e-9)
@@ -0,0 +1,158 @@
+import os
+import struct
+import threading
+from bisect import bisect_left
+from collections import deque
+import numpy as np
+import pytest
+from conftest import ROOT
+from checkpoint import Checkpointer
+from correlation import RollingCorrelation
+from orderbook import PriceLevelBook
+from portfolio_manager import PortfolioManager
+from replay import TickColumns, ReplayCoordinator
+from strategy import IStrategy, MACDStrategy, RSIStrategy, SimpleMovingAvgStrategy
+from tick_format import Tick, exchange_for_symbol
+
+PAIRS = [("BTCUSDT", "ETHUSDT"), ("BTC-USD", "ETH-USD"), ("BTC-USDT", "ETH-USDT")]
+
+
+def load(symbols):
+    return {symbol: TickColumns.from_csv(os.path.join(ROOT, "historical_data", f"{symbol}_data.csv")) for symbol in symbols}
+
+
+#a fresh bot: every strategy on both books, one portfolio and the correlation of the two symbols
+def setup(symbols, timeframe):
+    portfolio_manager = PortfolioManager(1000000, "cppi", list(symbols))
+    portfolio_manager.correlation = RollingCorrelation(symbols, window=50)
+    books = []
+    for symbol in symbols:
+        book = PriceLevelBook(symbol=symbol, exchange=exchange_for_symbol(symbol), stored_length=100000)
+        for strategy in (MACDStrategy, RSIStrategy, SimpleMovingAvgStrategy):
+            book.add_book_listener(strategy(None, portfolio_manager), timeframe=timeframe)
+        book.add_book_listener(portfolio_manager.correlation)
+        books.append(book)
+    return portfolio_manager, books
+
+
+#replay the ticks from ts start (inclusive) to ts end (exclusive) of every capture as one merged stream
+def replay(captures, books, start, end):
+    coordinator = ReplayCoordinator()
+    for book in books:
+        columns = captures[book.symbol]
+        ts = columns.ts.tolist()
+        coordinator.add_stream(columns.slice(bisect_left(ts, start), bisect_left(ts, end)), book.symbol, book)
+    coordinator.run()
+
+
+def assert_same_state(a, b, path = "state"):
+    '''
+    Equal down to the bits of every float and array, and to the types; shared references may differ since a
+    restore copies what the checkpoint held.
+    '''
+    assert type(a) is type(b), path
+    if isinstance(a, dict):
+        assert list(a) == list(b), path
+        for key in a:
+            assert_same_state(a[key], b[key], f"{path}/{key}")
+    elif isinstance(a, np.ndarray):
+        assert a.dtype == b.dtype and a.shape == b.shape and a.tobytes() == b.tobytes(), path
+    elif isinstance(a, (list, tuple, deque)):
+        assert len(a) == len(b), path
+        for i, (x, y) in enumerate(zip(a, b)):
+            assert_same_state(x, y, f"{path}[{i}]")
+    elif isinstance(a, float):
+        assert struct.pack("<d", a) == struct.pack("<d", b), path
+    elif hasattr(a, "__dict__"):
+        assert_same_state(vars(a), vars(b), f"{path}.{type(a).__name__}")
+    else:
+        assert a == b, path
+
+
+@pytest.mark.parametrize("timeframe", [None, "1m"])
+@pytest.mark.parametrize("symbols", PAIRS, ids="/".join)
+def test_restored_run_equals_uninterrupted_run(tmp_path, symbols, timeframe):
+    captures = load(symbols)
+    first = min(int(columns.ts[0]) for columns in captures.values())
+    last = max(int(columns.ts[-1]) for columns in captures.values()) + 1
+    middle = (first + last) // 2
+
+    portfolio_manager, books = setup(symbols, timeframe)
+    replay(captures, books, first, last)
+    uninterrupted = Checkpointer(str(tmp_path / "unused.ckpt"), portfolio_manager, books)
+
+    portfolio_manager, books = setup(symbols, timeframe)
+    replay(captures, books, first, middle)
+    Checkpointer(str(tmp_path / "bot.ckpt"), portfolio_manager, books).save(wait=True)
+    halfway_trades = portfolio_manager.trade_count
+
+    portfolio_manager, books = setup(symbols, timeframe)
+    restored = Checkpointer(str(tmp_path / "bot.ckpt"), portfolio_manager, books)
+    assert restored.restore()
+    assert restored.restored_books == {f"{book.exchange}:{book.symbol}" for book in books}
+    replay(captures, books, middle, last)
+
+    assert 0 < halfway_trades < portfolio_manager.trade_count
+    assert portfolio_manager.get_pnl_without_save() == uninterrupted.portfolio_manager.get_pnl_without_save()
+    expected, actual = uninterrupted.snapshot(), restored.snapshot()
+    del expected["saved_at"], actual["saved_at"]
+    #books, candles, every indicator of every timeframe, the correlation window and the portfolio
+    assert_same_state(actual, expected)
+
+
+class Candles(IStrategy):
+    def __init__(self) -> None:
+        self.candles = []
+
+    def on_trade_add(self, new_candle, message):
+        self.candles.append(new_candle)
+
+
+def timeframe_book():
+    book = PriceLevelBook(symbol="BTCUSDT", exchange="Binance")
+    listener = Candles()
+    book.add_book_listener(listener, timeframe="1s")
+    return book, listener
+
+
+def tick(ts):
+    return Tick(100.0, 1.0, ts, 100.5, 1.0, 99.5, 1.0, "BTCUSDT", 1)
+
+
+def test_no_flat_candles_for_the_downtime(tmp_path):
+    book, listener = timeframe_book()
+    for ts in (1000, 1500, 2200):
+        book.on_trade(tick(ts))
+    checkpointer = Checkpointer(str(tmp_path / "bot.ckpt"), PortfolioManager(1000000, "cppi", ["BTCUSDT"]), [book])
+    checkpointer.save(wait=True)
+
+    #without a restart the aggregator fills the seconds without ticks with flat candles
+    book.on_trade(tick(12500))
+    assert [candle["ticks"] for candle in listener.candles] == [2, 1] + [0] * 9
+
+    restored, listener = timeframe_book()
+    assert Checkpointer(str(tmp_path / "bot.ckpt"), PortfolioManager(1000000, "cppi", ["BTCUSDT"]), [restored]).restore()
+    restored.on_trade(tick(12500))
+    #only the candle in progress at the checkpoint is finished, nothing is made up for the time the bot was down
+    assert [(candle["start"], candle["ticks"]) for candle in listener.candles] == [(2000, 1)]
+    restored.on_trade(tick(13100))
+    assert [(candle["start"], candle["ticks"]) for candle in listener.candles] == [(2000, 1), (12000, 1)]
+
+
+def test_snapshot_waits_for_books_mid_tick(tmp_path):
+    btc = PriceLevelBook(symbol="BTCUSDT", exchange="Binance")
+    eth = PriceLevelBook(symbol="ETHUSDT", exchange="Binance")
+    checkpointer = Checkpointer(str(tmp_path / "bot.ckpt"), PortfolioManager(1000000, "cppi", ["BTCUSDT", "ETHUSDT"]), [btc, eth])
+    checkpointer.attach()
+    checkpointer.next_save = 0
+
+    #the ETHUSDT feed thread is in the middle of a tick while a BTCUSDT tick makes the snapshot due
+    with eth.lock:
+        feed = threading.Thread(target=btc.on_trade, args=(tick(1000),))
+        feed.start()
+        feed.join(0.2)
+        assert feed.is_alive() and not checkpointer.lock.acquire(blocking=False)
+        eth.on_trade(Tick(2000.0, 1.0, 1000, 2000.5, 1.0, 1999.5, 1.0, "ETHUSDT", 1))
+    feed.join()
+    checkpointer.writer.join()
+    assert checkpointer.saves == 1
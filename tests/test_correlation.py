@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from correlation import RollingCorrelation
+
+SYMBOLS = ["BTCUSDT", "ETHUSDT", "BTC-USD"]
+
+
+#correlated random walks, one candle price per symbol and second; about a tenth of the candles are missing,
+#but some symbol trades every second so every second moves the candle clock
+def price_stream(steps, seed = 7):
+    rng = np.random.default_rng(seed)
+    shocks = rng.multivariate_normal(np.zeros(3), [[1.0, 0.8, 0.3], [0.8, 1.0, 0.1], [0.3, 0.1, 1.0]], size=steps) * 1e-3
+    prices = 100.0 * np.exp(np.cumsum(shocks, axis=0))
+    traded = rng.random((steps, 3)) > 0.1
+    traded[0] = True
+    traded[~traded.any(axis=1), 0] = True
+    for t in range(1, steps):
+        #a symbol without a candle keeps its previous price
+        prices[t, ~traded[t]] = prices[t - 1, ~traded[t]]
+    return prices, traded
+
+
+def feed(correlation, prices, traded, start, end):
+    for t in range(start, end):
+        for i, symbol in enumerate(SYMBOLS):
+            if traded[t, i]:
+                correlation.update(symbol, prices[t, i], t * 1000 + 137 * i)
+
+
+#the rows in the window after steps [0, end): a step is sampled once the next one begins
+def expected_rows(prices, end, window):
+    returns = np.log(prices[1:end - 1] / prices[:end - 2])
+    return returns[-window:]
+
+
+def assert_matches_numpy(correlation, prices, end):
+    rows = expected_rows(prices, end, correlation.window)
+    assert len(correlation) == len(rows)
+    assert np.allclose(correlation.mean(), rows.mean(axis=0), rtol=1e-9, atol=1e-15)
+    assert np.allclose(correlation.covariance(), np.cov(rows.T), rtol=1e-7, atol=1e-15)
+    assert np.allclose(correlation.correlation(), np.corrcoef(rows.T), rtol=1e-7, atol=1e-9)
+
+
+@pytest.mark.parametrize("resync_every", [1000, 7])
+@pytest.mark.parametrize("steps", [20, 50, 52, 400])
+def test_matches_corrcoef_over_the_window(steps, resync_every):
+    prices, traded = price_stream(steps)
+    correlation = RollingCorrelation(SYMBOLS, window=50, resync_every=resync_every)
+    feed(correlation, prices, traded, 0, steps)
+    assert_matches_numpy(correlation, prices, steps)
+
+
+def test_too_few_rows():
+    prices, traded = price_stream(3)
+    correlation = RollingCorrelation(SYMBOLS, window=50)
+    feed(correlation, prices, traded, 0, 3)
+    assert len(correlation) == 1
+    assert np.isnan(correlation.correlation()).all()
+
+
+def test_matches_corrcoef_after_restore():
+    prices, traded = price_stream(400)
+    correlation = RollingCorrelation(SYMBOLS, window=50, resync_every=64)
+    feed(correlation, prices, traded, 0, 237)
+    state = correlation.snapshot()
+
+    restored = RollingCorrelation(SYMBOLS, window=50, resync_every=64)
+    assert restored.restore(state)
+    assert_matches_numpy(restored, prices, 237)
+    #the snapshot is a copy, the running instance moving on doesn't change it
+    feed(correlation, prices, traded, 237, 400)
+    feed(restored, prices, traded, 237, 400)
+    assert_matches_numpy(restored, prices, 400)
+    assert np.array_equal(restored.correlation(), correlation.correlation())
+
+    for symbols, window in ((SYMBOLS[:2], 50), (SYMBOLS, 60)):
+        other = RollingCorrelation(symbols, window=window)
+        assert not other.restore(state)
+        assert len(other) == 0
@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from decoding import IsoTimestampParser
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+#exact integer ms, truncated like the parser, no float rounding
+def reference(text):
+    return (datetime.fromisoformat(text) - EPOCH) // timedelta(milliseconds=1)
+
+
+@pytest.mark.parametrize("days", [("2023-07-10", "2023-07-11"), ("2023-12-31", "2024-01-01"), ("2024-02-28", "2024-02-29"), ("2024-02-29", "2024-03-01")])
+def test_crossing_midnight(days):
+    parse = IsoTimestampParser()
+    before, after = days
+    #one parser for the whole stream, so the cached midnight has to move with the date
+    texts = [f"{before}T23:59:59.998000Z", f"{before}T23:59:59.999999Z", f"{after}T00:00:00.000000Z",
+             f"{after}T00:00:00.000001Z", f"{after}T00:00:01.250000Z", f"{before}T23:59:59.500000Z"]
+    for text in texts:
+        assert parse(text) == reference(text), text
+    assert parse(f"{after}T00:00:00.000000Z") - parse(f"{before}T23:59:59.999999Z") == 1
+
+
+@pytest.mark.parametrize("fraction", ["", ".5", ".53", ".531", ".5312", ".53123", ".531234", ".000001", ".999"])
+def test_short_fractions(fraction):
+    parse = IsoTimestampParser()
+    text = f"2023-07-10T05:05:13{fraction}Z"
+    assert parse(text) == reference(text)
+
+
+@pytest.mark.parametrize("time", ["05:05:13.531234", "05:05:13.5", "05:05:13", "23:59:59.999999", "00:00:00.000000"])
+def test_utc_offset_instead_of_z(time):
+    parse = IsoTimestampParser()
+    text = f"2023-07-10T{time}+00:00"
+    assert parse(text) == reference(text)
+    assert parse(text) == parse(f"2023-07-10T{time}Z")
+    #a non zero offset is the same instant moved
+    assert parse(f"2023-07-10T{time}+02:00") == reference(f"2023-07-10T{time}+02:00") == parse(text) - 2 * 3600000
@@ -0,0 +1,163 @@
+import json
+from collections import deque
+import pytest
+import symbol_handler
+from orderbook import DepthBook
+from symbol_handler import BinanceSymbolHandler
+
+
+def delta(first, last, bids = (), asks = ()):
+    return {"e": "depthUpdate", "E": 1700000000000 + last, "s": "BTCUSDT", "U": first, "u": last,
+            "b": [[str(price), str(size)] for price, size in bids], "a": [[str(price), str(size)] for price, size in asks]}
+
+
+def snapshot(last_update_id, bids, asks):
+    return {"lastUpdateId": last_update_id,
+            "bids": [[str(price), str(size)] for price, size in bids], "asks": [[str(price), str(size)] for price, size in asks]}
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    handler = BinanceSymbolHandler("BTCUSDT", "live")
+    handler.snapshot_requests = 0
+
+    #snapshots are handed in by deliver() instead of fetched over REST
+    def request_depth_snapshot():
+        if not handler.depth_fetching:
+            handler.depth_fetching = True
+            handler.snapshot_requests += 1
+    monkeypatch.setattr(handler, "request_depth_snapshot", request_depth_snapshot)
+    return handler
+
+
+#what fetch_depth_snapshot does when the REST call returns
+def deliver(handler, depth_snapshot):
+    handler.depth_snapshot = depth_snapshot
+    handler.depth_fetching = False
+
+
+def feed(handler, *messages):
+    for message in messages:
+        handler.parse_message(message, "live")
+
+
+def test_depth_book_applies_snapshot_and_updates():
+    book = DepthBook()
+    book.apply_snapshot([(100.0, 1.0), (99.0, 2.0)], [(101.0, 1.5), (102.0, 3.0)], 1)
+    book.apply_update([(100.5, 0.5), (100.0, 0)], [(101.0, 0)], 2)
+    assert book.best_bid() == (100.5, 0.5)
+    assert book.best_ask() == (102.0, 3.0)
+    assert book.depth(2) == {"bids": [(100.5, 0.5), (99.0, 2.0)], "asks": [(102.0, 3.0)]}
+    assert book.ts == 2
+
+
+def test_buffered_deltas_are_applied_after_the_snapshot(handler):
+    feed(handler,
+         delta(95, 98, bids=[(99.0, 9.0)]), # older than the snapshot, dropped
+         delta(99, 101, bids=[(100.0, 4.0)]), # straddles it, applied
+         delta(102, 103, asks=[(101.0, 0)]))
+    assert handler.snapshot_requests == 1
+    assert handler.depth_update_id is None
+    assert len(handler.depth_buffer) == 3
+
+    deliver(handler, snapshot(100, [(100.0, 1.0), (99.0, 2.0)], [(101.0, 1.5), (102.0, 3.0)]))
+    feed(handler, delta(104, 105, bids=[(100.5, 0.5)]))
+    depth = handler.get_orderbook().depth
+    assert handler.depth_update_id == 105
+    assert len(handler.depth_buffer) == 0
+    assert depth.depth() == {"bids": [(100.5, 0.5), (100.0, 4.0), (99.0, 2.0)], "asks": [(102.0, 3.0)]}
+
+
+def test_gap_resyncs(handler):
+    deliver(handler, snapshot(100, [(100.0, 1.0)], [(101.0, 1.0)]))
+    feed(handler, delta(101, 102, bids=[(100.0, 2.0)]))
+    assert handler.depth_update_id == 102
+
+    #103-104 never arrived
+    feed(handler, delta(105, 106, bids=[(100.0, 3.0)]))
+    assert handler.depth_update_id is None
+    assert handler.snapshot_requests == 1
+    assert list(handler.depth_buffer) == [delta(105, 106, bids=[(100.0, 3.0)])]
+    assert handler.get_orderbook().depth.best_bid() == (100.0, 2.0)
+
+    deliver(handler, snapshot(105, [(100.0, 2.5)], [(101.0, 1.0)]))
+    feed(handler, delta(107, 107, asks=[(101.0, 0.5)]))
+    assert handler.depth_update_id == 107
+    assert handler.get_orderbook().depth.depth() == {"bids": [(100.0, 3.0)], "asks": [(101.0, 0.5)]}
+
+
+def test_gap_inside_the_buffer_keeps_the_newer_deltas(handler):
+    feed(handler, delta(101, 102, bids=[(100.0, 2.0)]), delta(105, 106, bids=[(100.0, 3.0)]))
+    deliver(handler, snapshot(100, [(100.0, 1.0)], [(101.0, 1.0)]))
+    feed(handler, delta(107, 108, bids=[(100.0, 4.0)]))
+    assert handler.depth_update_id is None
+    assert [message["U"] for message in handler.depth_buffer] == [105, 107]
+    assert handler.get_orderbook().depth.best_bid() == (100.0, 2.0)
+
+
+def test_buffer_overflow_resyncs_from_scratch(handler):
+    handler.depth_buffer = deque(maxlen=4)
+    feed(handler, *[delta(k, k) for k in range(101, 105)])
+    assert len(handler.depth_buffer) == 4
+
+    #the snapshot arrives too late, the deltas right after it were dropped with the overflow
+    feed(handler, delta(105, 105))
+    assert [message["U"] for message in handler.depth_buffer] == [105]
+    deliver(handler, snapshot(100, [(100.0, 1.0)], [(101.0, 1.0)]))
+    feed(handler, delta(106, 106))
+    assert handler.depth_update_id is None
+    assert [message["U"] for message in handler.depth_buffer] == [105, 106]
+    assert handler.snapshot_requests == 2
+
+    deliver(handler, snapshot(105, [(100.0, 1.0)], [(101.0, 1.0)]))
+    feed(handler, delta(107, 107, bids=[(100.0, 2.0)]))
+    assert handler.depth_update_id == 107
+    assert handler.get_orderbook().depth.best_bid() == (100.0, 2.0)
+
+
+def test_failed_snapshots_back_off(monkeypatch):
+    handler = BinanceSymbolHandler("BTCUSDT", "live")
+    clock = [1000.0]
+    responses = [OSError("timed out"), OSError("timed out"), snapshot(100, [(100.0, 1.0)], [(101.0, 1.0)])]
+    fetches = []
+
+    class Response():
+        def __init__(self, body) -> None:
+            self.body = body
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            return False
+
+        def read(self):
+            return json.dumps(self.body).encode()
+
+    def urlopen(url, timeout):
+        fetches.append(clock[0])
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return Response(response)
+
+    #the fetch runs right away instead of on a side thread
+    class Thread():
+        def __init__(self, target, name, daemon) -> None:
+            self.target = target
+
+        def start(self):
+            self.target()
+
+    monkeypatch.setattr(symbol_handler.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(symbol_handler.urllib.request, "urlopen", urlopen)
+    monkeypatch.setattr(symbol_handler.threading, "Thread", Thread)
+
+    #every delta asks for the snapshot, only the ones after the backoff fetch it
+    for clock[0] in (1000.0, 1000.5, 1001.0, 1002.5, 1003.0):
+        feed(handler, delta(101, 101))
+    assert fetches == [1000.0, 1001.0, 1003.0]
+    assert handler.depth_failures == 0
+    feed(handler, delta(102, 102, bids=[(100.0, 2.0)]))
+    assert handler.depth_update_id == 102
+    assert handler.get_orderbook().depth.best_bid() == (100.0, 2.0)
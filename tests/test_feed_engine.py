@@ -0,0 +1,46 @@
+import asyncio
+import json
+from feed_engine import AsyncFeedEngine, serve_messages
+
+
+#serve the messages to one feed until it received them all (or 2s passed)
+async def run(messages, on_message, **engine_args):
+    server = await serve_messages(messages, port=0)
+    port = server.sockets[0].getsockname()[1]
+    engine = AsyncFeedEngine(reconnect_delay=10.0, **engine_args)
+    feed = engine.add_feed(f"ws://127.0.0.1:{port}", {"op": "subscribe"}, on_message, "test")
+    runner = asyncio.create_task(engine.run())
+    for _ in range(200):
+        if feed.messages_received == len(messages):
+            break
+        await asyncio.sleep(0.01)
+    engine.stop()
+    await runner
+    server.close()
+    return feed
+
+
+def test_bad_message_does_not_drop_the_connection():
+    messages = [{"n": 0}, {"bad": True}, {"n": 1}, {"n": 2}]
+    received = []
+
+    def on_message(message):
+        data = json.loads(message)
+        if "bad" in data:
+            raise KeyError("n")
+        received.append(data["n"])
+
+    feed = asyncio.run(run(messages, on_message))
+    #every message came over the first connection, the bad one was only logged
+    assert received == [0, 1, 2]
+    assert feed.messages_received == len(messages)
+    assert feed.messages_failed == 1
+
+
+def test_messages_over_a_mebibyte():
+    #a full depth snapshot, larger than the 1 MiB websockets accepts by default
+    messages = [{"n": 0, "bids": [["100.0", "1.0"]] * 100000}, {"n": 1}]
+    received = []
+    feed = asyncio.run(run(messages, lambda message: received.append(json.loads(message)["n"])))
+    assert received == [0, 1]
+    assert feed.messages_failed == 0
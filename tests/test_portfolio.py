@@ -0,0 +1,28 @@
+from conftest import symbol_of
+from orderbook import PriceLevelBook
+from portfolio_manager import PortfolioManager
+from replay import TickColumns, replay_ticks
+from strategy import SimpleMovingAvgStrategy
+
+
+def test_pnl_history_is_stamped_with_tick_times(capture):
+    columns = TickColumns.from_csv(capture)
+    symbol = symbol_of(capture)
+    portfolio_manager = PortfolioManager(1000000, "cppi", [symbol])
+    book = PriceLevelBook()
+    book.add_book_listener(SimpleMovingAvgStrategy(None, portfolio_manager))
+    replay_ticks(columns, symbol, book, 0, len(columns))
+    times, values = portfolio_manager.pnls_over_time.raw()
+    assert len(times)
+    #a replay stamps the capture's time, not the time it ran at
+    assert columns.ts[0] / 1000 <= times[0] and times[-1] <= columns.ts[-1] / 1000
+    assert (times[1:] >= times[:-1]).all()
+    assert values[-1] == portfolio_manager.get_pnl_without_save()
+
+
+def test_pnl_history_never_goes_back_in_time():
+    portfolio_manager = PortfolioManager(1000000, "cppi", ["BTCUSDT", "BTC-USD"])
+    portfolio_manager.get_pnl(1700000001.0)
+    portfolio_manager.get_pnl(1700000000.5)
+    times, _ = portfolio_manager.pnls_over_time.raw()
+    assert times.tolist() == [1700000001.0, 1700000001.0]
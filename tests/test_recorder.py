@@ -0,0 +1,48 @@
+import csv
+import pytest
+from recorder import CSV_HEADER, TickRecorder
+from replay import TickColumns
+
+ROWS = [["100.5", "0.25", str(1700000000000 + k), "100.6", "1.0", "100.4", "2.0"] for k in range(5)]
+
+
+def record(directory, rows, record_format):
+    recorder = TickRecorder("BTCUSDT", "Binance", directory=str(directory), record_format=record_format)
+    for row in rows:
+        recorder.record(row)
+    recorder.close()
+    return recorder.file_name(None)
+
+
+def test_restarted_csv_download_appends(tmp_path):
+    file_name = record(tmp_path, ROWS[:2], "csv")
+    record(tmp_path, ROWS[2:], "csv")
+    with open(file_name, newline='') as file:
+        assert list(csv.reader(file)) == [CSV_HEADER] + ROWS
+
+
+def test_csv_partial_row_is_cut_before_appending(tmp_path):
+    file_name = record(tmp_path, ROWS[:2], "csv")
+    with open(file_name, 'a') as file:
+        file.write("100.5,0.2")
+    record(tmp_path, ROWS[2:], "csv")
+    with open(file_name, newline='') as file:
+        assert list(csv.reader(file)) == [CSV_HEADER] + ROWS
+
+
+def test_empty_csv_gets_a_header(tmp_path):
+    open(tmp_path / "BTCUSDT_data.csv", 'w').close()
+    file_name = record(tmp_path, ROWS, "csv")
+    with open(file_name, newline='') as file:
+        assert list(csv.reader(file)) == [CSV_HEADER] + ROWS
+
+
+@pytest.mark.parametrize("partial", [b"", b"\x01\x02\x03"])
+def test_restarted_binary_download_appends(tmp_path, partial):
+    file_name = record(tmp_path, ROWS[:2], "binary")
+    with open(file_name, 'ab') as file:
+        file.write(partial)
+    record(tmp_path, ROWS[2:], "binary")
+    columns = TickColumns.from_file(file_name)
+    assert columns.ts.tolist() == [int(row[2]) for row in ROWS]
+    assert columns.last.tolist() == [float(row[0]) for row in ROWS]
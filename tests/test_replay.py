@@ -0,0 +1,140 @@
+import glob
+import os
+import shutil
+import numpy as np
+import pytest
+from conftest import ROOT, symbol_of
+from orderbook import PriceLevelBook
+from replay import TickColumns, ColumnarReplay, ReplayCoordinator, read_captures_tail, replay_ticks, segment_sums, warm_up, TICK_FIELDS
+from tick_format import convert_csv
+from strategy import IStrategy
+
+
+class Recorder(IStrategy):
+    def __init__(self) -> None:
+        self.candles = []
+
+    def on_trade_add(self, new_candle, message):
+        #publishNs is a latency stamp, different on every run
+        self.candles.append((new_candle["price"], tuple(message[field] for field in TICK_FIELDS), message.symbol))
+
+
+def replayed(run):
+    book = PriceLevelBook(stored_length=100000)
+    recorder = Recorder()
+    book.add_book_listener(recorder)
+    run(book)
+    return book, recorder
+
+
+def assert_same_books(a, b):
+    for field in a.candles.data.dtype.names:
+        assert np.array_equal(a.candles.last()[field], b.candles.last()[field]), field
+    for field in a.CHECKPOINT_FIELDS:
+        assert getattr(a, field) == getattr(b, field), field
+
+
+def test_columnar_candles_equal_tick_by_tick(capture):
+    columns = TickColumns.from_csv(capture)
+    symbol = symbol_of(capture)
+    ticks, tick_recorder = replayed(lambda book: replay_ticks(columns, symbol, book, 0, len(columns)))
+    columnar, columnar_recorder = replayed(lambda book: ColumnarReplay(columns, symbol).run(book))
+    #exact, not approximately: SMA ties depend on the last bits of the candle means
+    assert columnar_recorder.candles == tick_recorder.candles
+    assert_same_books(columnar, ticks)
+
+
+def test_columnar_replay_in_pieces(capture):
+    #runs of a merged replay start and end anywhere, the candle in progress carries over between them
+    columns = TickColumns.from_csv(capture)
+    symbol = symbol_of(capture)
+    ticks, _ = replayed(lambda book: replay_ticks(columns, symbol, book, 0, len(columns)))
+
+    def in_pieces(book):
+        cuts = [0, 1, 7, 500, 501, len(columns) // 2, len(columns)]
+        for start, end in zip(cuts, cuts[1:]):
+            ColumnarReplay(columns.slice(start, end), symbol).run(book)
+    pieces, _ = replayed(in_pieces)
+    assert_same_books(pieces, ticks)
+
+
+def test_coordinator_columnar_runs_equal_tick_by_tick(capture):
+    columns = TickColumns.from_csv(capture)
+    symbol = symbol_of(capture)
+    results = []
+    for columnar_run in (None, 2, 32):
+        coordinator = ReplayCoordinator(columnar_run=columnar_run)
+        book, recorder = replayed(lambda book: coordinator.add_stream(columns, symbol, book) or coordinator.run())
+        results.append((book, recorder.candles))
+    for book, candles in results[1:]:
+        assert candles == results[0][1]
+        assert_same_books(book, results[0][0])
+
+
+def test_merged_streams_columnar_runs_equal_tick_by_tick():
+    #run boundaries depend on the other stream's timestamps, the candles of each book must not
+    captures = sorted(glob.glob(os.path.join(ROOT, "historical_data", "*.csv")))[:2]
+    streams = [(TickColumns.from_csv(capture), symbol_of(capture)) for capture in captures]
+    results = []
+    for columnar_run in (None, 2):
+        coordinator = ReplayCoordinator(columnar_run=columnar_run)
+        books = []
+        for columns, symbol in streams:
+            book = PriceLevelBook(symbol=symbol, stored_length=100000)
+            coordinator.add_stream(columns, symbol, book)
+            books.append(book)
+        coordinator.run()
+        results.append(books)
+    for tick_book, columnar_book in zip(*results):
+        assert_same_books(columnar_book, tick_book)
+
+
+def test_segment_sums_add_left_to_right():
+    values = [0.1] * 7 + [1e16, 1.0, -1e16]
+    assert segment_sums(values, [0, 7], [7, 10]) == [((((((0.1 + 0.1) + 0.1) + 0.1) + 0.1) + 0.1) + 0.1), (1e16 + 1.0) - 1e16]
+
+
+#the capture cut by time into three files named like hourly rotation, the oldest also converted to .ticks
+def rotate(capture, directory):
+    symbol = symbol_of(capture)
+    with open(capture, 'rb') as file:
+        header, *lines = file.readlines()
+    ts_index = header.decode().strip().split(",").index("ts")
+    first, last = (int(float(lines[k].split(b",")[ts_index])) for k in (0, -1))
+    cuts = [first + (last - first) // 3, first + 2 * (last - first) // 3]
+    pieces = [[], [], []]
+    for line in lines:
+        pieces[sum(int(float(line.split(b",")[ts_index])) >= cut for cut in cuts)].append(line)
+    file_names = []
+    for hour, piece in enumerate(pieces):
+        file_name = os.path.join(directory, f"{symbol}_data_202310010{hour}.csv")
+        with open(file_name, 'wb') as file:
+            file.write(header + b"".join(piece))
+        file_names.append(file_name)
+    convert_csv(file_names[0])
+    return last - first
+
+
+@pytest.mark.parametrize("share", [0.25, 0.5, 2.0])
+def test_tail_across_rotated_captures(capture, tmp_path, share):
+    span = rotate(capture, str(tmp_path))
+    columns, file_names = read_captures_tail(symbol_of(capture), int(span * share), str(tmp_path))
+    expected = TickColumns.from_file_tail(capture, int(span * share))
+    for field in TICK_FIELDS:
+        assert np.array_equal(columns.column(field), expected.column(field)), field
+    #newest file only, then the two newest, then every file with the oldest read from its .ticks
+    assert [os.path.basename(file_name) for file_name in file_names] == [f"{symbol_of(capture)}_data_202310010{hour}.{extension}" for hour, extension in
+                                                                          {0.25: [(2, "csv")], 0.5: [(1, "csv"), (2, "csv")], 2.0: [(0, "ticks"), (1, "csv"), (2, "csv")]}[share]]
+
+
+def test_warm_up_across_rotated_captures(capture, tmp_path):
+    whole, rotated = tmp_path / "whole", tmp_path / "rotated"
+    whole.mkdir()
+    rotated.mkdir()
+    shutil.copy(capture, whole)
+    span = rotate(capture, str(rotated))
+    books = [PriceLevelBook(stored_length=100000, symbol=symbol_of(capture)) for directory in (whole, rotated)]
+    for book, directory in zip(books, (whole, rotated)):
+        assert warm_up([book], int(span * 0.8), str(directory)) == [book]
+    assert len(books[0].candles) > 0
+    assert_same_books(*books)
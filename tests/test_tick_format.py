@@ -0,0 +1,112 @@
+import csv
+import os
+import numpy as np
+import pytest
+from conftest import symbol_of
+from replay import TickColumns
+from tick_format import TICK_DTYPE, HEADER_SIZE, TickFileWriter, convert_csv, exchange_for_symbol, open_tick_file, read_header
+
+
+#the csv text parsed field by field, what every reader has to reproduce exactly
+def csv_records(file_name):
+    with open(file_name, newline='') as file:
+        rows = list(csv.DictReader(file))
+    records = np.zeros(len(rows), dtype=TICK_DTYPE)
+    for field in TICK_DTYPE.names:
+        parse = int if field == "ts" else float
+        records[field] = [parse(row[field]) for row in rows]
+    return records
+
+
+def assert_bitwise_equal(records, expected):
+    for field in TICK_DTYPE.names:
+        assert len(records[field]) == len(expected), field
+        #compared as raw bits, not as numbers
+        assert np.array_equal(np.asarray(records[field]).view(np.int64), expected[field].view(np.int64)), field
+
+
+def write_ticks(csv_file, out_file, how):
+    symbol = symbol_of(csv_file)
+    if how == "convert_csv":
+        return convert_csv(csv_file, out_file)
+    #the download path: TickFileWriter fed the csv rows as strings, like the recorder gets them from the exchange
+    with open(csv_file, newline='') as file:
+        reader = csv.reader(file)
+        columns = next(reader)
+        order = [columns.index(field) for field in TICK_DTYPE.names]
+        rows = [[row[i] for i in order] for row in reader]
+    writer = TickFileWriter(out_file, symbol, exchange_for_symbol(symbol), batch_size=1000)
+    writer.write_rows(rows)
+    writer.close()
+    return out_file
+
+
+@pytest.mark.parametrize("how", ["convert_csv", "TickFileWriter"])
+def test_csv_to_ticks_round_trip(capture, tmp_path, how):
+    out_file = write_ticks(capture, str(tmp_path / os.path.basename(capture).replace(".csv", ".ticks")), how)
+    expected = csv_records(capture)
+    header, records = open_tick_file(out_file)
+    assert header["symbol"] == symbol_of(capture)
+    assert header["exchange"] == exchange_for_symbol(symbol_of(capture))
+    assert isinstance(records, np.memmap)
+    assert_bitwise_equal(records, expected)
+    #and through the replay's readers
+    columns = TickColumns.from_binary(out_file)
+    assert_bitwise_equal({field: columns.column(field) for field in TICK_DTYPE.names}, expected)
+    assert_bitwise_equal({field: TickColumns.from_csv(capture).column(field) for field in TICK_DTYPE.names}, expected)
+
+
+@pytest.mark.filterwarnings("ignore:loadtxt")
+def test_empty_capture(tmp_path):
+    csv_file = tmp_path / "BTCUSDT_data.csv"
+    csv_file.write_text("last,lastSz,ts,askPx,askSz,bidPx,bidSz\n")
+    out_file = convert_csv(str(csv_file))
+    assert os.path.getsize(out_file) == HEADER_SIZE
+    header, records = open_tick_file(out_file)
+    assert header["symbol"] == "BTCUSDT"
+    assert len(records) == 0 and records.dtype == TICK_DTYPE
+    assert len(TickColumns.from_file(out_file)) == 0
+
+
+def test_files_shorter_than_a_header_are_rejected(tmp_path):
+    for size in (0, HEADER_SIZE - 1):
+        file_name = tmp_path / f"short{size}.ticks"
+        file_name.write_bytes(b"\0" * size)
+        with pytest.raises(ValueError):
+            read_header(str(file_name))
+
+
+@pytest.mark.parametrize("extra", [1, TICK_DTYPE.itemsize // 2, TICK_DTYPE.itemsize - 1])
+def test_partial_last_record_is_ignored(capture, tmp_path, extra):
+    out_file = convert_csv(capture, str(tmp_path / "capture.ticks"))
+    with open(out_file, 'ab') as file:
+        file.write(b"\xff" * extra)
+    assert (os.path.getsize(out_file) - HEADER_SIZE) % TICK_DTYPE.itemsize == extra
+    header, records = open_tick_file(out_file)
+    assert_bitwise_equal(records, csv_records(capture))
+
+
+def test_symbol_of_rotated_capture(capture, tmp_path):
+    symbol = symbol_of(capture)
+    rotated = tmp_path / f"{symbol}_data_20231001.csv"
+    rotated.write_bytes(open(capture, 'rb').read())
+    header, records = open_tick_file(convert_csv(str(rotated)))
+    assert (header["symbol"], header["exchange"]) == (symbol, exchange_for_symbol(symbol))
+    assert_bitwise_equal(records, csv_records(capture))
+
+
+def test_append_checks_the_header(tmp_path):
+    out_file = str(tmp_path / "BTCUSDT_data.ticks")
+    TickFileWriter(out_file, "BTCUSDT", "Binance").close()
+    #same symbol and exchange: appends
+    writer = TickFileWriter(out_file, "BTCUSDT", "Binance")
+    writer.write_rows([("100.0", "1.0", "1000", "100.5", "1.0", "99.5", "1.0")])
+    writer.close()
+    for symbol, exchange in (("ETHUSDT", "Binance"), ("BTCUSDT", "OKX")):
+        with pytest.raises(ValueError):
+            TickFileWriter(out_file, symbol, exchange)
+    assert os.path.getsize(out_file) == HEADER_SIZE + TICK_DTYPE.itemsize
+    with open(out_file, 'r+b') as file:
+        file.write(b"NOTTICKS")
+    with pytest.raises(ValueError):
+        TickFileWriter(out_file, "BTCUSDT", "Binance")
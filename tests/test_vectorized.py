@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from conftest import symbol_of
+from orderbook import PriceLevelBook
+from replay import TickColumns, replay_ticks
+from strategy import IStrategy
+from sweep import run_backtest
+from vectorized import VECTORIZED, candle_series, run_vectorized
+
+
+class CandlePrices(IStrategy):
+    def __init__(self) -> None:
+        self.prices = []
+
+    def on_trade_add(self, new_candle, message):
+        self.prices.append(new_candle["price"])
+
+
+def test_candle_series_equals_on_trade(capture):
+    columns = TickColumns.from_csv(capture)
+    book = PriceLevelBook()
+    recorder = CandlePrices()
+    book.add_book_listener(recorder)
+    replay_ticks(columns, symbol_of(capture), book, 0, len(columns))
+    closes, prices = candle_series(columns)
+    assert prices.tolist() == recorder.prices
+
+
+#parity with a tick by tick replay through PriceLevelBook.on_trade, not with the columnar candles
+@pytest.mark.parametrize("risk_manager", ["cppi", "ratio"])
+@pytest.mark.parametrize("strategy", sorted(VECTORIZED))
+def test_vectorized_equals_tick_by_tick(capture, strategy, risk_manager):
+    columns = TickColumns.from_csv(capture)
+    symbol = symbol_of(capture)
+    event = run_backtest(strategy, symbol, {}, risk_manager, 1000000, columns, columnar=False)
+    vector = run_vectorized(strategy, symbol, {}, risk_manager, 1000000, columns)
+    assert vector["trades"] == event["trades"]
+    assert np.isclose(vector["pnl"], event["pnl"], rtol=1e-9, atol=1e-9)
+    assert np.isclose(vector["max_drawdown"], event["max_drawdown"], rtol=1e-9, atol=1e-9)
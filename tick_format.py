@@ -0,0 +1,259 @@
+import os
+import struct
+import sys
+import numpy as np
+
+# Fixed-width binary tick files (.ticks)
+# Layout: a 64 byte little-endian header followed by back to back TICK_DTYPE records.
+# Header: magic (8s), schema version (H), header size (H), record size (I), symbol (32s), exchange (16s).
+# The record count is not stored, it follows from the file size, so the download path can keep appending
+# and a reader simply ignores a partially written last record.
+
+MAGIC = b"TBTICKS\0"
+SCHEMA_VERSION = 1
+HEADER_FORMAT = "<8sHHI32s16s"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# the seven recorded fields, same order as the csv captures
+TICK_DTYPE = np.dtype([("last", "<f8"),
+                       ("lastSz", "<f8"),
+                       ("ts", "<i8"),
+                       ("askPx", "<f8"),
+                       ("askSz", "<f8"),
+                       ("bidPx", "<f8"),
+                       ("bidSz", "<f8")])
+
+
+# numeric exchange ids carried by ticks, 0 when the exchange is unknown
+EXCHANGES = ["-", "Binance", "Coinbase", "OKX"]
+EXCHANGE_IDS = {exchange: i for i, exchange in enumerate(EXCHANGES)}
+
+
+def intern_symbol(symbol):
+    #one string object per symbol, so symbol comparisons and dict lookups on ticks are pointer checks
+    return sys.intern(symbol)
+
+
+class Tick():
+    '''
+    One top of book tick, the message type of PriceLevelBook.on_trade for live and historic data.
+    Fixed slots instead of a dict: no per-tick hash table, and fields are plain attribute reads
+    (tick.askPx). Symbols are interned and the exchange is a small integer id, tick.exchange gives its name.
+    receiveNs (live socket receive stamp) and publishNs (candle published to a listener) are None when unset.
+    Listeners written against the old dict messages keep working: tick["askPx"], tick.get("receiveNs")
+    and "receiveNs" in tick map to the attributes.
+    '''
+    __slots__ = ("last", "lastSz", "ts", "askPx", "askSz", "bidPx", "bidSz", "symbol", "exchange_id", "receiveNs", "publishNs")
+
+    def __init__(self, last, lastSz, ts, askPx, askSz, bidPx, bidSz, symbol, exchange_id = 0, receiveNs = None) -> None:
+        self.last = last
+        self.lastSz = lastSz
+        self.ts = ts
+        self.askPx = askPx
+        self.askSz = askSz
+        self.bidPx = bidPx
+        self.bidSz = bidSz
+        self.symbol = symbol
+        self.exchange_id = exchange_id
+        self.receiveNs = receiveNs
+        self.publishNs = None
+
+    @property
+    def exchange(self):
+        return EXCHANGES[self.exchange_id]
+
+    @exchange.setter
+    def exchange(self, exchange):
+        self.exchange_id = EXCHANGE_IDS.get(exchange, 0)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def get(self, key, default = None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in TICK_DTYPE.names + ("symbol", "exchange", "receiveNs", "publishNs")}
+
+    def __repr__(self):
+        return f"Tick({self.symbol} {self.exchange} ts={self.ts} last={self.last}x{self.lastSz} bid={self.bidPx}x{self.bidSz} ask={self.askPx}x{self.askSz})"
+
+
+class TickBatch():
+    '''
+    Preallocated block of ticks of one symbol, stored as TICK_DTYPE records (the .ticks file layout),
+    for code that moves ticks in bulk: appending copies seven numbers into the next record, records
+    can be written to a file or replayed as columns without conversion, and tick(i) gives a Tick view.
+    '''
+    def __init__(self, capacity, symbol = "-", exchange = "-") -> None:
+        self.records = np.zeros(capacity, dtype=TICK_DTYPE)
+        self.capacity = capacity
+        self.count = 0
+        self.symbol = intern_symbol(symbol)
+        self.exchange_id = EXCHANGE_IDS.get(exchange, 0)
+
+    def __len__(self):
+        return self.count
+
+    def is_full(self):
+        return self.count == self.capacity
+
+    #fields in TICK_DTYPE order, strings straight from the exchange are converted
+    def append(self, last, lastSz, ts, askPx, askSz, bidPx, bidSz):
+        if self.count == self.capacity:
+            raise IndexError("tick batch is full")
+        self.records[self.count] = (float(last), float(lastSz), int(float(ts)), float(askPx), float(askSz), float(bidPx), float(bidSz))
+        self.count += 1
+
+    def append_tick(self, tick):
+        self.append(tick.last, tick.lastSz, tick.ts, tick.askPx, tick.askSz, tick.bidPx, tick.bidSz)
+
+    #filled records, a view
+    def view(self):
+        return self.records[:self.count]
+
+    def tick(self, i):
+        if not -self.count <= i < self.count:
+            raise IndexError(i)
+        record = self.records[i % self.count]
+        return Tick(float(record["last"]), float(record["lastSz"]), float(record["ts"]), float(record["askPx"]),
+                    float(record["askSz"]), float(record["bidPx"]), float(record["bidSz"]), self.symbol, self.exchange_id)
+
+    def __iter__(self):
+        symbol, exchange_id = self.symbol, self.exchange_id
+        for last, lastSz, ts, askPx, askSz, bidPx, bidSz in self.view().tolist():
+            yield Tick(last, lastSz, float(ts), askPx, askSz, bidPx, bidSz, symbol, exchange_id)
+
+    def clear(self):
+        self.count = 0
+
+
+def exchange_for_symbol(symbol):
+    #symbol naming used by main.py: BTCUSDT on Binance, BTC-USD on Coinbase, BTC-USDT on OKX
+    if "-" not in symbol:
+        return "Binance"
+    return "OKX" if symbol.endswith("-USDT") else "Coinbase"
+
+
+def tick_file_name(symbol, directory='historical_data'):
+    return f"{directory}/{symbol}_data.ticks"
+
+
+def write_header(file, symbol, exchange):
+    file.write(struct.pack(HEADER_FORMAT, MAGIC, SCHEMA_VERSION, HEADER_SIZE, TICK_DTYPE.itemsize,
+                           symbol.encode(), exchange.encode()))
+
+
+def read_header(file_name):
+    with open(file_name, 'rb') as file:
+        raw = file.read(HEADER_SIZE)
+    if len(raw) < HEADER_SIZE:
+        raise ValueError(f"{file_name} is too short to be a tick file")
+    magic, version, header_size, record_size, symbol, exchange = struct.unpack(HEADER_FORMAT, raw)
+    if magic != MAGIC:
+        raise ValueError(f"{file_name} is not a tick file")
+    if version != SCHEMA_VERSION or record_size != TICK_DTYPE.itemsize:
+        raise ValueError(f"{file_name} has unsupported schema version {version} (record size {record_size})")
+    return {"version": version,
+            "header_size": header_size,
+            "record_size": record_size,
+            "symbol": symbol.rstrip(b"\0").decode(),
+            "exchange": exchange.rstrip(b"\0").decode()}
+
+
+def open_tick_file(file_name):
+    '''
+    Returns (header, records) where records is a read-only np.memmap of TICK_DTYPE.
+    Pages are shared by every process that maps the same file.
+    '''
+    header = read_header(file_name)
+    count = (os.path.getsize(file_name) - header["header_size"]) // header["record_size"]
+    if count == 0:
+        return header, np.zeros(0, dtype=TICK_DTYPE)
+    records = np.memmap(file_name, dtype=TICK_DTYPE, mode='r', offset=header["header_size"], shape=(count,))
+    return header, records
+
+
+class TickFileWriter():
+    '''
+    Appends ticks to a .ticks file, writing the header when the file is new or empty.
+    An existing file must have the same symbol, exchange and schema, otherwise ValueError.
+    A partial record at the end of an existing file (a crash mid write) is cut off so new records stay aligned.
+    '''
+    def __init__(self, file_name, symbol, exchange, batch_size = 1024) -> None:
+        self.file_name = file_name
+        if os.path.exists(file_name) and os.path.getsize(file_name) >= HEADER_SIZE:
+            header = read_header(file_name)
+            if (header["symbol"], header["exchange"]) != (symbol, exchange):
+                raise ValueError(f"{file_name} holds {header['exchange']} {header['symbol']} ticks, not {exchange} {symbol}")
+        self.file = open(file_name, 'ab')
+        size = self.file.tell()
+        if size < HEADER_SIZE:
+            self.file.truncate(0)
+            write_header(self.file, symbol, exchange)
+        elif (size - HEADER_SIZE) % TICK_DTYPE.itemsize:
+            self.file.truncate(size - (size - HEADER_SIZE) % TICK_DTYPE.itemsize)
+            self.file.seek(0, os.SEEK_END)
+        self.batch = TickBatch(batch_size, symbol, exchange) # reused for every write
+
+    #rows are sequences in TICK_DTYPE field order, values may still be strings straight from the exchange
+    def write_rows(self, rows):
+        batch = self.batch
+        for row in rows:
+            batch.append(*row)
+            if batch.is_full():
+                self.write_batch(batch)
+        self.write_batch(batch)
+
+    def write_batch(self, batch):
+        batch.view().tofile(self.file)
+        batch.clear()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def convert_csv(csv_file, out_file = None, symbol = None, exchange = None):
+    '''
+    Converts a csv capture (historical_data/<symbol>_data.csv, or a rotated <symbol>_data_<period>.csv) into a
+    .ticks file next to it.
+    '''
+    if symbol is None:
+        symbol = os.path.basename(csv_file).split("_data")[0]
+    if exchange is None:
+        exchange = exchange_for_symbol(symbol)
+    if out_file is None:
+        out_file = csv_file.removesuffix(".csv") + ".ticks"
+
+    with open(csv_file) as file:
+        columns = file.readline().strip().split(",")
+    usecols = [columns.index(field) for field in TICK_DTYPE.names]
+    data = np.loadtxt(csv_file, delimiter=",", skiprows=1, usecols=usecols, dtype=np.float64, ndmin=2)
+
+    records = np.empty(len(data), dtype=TICK_DTYPE)
+    for i, field in enumerate(TICK_DTYPE.names):
+        records[field] = data[:, i]
+    with open(out_file, 'wb') as file:
+        write_header(file, symbol, exchange)
+        records.tofile(file)
+    print(f"Converted {len(records)} ticks from {csv_file} to {out_file}")
+    return out_file
+
+
+if __name__ == "__main__":
+    #python tick_format.py historical_data/*.csv
+    for csv_file in sys.argv[1:]:
+        convert_csv(csv_file)
@@ -0,0 +1,114 @@
+import csv
+import numpy as np
+
+
+class TimeSeriesStore():
+    '''
+    Bounded history of (timestamp, value) points in preallocated float64 arrays, with two resolutions:
+    raw points for the last raw_seconds, and min/max/last per bucket_seconds bucket beyond that.
+    Both tiers are circular, so memory is fixed: raw_capacity points and bucket_capacity buckets
+    (default one week of minutes).
+    '''
+    def __init__(self, raw_seconds = 3600, raw_capacity = 100000, bucket_seconds = 60, bucket_capacity = 10080) -> None:
+        self.raw_seconds = raw_seconds
+        self.bucket_seconds = bucket_seconds
+
+        self.raw_capacity = raw_capacity
+        self.raw_times = np.zeros(raw_capacity)
+        self.raw_values = np.zeros(raw_capacity)
+        self.raw_position = 0
+        self.raw_count = 0
+
+        self.bucket_capacity = bucket_capacity
+        self.bucket_starts = np.zeros(bucket_capacity)
+        self.bucket_mins = np.zeros(bucket_capacity)
+        self.bucket_maxs = np.zeros(bucket_capacity)
+        self.bucket_lasts = np.zeros(bucket_capacity)
+        self.bucket_position = 0
+        self.bucket_count = 0
+
+        #bucket still being filled
+        self.current_start = None
+        self.current_min = self.current_max = self.current_last = 0.0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, value):
+        self.raw_times[self.raw_position] = timestamp
+        self.raw_values[self.raw_position] = value
+        self.raw_position = (self.raw_position + 1) % self.raw_capacity
+        if self.raw_count < self.raw_capacity:
+            self.raw_count += 1
+
+        start = timestamp // self.bucket_seconds * self.bucket_seconds
+        if start != self.current_start:
+            if self.current_start is not None:
+                self.push_bucket()
+            self.current_start = start
+            self.current_min = self.current_max = self.current_last = value
+        else:
+            if value < self.current_min:
+                self.current_min = value
+            elif value > self.current_max:
+                self.current_max = value
+            self.current_last = value
+        self.count += 1
+
+    def push_bucket(self):
+        i = self.bucket_position
+        self.bucket_starts[i] = self.current_start
+        self.bucket_mins[i] = self.current_min
+        self.bucket_maxs[i] = self.current_max
+        self.bucket_lasts[i] = self.current_last
+        self.bucket_position = (i + 1) % self.bucket_capacity
+        if self.bucket_count < self.bucket_capacity:
+            self.bucket_count += 1
+
+    def latest(self):
+        return self.current_last if self.count else None
+
+    #ordered copy of the last n items of a circular array, oldest first
+    def ordered(self, array, position, count):
+        return np.roll(array, -position)[len(array) - count:]
+
+    def raw(self):
+        return (self.ordered(self.raw_times, self.raw_position, self.raw_count),
+                self.ordered(self.raw_values, self.raw_position, self.raw_count))
+
+    def buckets(self):
+        #finished buckets plus the one being filled: (starts, mins, maxs, lasts)
+        columns = [self.ordered(array, self.bucket_position, self.bucket_count)
+                   for array in (self.bucket_starts, self.bucket_mins, self.bucket_maxs, self.bucket_lasts)]
+        if self.current_start is not None:
+            current = (self.current_start, self.current_min, self.current_max, self.current_last)
+            columns = [np.append(column, value) for column, value in zip(columns, current)]
+        return tuple(columns)
+
+    def downsampled(self):
+        '''
+        Returns (times, lasts, mins, maxs): one row per bucket for everything older than raw_seconds,
+        then every raw point of the last raw_seconds (min = max = last).
+        '''
+        raw_times, raw_values = self.raw()
+        if self.count == 0:
+            return raw_times, raw_values, raw_values, raw_values
+
+        #raw points from the first bucket boundary after the cutoff, whole buckets before it
+        cutoff = max(raw_times[-1] - self.raw_seconds, raw_times[0])
+        boundary = -(-cutoff // self.bucket_seconds) * self.bucket_seconds
+        starts, mins, maxs, lasts = self.buckets()
+        old = starts < boundary
+        recent = raw_times >= boundary
+        return (np.concatenate([starts[old], raw_times[recent]]),
+                np.concatenate([lasts[old], raw_values[recent]]),
+                np.concatenate([mins[old], raw_values[recent]]),
+                np.concatenate([maxs[old], raw_values[recent]]))
+
+    def export_csv(self, file_name, name = "value"):
+        times, lasts, mins, maxs = self.downsampled()
+        with open(file_name, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(["time", name, "min", "max"])
+            writer.writerows(zip(times.tolist(), lasts.tolist(), mins.tolist(), maxs.tolist()))
@@ -0,0 +1,333 @@
+import argparse
+import glob
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from indicators import StreamingMACD, window_macd_weights
+from replay import TickColumns, segment_sums
+from strategy import MACDStrategy, RSIStrategy, SimpleMovingAvgStrategy
+
+# what a strategy does on a candle
+BUY, SELL, REBALANCE, WAIT = 1, -1, 0, 2
+
+# rows per block when a computation needs a window per candle, bounds the temporary arrays
+BLOCK = 1 << 16
+
+
+def candle_closes(ts, candle_length_ms = 1000):
+    '''
+    Indices of the ticks that close a candle in a fresh PriceLevelBook, the same as replay.candle_boundaries
+    but without a loop per candle. A tick closes the candle started by tick b when ts > start(b) + length,
+    i.e. floor((ts - 1) / length) >= floor(ts[b] / length) + 1. So the candidates are the ticks where
+    floor((ts - 1) / length) steps up, and a boundary sitting exactly on a multiple of the length makes the
+    next candidate a non-boundary when that candidate is only one step up. ts must be sorted.
+    '''
+    ts = np.asarray(ts, dtype=np.int64)
+    if len(ts) == 0:
+        return np.empty(0, dtype=np.int64)
+    steps = (ts - 1) // candle_length_ms
+    #a fresh book starts at candle_start 0
+    candidates = np.flatnonzero(np.diff(steps, prepend=0) > 0)
+    if len(candidates) < 2:
+        return candidates
+    steps = steps[candidates]
+    skips = (ts[candidates[:-1]] % candle_length_ms == 0) & (steps[1:] == steps[:-1] + 1)
+    #a candidate is skipped only when the previous one is a boundary, so inside a run of skips every other one is kept
+    index = np.arange(len(skips))
+    run_start = np.maximum.accumulate(np.where(skips, -1, index))
+    kept = np.ones(len(candidates), dtype=bool)
+    kept[1:] = (index - run_start) % 2 == 0
+    return candidates[kept]
+
+
+def candle_series(columns, candle_length_ms = 1000):
+    '''
+    (closing tick indices, candle prices) of a capture: candle k is the one published when tick closes[k]
+    arrives, with the mean price PriceLevelBook gives it (the first one is the book's 0.0 placeholder).
+    Prices are summed tick by tick in order like the book's running sum, so the means are bit for bit the same.
+    '''
+    closes = candle_closes(columns.ts, candle_length_ms)
+    if len(closes) == 0:
+        return closes, np.empty(0)
+    last = columns.last.tolist()
+    ends = closes.tolist()
+    #the placeholder candle holds 0.0 and every tick before the first close
+    first = 0.0
+    for price in last[:ends[0]]:
+        first += price
+    sums = [first] + segment_sums(last, ends[:-1], ends[1:])
+    prices = np.array(sums) / np.diff(closes, prepend=-1)
+    return closes, prices
+
+
+def sma_actions(prices, strategy):
+    window = strategy.window_size
+    actions = np.full(len(prices), WAIT, dtype=np.int8)
+    if len(prices) < window:
+        return actions
+    #flat windows make price == average ties common, and which way they go depends on the rounding left in
+    #RollingSMA's running sum, so that sum is replayed in the same order instead of summing each window
+    values = prices.tolist()
+    running = 0.0
+    sums = []
+    for k, price in enumerate(values):
+        running += price
+        if k >= window:
+            running -= values[k - window]
+        sums.append(running)
+    average = np.array(sums[window - 1:]) / window
+    latest = prices[window - 1:]
+    actions[window - 1:] = np.where(latest > average, SELL, np.where(latest < average, BUY, REBALANCE))
+    return actions
+
+
+def rsi_actions(prices, strategy):
+    window = strategy.window_size
+    actions = np.full(len(prices), WAIT, dtype=np.int8)
+    #the first non zero price is the reference, changes are counted from the one after it
+    nonzero = np.flatnonzero(prices != 0)
+    if len(nonzero) == 0 or len(prices) - nonzero[0] - 1 < window:
+        return actions
+    first = nonzero[0]
+    deltas = np.diff(prices[first:])
+    ups = sliding_window_view(np.where(deltas > 0, deltas, 0.0), window).sum(axis=1) / window
+    downs = sliding_window_view(np.where(deltas > 0, 0.0, -deltas), window).sum(axis=1) / window
+    downs[downs == 0] = 0.1
+    rsi = 100 - 100 / (1 + ups / downs)
+    actions[first + window:] = np.where(rsi >= strategy.sell_thresh, SELL, np.where(rsi <= strategy.buy_thresh, BUY, REBALANCE))
+    return actions
+
+
+def windowed_macd(prices, short_window, long_window, signal_span):
+    #WindowedMACD for every full window: two dot products per candle, computed a block at a time
+    macd_weights, signal_weights = window_macd_weights(short_window, long_window, signal_span)
+    windows = sliding_window_view(prices, long_window)
+    macd = np.empty(len(windows))
+    signal = np.empty(len(windows))
+    for start in range(0, len(windows), BLOCK):
+        block = windows[start:start + BLOCK] - prices[long_window - 1 + start:long_window - 1 + start + BLOCK, None]
+        macd[start:start + BLOCK] = block @ macd_weights
+        signal[start:start + BLOCK] = block @ signal_weights
+    return macd, signal
+
+
+def streaming_macd(prices, short_window, long_window, signal_span):
+    #EMAs over the whole history are a recursion, run it as StreamingMACD does
+    indicator = StreamingMACD(short_window, long_window, signal_span)
+    values = [indicator.update(price) for price in prices.tolist()]
+    macd = np.array([value[0] for value in values])
+    signal = np.array([value[1] for value in values])
+    return macd[long_window - 1:], signal[long_window - 1:]
+
+
+def rolling_hurst(prices, window = 100, min_lag = 2, max_lag = 20):
+    '''
+    RollingHurst.value after every price: slope of log(std of lagged differences) over log(lag), with each
+    lag's sum and sum of squares over the window taken from cumulative sums of the differences.
+    '''
+    n = len(prices)
+    lags = list(range(min_lag, max_lag))
+    log_lags = np.log(lags)
+    centered = log_lags - log_lags.mean()
+    slope = np.zeros(n)
+    valid = np.ones(n, dtype=bool)
+    index = np.arange(n)
+    count = np.minimum(index + 1, window) # prices in the window after price k
+    for weight, lag in zip(centered.tolist(), lags):
+        diffs = prices[lag:] - prices[:-lag] # diffs[j] ends at price j + lag
+        sums = np.concatenate(([0.0], np.cumsum(diffs)))
+        sums_sq = np.concatenate(([0.0], np.cumsum(diffs * diffs)))
+        diff_count = count - lag
+        end = np.clip(index - lag + 1, 0, None) # diffs ending at or before price k
+        begin = np.clip(end - diff_count, 0, None)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = (sums[end] - sums[begin]) / diff_count
+            variance = (sums_sq[end] - sums_sq[begin]) / diff_count - mean * mean
+            valid &= (diff_count > 0) & (variance > 0)
+            slope += weight * 0.5 * np.log(np.where(variance > 0, variance, 1.0))
+    hurst = slope / float((centered * centered).sum())
+    hurst[~valid] = np.nan
+    return hurst
+
+
+def macd_actions(prices, strategy):
+    long_window = strategy.long_window
+    actions = np.full(len(prices), WAIT, dtype=np.int8)
+    if len(prices) < long_window:
+        return actions
+    compute = windowed_macd if strategy.windowed_macd else streaming_macd
+    macd, signal = compute(prices, strategy.short_window, long_window, strategy.signal_span)
+    hurst = rolling_hurst(prices, strategy.hurst_len, strategy.hurst_min_lag, strategy.hurst_max_lag)[long_window - 1:]
+    trending = hurst > strategy.hurst_thresh
+    actions[long_window - 1:] = np.where((macd > signal) & trending, BUY, np.where((macd < signal) & trending, SELL, REBALANCE))
+    return actions
+
+
+VECTORIZED = {"macd": (MACDStrategy, macd_actions), "rsi": (RSIStrategy, rsi_actions), "sma": (SimpleMovingAvgStrategy, sma_actions)}
+
+
+def simulate(actions, ask, ask_size, bid, bid_size, risk_manager = "cppi", initial_balance = 1000000, resync_every = 10000):
+    '''
+    PortfolioManager buy/sell/rebalance for one symbol over the candles that act, with the same float
+    operations in the same order (including the mark to market running total and its resync), so the
+    result matches the event driven backtest. Everything is a local variable, the marks are inlined.
+    Returns (pnl, trades, max drawdown).
+    '''
+    balance = initial_balance
+    position = 0
+    position_value = 0
+    net_value = 0.0
+    marks = 0
+    trades = 0
+    peak = 0.0
+    max_drawdown = 0.0
+    #risk manager allocation: cppi/tipp cushion * 1/max_asset_downside, ratio: share of the balance
+    cppi, tipp, ratio = risk_manager == "cppi", risk_manager == "tipp", risk_manager == "ratio"
+    multiplier = 1 / 0.2
+
+    actions = actions.tolist()
+    for k in [k for k, action in enumerate(actions) if action != WAIT]:
+        action = actions[k]
+        if action == SELL:
+            price, size = bid[k], bid_size[k]
+        else:
+            price, size = ask[k], ask_size[k]
+
+        #update_price
+        value = position * price
+        net_value += value - position_value
+        position_value = value
+        marks += 1
+        if marks % resync_every == 0:
+            net_value = position_value
+
+        pnl = (balance + net_value) - initial_balance
+        if cppi:
+            risk_limit = (pnl + initial_balance * 0.1) * multiplier / price
+        elif tipp:
+            risk_limit = ((pnl + initial_balance) * 0.1) * multiplier / price
+        elif ratio:
+            risk_limit = balance * 0.3 / price
+        else:
+            risk_limit = None
+
+        traded = True
+        if action == BUY:
+            balance_limit = balance / price
+            limit = (risk_limit if risk_limit is not None else balance_limit) - position
+            shares = max(0, min(size, min(balance_limit, limit)))
+            shares = max(0, min(shares, balance / price))
+            balance -= shares * price
+            position += shares
+        elif action == SELL:
+            shares = max(0, min(size, (risk_limit if risk_limit is not None else 0) - (-position)))
+            balance += shares * price
+            position -= shares
+        elif risk_limit and position > risk_limit:
+            #rebalance sells down to the risk limit through sell(), which marks the price once more
+            marks += 1
+            if marks % resync_every == 0:
+                net_value = position_value
+            shares = min(position - risk_limit, size)
+            balance += shares * price
+            position -= shares
+        else:
+            shares = 0
+            traded = False
+
+        if traded:
+            #mark_to_market after the trade
+            value = position * price
+            net_value += value - position_value
+            position_value = value
+            marks += 1
+            if marks % resync_every == 0:
+                net_value = position_value
+        if shares > 0:
+            trades += 1
+
+        pnl = (balance + net_value) - initial_balance
+        if pnl > peak:
+            peak = pnl
+        elif peak - pnl > max_drawdown:
+            max_drawdown = peak - pnl
+
+    return (balance + net_value) - initial_balance, trades, max_drawdown
+
+
+def run_vectorized(strategy, symbol, params, risk_manager = "cppi", balance = 1000000, columns = None):
+    '''
+    Vectorized counterpart of sweep.run_backtest, returns the same result fields.
+    '''
+    started = time.perf_counter()
+    if not columns.is_time_ordered():
+        columns = columns.sorted_by_time()
+    strategy_class, actions_for = VECTORIZED[strategy]
+    instance = strategy_class(market_data_manager=None, portfolio_manager=None, **params)
+    closes, prices = candle_series(columns)
+    actions = actions_for(prices, instance)
+    pnl, trades, max_drawdown = simulate(actions, columns.askPx[closes].tolist(), columns.askSz[closes].tolist(),
+                                         columns.bidPx[closes].tolist(), columns.bidSz[closes].tolist(), risk_manager, balance)
+    return {"strategy": strategy,
+            "symbol": symbol,
+            "params": params,
+            "pnl": pnl,
+            "max_drawdown": max_drawdown,
+            "trades": trades,
+            "candles": len(prices),
+            "seconds": time.perf_counter() - started}
+
+
+def check_parity(file_name, strategy, params = None, risk_manager = "cppi", balance = 1000000, tolerance = 1e-9):
+    '''
+    Parity check: runs the event driven backtest tick by tick through PriceLevelBook.on_trade (the path of
+    main.py -d historic) and the vectorized one on the same capture and compares PnL, trade count and max drawdown.
+    '''
+    from sweep import run_backtest, symbol_for_file
+
+    params = params or {}
+    columns = TickColumns.from_file(file_name)
+    if not columns.is_time_ordered():
+        columns = columns.sorted_by_time()
+    symbol = symbol_for_file(file_name)
+    event = run_backtest(strategy, symbol, params, risk_manager, balance, columns, columnar=False)
+    vector = run_vectorized(strategy, symbol, params, risk_manager, balance, columns)
+    scale = max(1.0, abs(event["pnl"]))
+    passed = (abs(event["pnl"] - vector["pnl"]) <= tolerance * scale and event["trades"] == vector["trades"]
+              and abs(event["max_drawdown"] - vector["max_drawdown"]) <= tolerance * scale)
+    print(f"{symbol:<10} {strategy:<5} {risk_manager:<6} event pnl {event['pnl']:>14.6f} trades {event['trades']:>6} ({event['seconds']:.2f}s)  "
+          f"vectorized pnl {vector['pnl']:>14.6f} trades {vector['trades']:>6} ({vector['seconds']:.2f}s)  {'ok' if passed else 'FAILED'}")
+    return {"file": file_name, "strategy": strategy, "risk_manager": risk_manager, "event": event, "vectorized": vector, "passed": passed}
+
+
+if __name__ == "__main__":
+    from sweep import parse_params, symbol_for_file
+
+    parser = argparse.ArgumentParser(description="Vectorized backtest: candles, signals and portfolio sizing over whole arrays instead of event callbacks\
+                                        \nTry \'python vectorized.py -s macd -p hurst_thresh=0.5\' or \'python vectorized.py --check\' to compare with the event driven backtest",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-s', '--strategies', choices=list(VECTORIZED), nargs='*', help='Strategies to run (default: all)', default=list(VECTORIZED))
+    parser.add_argument('-p', '--params', nargs='*', help='Constructor parameters as name=value', default=None)
+    parser.add_argument('-f', '--files', nargs='*', help='Capture files (default: historical_data/*.csv)', default=None)
+    parser.add_argument('-r', '--risk_managers', choices=['cppi', 'tipp', 'ratio'], nargs='*', help='Risk managers (default: cppi)', default=["cppi"])
+    parser.add_argument('-b', '--balance', type = float, help='Initial balance (default: 1000000)', default=1000000)
+    parser.add_argument('--check', action='store_true', help='Also run the event driven backtest and check both give the same result')
+    args = parser.parse_args()
+
+    params = {name: values[0] for name, values in parse_params(args.params).items()} if args.params else {}
+    file_names = args.files or sorted(glob.glob('historical_data/*.csv'))
+    passed = True
+    for file_name in file_names:
+        if args.check:
+            for strategy in args.strategies:
+                for risk_manager in args.risk_managers:
+                    passed &= check_parity(file_name, strategy, params, risk_manager, args.balance)["passed"]
+            continue
+        columns = TickColumns.from_file(file_name)
+        for strategy in args.strategies:
+            for risk_manager in args.risk_managers:
+                result = run_vectorized(strategy, symbol_for_file(file_name), params, risk_manager, args.balance, columns)
+                print(f"{result['symbol']:<10} {strategy:<5} {risk_manager:<6} pnl {result['pnl']:>14.2f} max drawdown {result['max_drawdown']:>12.2f} "
+                      f"trades {result['trades']:>6} candles {result['candles']:>8} ({result['seconds']:.2f}s)")
+    if not passed:
+        raise SystemExit(1)